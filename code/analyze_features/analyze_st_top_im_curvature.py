@@ -59,9 +59,10 @@ def measure_curvrect_stats(bank, image_brick, batch_size=20, \
         print('processing images w filter bank')
         sys.stdout.flush()
         st = time.time()
-        all_curv_filt_coeffs = bank.filter_image_batch_pytorch(image_batch, which_kernels='curv')
-        all_rect_filt_coeffs = bank.filter_image_batch_pytorch(image_batch, which_kernels='rect')
-        all_lin_filt_coeffs = bank.filter_image_batch_pytorch(image_batch, which_kernels='linear')
+        # only keeping the max over filters and the mean over space for each family, 
+        # these are accumulated as chunks of filters are done (full coefficient arrays not stored)
+        curv_stats, rect_stats, lin_stats = \
+                bank.filter_image_batch_reduce(image_batch, which_kernels=['curv','rect','linear'])
         
         elapsed = time.time() - st
         print('took %.5f sec to process batch of %d images (image size %d pix)'\
@@ -69,42 +70,30 @@ def measure_curvrect_stats(bank, image_brick, batch_size=20, \
  
         print('computing summary stats')
         # Compute some summary stats (trying to give many options here)
-        max_curv_images = np.max(all_curv_filt_coeffs, axis=2)
-        max_rect_images = np.max(all_rect_filt_coeffs, axis=2)
-        max_lin_images = np.max(all_lin_filt_coeffs, axis=2)
+        max_curv_images = curv_stats['max_over_filters']
+        max_rect_images = rect_stats['max_over_filters']
+        max_lin_images = lin_stats['max_over_filters']
         
         # method 1 - compare curved filters vs linear filters.
         unique_curv_inds = max_curv_images>max_lin_images
         unique_lin_inds = max_lin_images>max_curv_images
         
-        unique_curv_ims = copy.deepcopy(max_curv_images)
-        unique_curv_ims[~unique_curv_inds] = 0.0        
-        unique_lin_ims = copy.deepcopy(max_lin_images)
-        unique_lin_ims[~unique_lin_inds] = 0.0
-
-        curv_score_method1[batch_inds] = np.mean(np.mean(unique_curv_ims, axis=0), axis=0);
-        lin_score_method1[batch_inds] = np.mean(np.mean(unique_lin_ims, axis=0), axis=0);
+        curv_score_method1[batch_inds] = np.mean(np.where(unique_curv_inds, max_curv_images, 0.0), axis=(0,1))
+        lin_score_method1[batch_inds] = np.mean(np.where(unique_lin_inds, max_lin_images, 0.0), axis=(0,1))
         
         # method 2 - compare curved against both angular (rect) and linear filters.
         unique_curv_inds = ((max_curv_images>max_rect_images) & (max_curv_images>max_lin_images))
         unique_rect_inds = ((max_rect_images>max_curv_images) & (max_rect_images>max_lin_images))
         unique_lin_inds = ((max_lin_images>max_curv_images) & (max_lin_images>max_rect_images))
 
-        unique_curv_ims = copy.deepcopy(max_curv_images)
-        unique_curv_ims[~unique_curv_inds] = 0.0
-        unique_rect_ims = copy.deepcopy(max_rect_images)
-        unique_rect_ims[~unique_rect_inds] = 0.0
-        unique_lin_ims = copy.deepcopy(max_lin_images)
-        unique_lin_ims[~unique_lin_inds] = 0.0
-
-        curv_score_method2[batch_inds] = np.mean(np.mean(unique_curv_ims, axis=0), axis=0);
-        rect_score_method2[batch_inds] = np.mean(np.mean(unique_rect_ims, axis=0), axis=0);
-        lin_score_method2[batch_inds] = np.mean(np.mean(unique_lin_ims, axis=0), axis=0);
+        curv_score_method2[batch_inds] = np.mean(np.where(unique_curv_inds, max_curv_images, 0.0), axis=(0,1))
+        rect_score_method2[batch_inds] = np.mean(np.where(unique_rect_inds, max_rect_images, 0.0), axis=(0,1))
+        lin_score_method2[batch_inds] = np.mean(np.where(unique_lin_inds, max_lin_images, 0.0), axis=(0,1))
 
         # averaging power over image dimensions        
-        mean_curv_over_space[batch_inds,:] = np.mean(np.mean(all_curv_filt_coeffs, axis=0), axis=0).T
-        mean_rect_over_space[batch_inds,:] = np.mean(np.mean(all_rect_filt_coeffs, axis=0), axis=0).T
-        mean_lin_over_space[batch_inds,:] = np.mean(np.mean(all_lin_filt_coeffs, axis=0), axis=0).T
+        mean_curv_over_space[batch_inds,:] = curv_stats['mean_over_space'].T
+        mean_rect_over_space[batch_inds,:] = rect_stats['mean_over_space'].T
+        mean_lin_over_space[batch_inds,:] = lin_stats['mean_over_space'].T
  
     curvrect = {'curv_score_method1': curv_score_method1, 
                 'lin_score_method1': lin_score_method1, 
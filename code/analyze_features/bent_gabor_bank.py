@@ -293,6 +293,37 @@ class bent_gabor_feature_bank():
 
         # This should behave like filter_image_batch, but is much faster when using 
         # a GPU (specify in self.device)
+        # Uses the cached kernels in filter_image_batch_multi.
+        
+        if which_kernels=='all':
+            all_conved_images = self.filter_image_batch_multi(image_batch, \
+                                        which_kernels=['curv','rect','linear'], to_numpy=False)
+            all_conved_images = torch.cat(all_conved_images, axis=2)
+        elif which_kernels in ['curv','rect','linear']:
+            all_conved_images = self.filter_image_batch_multi(image_batch, \
+                                        which_kernels=[which_kernels], to_numpy=False)[0]
+        else:
+            raise ValueError('which_kernels must be one of [curv, rect, linear, all]')
+            
+        if to_numpy:
+            all_conved_images = all_conved_images.detach().cpu().numpy()
+            
+        return all_conved_images
+    
+    def __get_kernel_tensors__(self, which_kernels):
+        
+        """
+        Get the kernels for one family of filters (curv, rect, linear), ready for filtering 
+        real-valued images with torch.fft.rfft2.
+        Filtering is ifft2(fft2(image) * kernel), which is a circular convolution with the complex 
+        filter ifft2(kernel). The real and imaginary parts of that filter are each real-valued, 
+        so they are stored as their own half-spectra (rfft2), [n_filters x size x size/2+1].
+        These and the kernel norms are made once, and kept on self.device.
+        """
+        if not hasattr(self, 'kernel_tensors'):
+            self.kernel_tensors = dict()
+        if which_kernels in self.kernel_tensors.keys():
+            return self.kernel_tensors[which_kernels]
         
         if which_kernels=='curv':
             kernel_list = self.kernels['curv_freq']
@@ -300,43 +331,161 @@ class bent_gabor_feature_bank():
             kernel_list = self.kernels['rect_freq']
         elif which_kernels=='linear':
             kernel_list = self.kernels['lin_freq']
-        elif which_kernels=='all':
-            kernel_list = self.kernels['curv_freq']+self.kernels['rect_freq']+self.kernels['lin_freq']
         else:
-            raise ValueError('which_kernels must be one of [curv, rect, linear, all]')
-
-        # stack all the filters together, [self.kernel_size, self.kernel_size, n_filters]
-        # and send to specified device.
-        all_kernels = np.dstack(kernel_list)
-        all_kernels_tensor = torch.complex(torch.Tensor(np.real(all_kernels)), \
-                                           torch.Tensor(np.imag(all_kernels))).to(self.device)
-
+            raise ValueError('which_kernels must be one of [curv, rect, linear]')
+            
+        # [n_filters, self.kernel_size, self.kernel_size]
+        all_kernels = np.stack(kernel_list, axis=0)
+        
         # Compute power of each kernel, will use to normalize the convolution result.
-        all_kernels_power =  torch.sum(torch.sum(torch.pow(torch.abs(all_kernels_tensor), 2), \
-                                                 axis=0), axis=0)
-        all_kernels_power =  torch.sqrt(all_kernels_power)
-
-        # send image batch to device [self.image_size, self.image_size, n_images]
-        image_batch_tensor = torch.Tensor(image_batch).to(self.device)
-        # get frequency domain representation of images
-        image_batch_fft = torch.fft.fftn(image_batch_tensor, dim=(0,1))
-
-        # apply the filters by multiplying all at once
-        mult = image_batch_fft.view([self.image_size, self.image_size,1,-1]) * \
-                all_kernels_tensor.view([self.image_size, self.image_size,-1,1])
-        # back to spatial domain 
-        all_conved_images = torch.abs(torch.fft.ifftn(mult,dim=(0,1)))
-
-        # power correction
-        all_conved_images = torch.pow(all_conved_images,1/2) 
-        all_conved_images = all_conved_images/ \
-                    all_kernels_power.view([1,1,all_kernels_power.shape[0],1])
+        all_kernels_power = np.sqrt(np.sum(np.abs(all_kernels)**2, axis=(1,2)))
         
-        # shift back to original spatial configuration
-        all_conved_images = torch.fft.fftshift(all_conved_images, dim=(0,1))
-
-        if to_numpy:
-            all_conved_images = all_conved_images.detach().cpu().numpy()
+        filters = np.fft.ifft2(all_kernels, axes=(1,2))
+        kernels_real = np.fft.rfft2(np.real(filters), axes=(1,2))
+        kernels_imag = np.fft.rfft2(np.imag(filters), axes=(1,2))
+        
+        self.kernel_tensors[which_kernels] = \
+                {'real': torch.tensor(kernels_real, dtype=torch.complex64, device=self.device), \
+                 'imag': torch.tensor(kernels_imag, dtype=torch.complex64, device=self.device), \
+                 'power': torch.tensor(all_kernels_power, dtype=torch.float32, device=self.device)}
+        
+        return self.kernel_tensors[which_kernels]
+    
+    def __filter_chunks__(self, image_batch_fft, which_kernels, filter_batch_size):
+        
+        """
+        Apply one family of kernels to an image batch (already in frequency domain, 
+        from rfft2, [n_images x self.image_size x self.image_size/2+1]), a chunk of 
+        filters at a time. 
+        Yields (f0, f1, conved) where conved is the filtered images for filters f0:f1, 
+        [n_filters_batch x n_images x self.image_size x self.image_size]
+        (not yet shifted back to original spatial configuration).
+        """
+        
+        size = self.image_size
+        _kernels = self.__get_kernel_tensors__(which_kernels)
+        n_filters = _kernels['power'].shape[0]
+        
+        for f0 in range(0, n_filters, filter_batch_size):
+
+            f1 = np.min([f0+filter_batch_size, n_filters])
+
+            # apply the filters by multiplying all at once 
+            # (real and imaginary parts of filters separately)
+            conved_real = torch.fft.irfft2(image_batch_fft[None,:,:,:] * \
+                                           _kernels['real'][f0:f1,None,:,:], \
+                                           s=(size, size), dim=(2,3))
+            conved_imag = torch.fft.irfft2(image_batch_fft[None,:,:,:] * \
+                                           _kernels['imag'][f0:f1,None,:,:], \
+                                           s=(size, size), dim=(2,3))
+            # magnitude, then power correction
+            conved = torch.pow(conved_real**2 + conved_imag**2, 1/4)
+            conved_real = None; conved_imag = None
+            conved = conved / _kernels['power'][f0:f1,None,None,None]
+
+            yield f0, f1, conved
+    
+    def __get_image_batch_fft__(self, image_batch, max_elements):
+        
+        n_images = image_batch.shape[2]
+        
+        # send image batch to device, [n_images, self.image_size, self.image_size]
+        image_batch_tensor = torch.Tensor(np.moveaxis(image_batch, [0,1,2], [1,2,0])).to(self.device)
+        # get frequency domain representation of images 
+        image_batch_fft = torch.fft.rfft2(image_batch_tensor, dim=(1,2))
+        
+        filter_batch_size = int(np.max([1, max_elements // (n_images * self.image_size**2)]))
+        
+        return image_batch_fft, filter_batch_size
+        
+    def filter_image_batch_multi(self, image_batch, which_kernels=['curv','rect','linear'], \
+                                 to_numpy=True, max_elements=2**25):
+        
+        """
+        Filter a batch of images with one or more families of kernels, 
+        same result as filter_image_batch_pytorch for each family. 
+        The image fft is only done once for all the families, using rfft2 since images are real.
+        Filters are applied in chunks, so that the intermediate arrays have at most
+        max_elements elements.
+        image_batch is [self.image_size, self.image_size, n_images]
+        Returns a list with one [self.image_size, self.image_size, n_filters, n_images] 
+        array for each family in which_kernels.
+        """
+        
+        size = self.image_size
+        n_images = image_batch.shape[2]
+        
+        image_batch_fft, filter_batch_size = self.__get_image_batch_fft__(image_batch, max_elements)
+        
+        all_conved_images = []
+        
+        for kk in which_kernels:
+            
+            n_filters = self.__get_kernel_tensors__(kk)['power'].shape[0]
+            
+            conved_images = torch.zeros((size, size, n_filters, n_images), device=self.device)
+            
+            for f0, f1, conved in self.__filter_chunks__(image_batch_fft, kk, filter_batch_size):
+                
+                conved_images[:,:,f0:f1,:] = conved.permute(2,3,0,1)
+                
+            conved = None
+            
+            # shift back to original spatial configuration
+            conved_images = torch.fft.fftshift(conved_images, dim=(0,1))
+            
+            if to_numpy:
+                conved_images = conved_images.detach().cpu().numpy()
+                
+            all_conved_images += [conved_images]
             
         return all_conved_images
- 
\ No newline at end of file
+    
+    def filter_image_batch_reduce(self, image_batch, which_kernels=['curv','rect','linear'], \
+                                  to_numpy=True, max_elements=2**25):
+        
+        """
+        Filter a batch of images with one or more families of kernels, but only keep 
+        summary stats for each family: the max over filters at each pixel, and the mean 
+        over space for each filter. These are accumulated as each chunk of filters is done, 
+        so the full [size x size x n_filters x n_images] array is never made, and memory
+        doesn't depend on the number of filters.
+        image_batch is [self.image_size, self.image_size, n_images]
+        Returns a list with one dict for each family in which_kernels:
+            'max_over_filters': [self.image_size, self.image_size, n_images]
+            'mean_over_space': [n_filters, n_images]
+        """
+        
+        size = self.image_size
+        n_images = image_batch.shape[2]
+        
+        image_batch_fft, filter_batch_size = self.__get_image_batch_fft__(image_batch, max_elements)
+        
+        all_stats = []
+        
+        for kk in which_kernels:
+            
+            n_filters = self.__get_kernel_tensors__(kk)['power'].shape[0]
+            
+            # coefficients are all >=0, so zeros are a safe starting point for max.
+            max_over_filters = torch.zeros((n_images, size, size), device=self.device)
+            mean_over_space = torch.zeros((n_filters, n_images), device=self.device)
+            
+            for f0, f1, conved in self.__filter_chunks__(image_batch_fft, kk, filter_batch_size):
+                
+                max_over_filters = torch.maximum(max_over_filters, torch.max(conved, axis=0)[0])
+                mean_over_space[f0:f1,:] = torch.mean(conved, axis=(2,3))
+                
+            conved = None
+            
+            # shift back to original spatial configuration
+            max_over_filters = torch.fft.fftshift(max_over_filters.permute(1,2,0), dim=(0,1))
+            
+            if to_numpy:
+                max_over_filters = max_over_filters.detach().cpu().numpy()
+                mean_over_space = mean_over_space.detach().cpu().numpy()
+                
+            all_stats += [{'max_over_filters': max_over_filters, \
+                           'mean_over_space': mean_over_space}]
+            
+        return all_stats
@@ -15,7 +15,7 @@ def run_decoding(subject=999, \
                  which_prf_grid=1, debug=False, \
                  zscore_each=False, match_prf_trialcounts=True, \
                  categ_vs_none = False, \
-                 layer_name=None):
+                 layer_name=None, prf_batch_size=50):
   
     print('\nusing prf grid %d\n'%(which_prf_grid))
     # Params for the spatial aspect of the model (possible pRFs)
@@ -115,59 +115,74 @@ def run_decoding(subject=999, \
     
     n_trials_eachlabel = np.zeros((n_prfs, n_sem_axes), dtype=int)
     
-    # first looping over pRFs
-    for prf_model_index in range(n_prfs):
-
-        if not prfs_use[prf_model_index]:
-            continue
-            
-        if debug and prf_model_index>1:
-            continue
-
-        print('\nProcessing pRF %d of %d'%(prf_model_index, n_prfs))
-
-        features_in_prf, _ = feat_loader.load(image_inds, prf_model_index)
-       
-        print('Size of features array for this image set and prf is:')
-        print(features_in_prf.shape)
-        assert(not np.any(np.isnan(features_in_prf)))
-        # assert(not np.any(np.sum(features_in_prf, axis=0)==0))
-
-        # then looping over axes to decode
-        for aa in range(n_sem_axes):
-
-            if prf_model_index==0:
-                print('processing axis: %s'%discrim_type_list[aa])
-                print('labels: ')
-                print(unique_labels_each[aa])  
-            
-            labels = labels_all[:,aa,prf_model_index]
-            
-            # which trials to use here? evenly balanced for each label
-            inds2use = trial_masks[:,prf_model_index, aa]==1
-            
-            X = features_in_prf[inds2use,:]
-            y = labels[inds2use]
-            
-            # check the labels
-            assert(not np.any(np.isnan(y)))
-            un,n_each = np.unique(y, return_counts=True)
-            print('label counts:')
-            print(un, n_each)
-            assert(n_each[0]==n_each[1])
-            if match_prf_trialcounts:
-                print(n_each, n_each_first)
-                assert(np.all(n_each==n_each_first[aa]))
-            n_trials_eachlabel[prf_model_index, aa] = n_each[0]
-            
-            tst_acc, tst_dprime = stats_utils.decode_lda(X, y, n_crossval_folds=10, debug=debug)
+    prfs_do = np.array([mm for mm in range(n_prfs) if prfs_use[mm] and not (debug and mm>1)])
+    n_prf_batches = int(np.ceil(len(prfs_do)/prf_batch_size))
+    
+    # first looping over batches of pRFs
+    for bb in range(n_prf_batches):
+        
+        prf_batch_inds = prfs_do[bb*prf_batch_size:(bb+1)*prf_batch_size]
+        
+        # gather all the decoding problems for this batch (pRFs x axes), 
+        # then solve them all at once.
+        X_list = []; y_list = []; cv_labels_list = []; problem_inds = []
+        
+        for prf_model_index in prf_batch_inds:
+
+            print('\nProcessing pRF %d of %d'%(prf_model_index, n_prfs))
+
+            features_in_prf, _ = feat_loader.load(image_inds, prf_model_index)
+
+            print('Size of features array for this image set and prf is:')
+            print(features_in_prf.shape)
+            assert(not np.any(np.isnan(features_in_prf)))
+            # assert(not np.any(np.sum(features_in_prf, axis=0)==0))
+
+            # then looping over axes to decode
+            for aa in range(n_sem_axes):
+
+                if prf_model_index==0:
+                    print('processing axis: %s'%discrim_type_list[aa])
+                    print('labels: ')
+                    print(unique_labels_each[aa])  
+
+                labels = labels_all[:,aa,prf_model_index]
+
+                # which trials to use here? evenly balanced for each label
+                inds2use = trial_masks[:,prf_model_index, aa]==1
+
+                X = features_in_prf[inds2use,:]
+                y = labels[inds2use]
+
+                # check the labels
+                assert(not np.any(np.isnan(y)))
+                un,n_each = np.unique(y, return_counts=True)
+                print('label counts:')
+                print(un, n_each)
+                assert(n_each[0]==n_each[1])
+                if match_prf_trialcounts:
+                    print(n_each, n_each_first)
+                    assert(np.all(n_each==n_each_first[aa]))
+                n_trials_eachlabel[prf_model_index, aa] = n_each[0]
+
+                X_list += [X]
+                y_list += [y]
+                # cross-validation folds drawn in same order as calling decode_lda here
+                cv_labels_list += [stats_utils.get_cv_labels(len(y), n_crossval_folds=10)]
+                problem_inds += [(prf_model_index, aa)]
+                
+        tst_acc, tst_dprime = stats_utils.decode_lda_many(X_list, y_list, cv_labels_list, \
+                                                          n_crossval_folds=10, debug=debug)
+        
+        for ii, (prf_model_index, aa) in enumerate(problem_inds):
             
-            acc_each_prf[prf_model_index,aa] = tst_acc
-            dprime_each_prf[prf_model_index, aa] = tst_dprime
+            acc_each_prf[prf_model_index,aa] = tst_acc[ii]
+            dprime_each_prf[prf_model_index, aa] = tst_dprime[ii]
             
             # print to see how we are doing so far
-            print('decode %s, prf %d: acc=%.2f, dprime=%.2f'%(discrim_type_list[aa], prf_model_index, tst_acc, tst_dprime))
-            sys.stdout.flush()
+            print('decode %s, prf %d: acc=%.2f, dprime=%.2f'%(discrim_type_list[aa], prf_model_index, \
+                                                              tst_acc[ii], tst_dprime[ii]))
+        sys.stdout.flush()
 
 
     print('saving to %s'%fn2save)
@@ -197,6 +212,8 @@ if __name__ == '__main__':
                     help="use same number of trials for each pRF?")
     parser.add_argument("--categ_vs_none", type=int,default=1,
                     help="decode presence vs. absence of each category?")
+    parser.add_argument("--prf_batch_size", type=int,default=50,
+                    help="how many pRFs to decode at once?")
 
     args = parser.parse_args()
 
@@ -207,5 +224,5 @@ if __name__ == '__main__':
      
     run_decoding(subject=args.subject, feature_type=args.feature_type, debug=args.debug==1, \
                  which_prf_grid=args.which_prf_grid, match_prf_trialcounts=args.match_prf_trialcounts==1, \
-                 categ_vs_none=args.categ_vs_none==1)
+                 categ_vs_none=args.categ_vs_none==1, prf_batch_size=args.prf_batch_size)
     
\ No newline at end of file
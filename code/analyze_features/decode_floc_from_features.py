@@ -14,7 +14,7 @@ os.environ["HDF5_USE_FILE_LOCKING"] = "FALSE"
 def run_decoding(image_set='floc', 
                  feature_type='gabor_solo', \
                  which_prf_grid=1, debug=False, \
-                 layer_name=None):
+                 layer_name=None, prf_batch_size=50):
       
     models = initialize_fitting.get_prf_models(which_grid = which_prf_grid)    
     n_prfs = len(models)
@@ -78,74 +78,99 @@ def run_decoding(image_set='floc',
     pairwise_acc_each_prf = np.zeros((n_prfs, n_sem_axes, n_sem_axes), dtype=np.float32)
     pairwise_dprime_each_prf = np.zeros((n_prfs, n_sem_axes, n_sem_axes), dtype=np.float32)
     
-    # first looping over pRFs
-    for prf_model_index in range(n_prfs):
+    prfs_do = np.arange(n_prfs)
+    if debug:
+        prfs_do = prfs_do[0:2]
+    n_prf_batches = int(np.ceil(len(prfs_do)/prf_batch_size))
+    
+    image_inds = np.where(image_inds_use)[0]
+    
+    # first looping over batches of pRFs
+    for bb in range(n_prf_batches):
+        
+        prf_batch_inds = prfs_do[bb*prf_batch_size:(bb+1)*prf_batch_size]
+        
+        # gather all the decoding problems for this batch (pRFs x axes, and pairs of axes), 
+        # then solve them all at once.
+        X_list = []; y_list = []; cv_labels_list = []; problem_inds = []
+        
+        for prf_model_index in prf_batch_inds:
 
-        if debug and prf_model_index>1:
-            continue
+            print('\nProcessing pRF %d of %d'%(prf_model_index, n_prfs))
 
-        print('\nProcessing pRF %d of %d'%(prf_model_index, n_prfs))
+            print(len(image_inds))
+            features_in_prf, _ = feat_loader.load(image_inds, prf_model_index)
 
-        image_inds = np.where(image_inds_use)[0]
-        print(len(image_inds))
-        features_in_prf, _ = feat_loader.load(image_inds, prf_model_index)
-       
-        print('Size of features array for this image set and prf is:')
-        print(features_in_prf.shape)
-        assert(not np.any(np.isnan(features_in_prf)))
-        # assert(not np.any(np.sum(features_in_prf, axis=0)==0))
-
-        # then looping over axes to decode
-        for aa in range(n_sem_axes):
-
-            X = features_in_prf[downsample_inds[:,aa],:]
-            y = domain_labels[downsample_inds[:,aa],aa]
-            un, counts = np.unique(y, return_counts=True)
-            assert(counts[0]==counts[1]) # double check balancing
-            
-            if prf_model_index==0:
-                print('processing axis: %s'%discrim_type_list[aa])
-                print('labels: ')
-                print(np.unique(y))
-                print('size of X, y: %s, %s'%(X.shape, y.shape))
-            
-            tst_acc, tst_dprime = stats_utils.decode_lda(X, y, n_crossval_folds=10, debug=debug)
-            
-            acc_each_prf[prf_model_index,aa] = tst_acc
-            dprime_each_prf[prf_model_index, aa] = tst_dprime
-            
-            # print to see how we are doing so far
-            print('decode %s, prf %d: acc=%.2f, dprime=%.2f'%(discrim_type_list[aa], 
-                                                              prf_model_index, tst_acc, tst_dprime))
-            sys.stdout.flush()
-            
-            for aa2 in np.arange(aa+1, n_sem_axes):
-                
-                inds_use_pairwise = domain_labels[:,aa] | domain_labels[:,aa2]
-                X = features_in_prf[inds_use_pairwise==1,:]
-                y = domain_labels[inds_use_pairwise==1,aa]
-                y2 = domain_labels[inds_use_pairwise==1,aa2]
-                assert(np.all(y==(1-y2))) # should be opposites
+            print('Size of features array for this image set and prf is:')
+            print(features_in_prf.shape)
+            assert(not np.any(np.isnan(features_in_prf)))
+            # assert(not np.any(np.sum(features_in_prf, axis=0)==0))
+
+            # then looping over axes to decode
+            for aa in range(n_sem_axes):
+
+                X = features_in_prf[downsample_inds[:,aa],:]
+                y = domain_labels[downsample_inds[:,aa],aa]
                 un, counts = np.unique(y, return_counts=True)
                 assert(counts[0]==counts[1]) # double check balancing
-               
+
                 if prf_model_index==0:
-                    print('processing axis: %s vs %s'%(domains[aa], domains[aa2]))
+                    print('processing axis: %s'%discrim_type_list[aa])
                     print('labels: ')
                     print(np.unique(y))
                     print('size of X, y: %s, %s'%(X.shape, y.shape))
 
-                tst_acc, tst_dprime = stats_utils.decode_lda(X, y, n_crossval_folds=10, debug=debug)
+                X_list += [X]
+                y_list += [y]
+                # cross-validation folds drawn in same order as calling decode_lda here
+                cv_labels_list += [stats_utils.get_cv_labels(len(y), n_crossval_folds=10)]
+                problem_inds += [(prf_model_index, aa, None)]
+                
+                for aa2 in np.arange(aa+1, n_sem_axes):
+
+                    inds_use_pairwise = domain_labels[:,aa] | domain_labels[:,aa2]
+                    X = features_in_prf[inds_use_pairwise==1,:]
+                    y = domain_labels[inds_use_pairwise==1,aa]
+                    y2 = domain_labels[inds_use_pairwise==1,aa2]
+                    assert(np.all(y==(1-y2))) # should be opposites
+                    un, counts = np.unique(y, return_counts=True)
+                    assert(counts[0]==counts[1]) # double check balancing
+
+                    if prf_model_index==0:
+                        print('processing axis: %s vs %s'%(domains[aa], domains[aa2]))
+                        print('labels: ')
+                        print(np.unique(y))
+                        print('size of X, y: %s, %s'%(X.shape, y.shape))
+
+                    X_list += [X]
+                    y_list += [y]
+                    cv_labels_list += [stats_utils.get_cv_labels(len(y), n_crossval_folds=10)]
+                    problem_inds += [(prf_model_index, aa, aa2)]
+                    
+        tst_acc, tst_dprime = stats_utils.decode_lda_many(X_list, y_list, cv_labels_list, \
+                                                          n_crossval_folds=10, debug=debug)
+        
+        for ii, (prf_model_index, aa, aa2) in enumerate(problem_inds):
+            
+            if aa2 is None:
+                
+                acc_each_prf[prf_model_index,aa] = tst_acc[ii]
+                dprime_each_prf[prf_model_index, aa] = tst_dprime[ii]
 
-                pairwise_acc_each_prf[prf_model_index, aa,aa2] = tst_acc
-                pairwise_dprime_each_prf[prf_model_index, aa,aa2] = tst_dprime
-                pairwise_acc_each_prf[prf_model_index, aa2,aa] = tst_acc
-                pairwise_dprime_each_prf[prf_model_index, aa2,aa] = tst_dprime
+                # print to see how we are doing so far
+                print('decode %s, prf %d: acc=%.2f, dprime=%.2f'%(discrim_type_list[aa], 
+                                                                  prf_model_index, tst_acc[ii], tst_dprime[ii]))
+            else:
+                
+                pairwise_acc_each_prf[prf_model_index, aa,aa2] = tst_acc[ii]
+                pairwise_dprime_each_prf[prf_model_index, aa,aa2] = tst_dprime[ii]
+                pairwise_acc_each_prf[prf_model_index, aa2,aa] = tst_acc[ii]
+                pairwise_dprime_each_prf[prf_model_index, aa2,aa] = tst_dprime[ii]
 
                 # print to see how we are doing so far
                 print('decode %s vs %s, prf %d: acc=%.2f, dprime=%.2f'%(domains[aa], domains[aa2], 
-                                                                        prf_model_index, tst_acc, tst_dprime))
-                sys.stdout.flush()
+                                                                        prf_model_index, tst_acc[ii], tst_dprime[ii]))
+        sys.stdout.flush()
 
 
     print('saving to %s'%fn2save)
@@ -169,6 +194,8 @@ if __name__ == '__main__':
                     help="want to run a fast test version of this script to debug? 1 for yes, 0 for no")
     parser.add_argument("--which_prf_grid", type=int,default=1,
                     help="which prf grid to use")
+    parser.add_argument("--prf_batch_size", type=int,default=50,
+                    help="how many pRFs to decode at once?")
     
     args = parser.parse_args()
 
@@ -178,5 +205,5 @@ if __name__ == '__main__':
     sys.stdout.flush()
      
     run_decoding(image_set=args.image_set, feature_type=args.feature_type, debug=args.debug==1, \
-                  which_prf_grid=args.which_prf_grid)
+                  which_prf_grid=args.which_prf_grid, prf_batch_size=args.prf_batch_size)
     
\ No newline at end of file
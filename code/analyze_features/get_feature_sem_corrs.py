@@ -145,12 +145,11 @@ def get_feature_corrs(subject, feature_type, which_prf_grid=1, layer_name=None):
             
             if np.all(np.isin(unique_labels_each[aa], unique_labels_actual)):
             
-                for ff in range(n_features):
-                
-                    partial_corr = stats_utils.compute_partial_corr(x=labels_main_axis[inds2use], \
-                                                                y=features_in_prf[inds2use,ff], \
-                                                                c=labels_other_axes[inds2use,:])
-                    all_partial_corrs[ff,prf_model_index,aa] = partial_corr
+                # all features at once, since the covariates are the same
+                partial_corr = stats_utils.compute_partial_corr(x=labels_main_axis[inds2use], \
+                                                            y=features_in_prf[inds2use,:], \
+                                                            c=labels_other_axes[inds2use,:])
+                all_partial_corrs[:,prf_model_index,aa] = partial_corr
                 
                 for ui, uu in enumerate(unique_labels_actual):
                     n_samp_each_axis_partial[prf_model_index,aa,ui] = np.sum(labels_main_axis[inds2use]==uu)
@@ -7,6 +7,7 @@ def get_feature_tuning(best_prf_inds, features_each_prf, val_voxel_data_pred, \
     """
     Get an approximate measure of voxels' tuning for particular features, based on how correlated 
     the predicted responses of the encoding model are with the activation in each feature channel.
+    Voxels that share a best pRF are done together, as one matrix multiplication.
     """
     
     n_trials = val_voxel_data_pred.shape[0]
@@ -14,32 +15,38 @@ def get_feature_tuning(best_prf_inds, features_each_prf, val_voxel_data_pred, \
     n_features = features_each_prf.shape[1]
     corr_each_feature = np.zeros((n_voxels, n_features))
    
-    for vv in range(n_voxels):
+    voxels_to_do = np.arange(n_voxels)
+    if debug:
+        voxels_to_do = voxels_to_do[0:2]
+    best_prf_each_voxel = best_prf_inds[voxels_to_do,0]
+    
+    # voxels with the same best pRF have the same features, so do them all at once.
+    for mm in np.unique(best_prf_each_voxel):
         
-        if debug and (vv>1):
-            continue
-        print('computing feature tuning for voxel %d of %d, prf %d\n'%(vv, n_voxels, best_prf_inds[vv,0]))
+        voxel_inds = voxels_to_do[best_prf_each_voxel==mm]
+        print('computing feature tuning for %d voxels with prf %d\n'%(len(voxel_inds), mm))
            
-        # voxel's predicted response to validation set trials, based on encoding model.
-        resp = val_voxel_data_pred[:,vv,0]
-        # activation in the feature of interest on each trial.
-        feat_act = features_each_prf[:,:,best_prf_inds[vv,0]]
+        # voxels' predicted response to validation set trials, based on encoding model.
+        resp = val_voxel_data_pred[:,voxel_inds,0]
+        # activation in each feature on each trial.
+        feat_act = features_each_prf[:,:,mm]
         
         if trials_use_each_prf is not None:
             # select subset of trials to work with
-            trials_use = trials_use_each_prf[:,best_prf_inds[vv,0]]
+            trials_use = trials_use_each_prf[:,mm]
             resp = resp[trials_use]
             feat_act = feat_act[trials_use]
             if np.sum(trials_use)==0:
-                print('voxel %d: no trials are included here, skipping it'%vv)
-                corr_each_feature[vv,:] = np.nan
+                print('prf %d: no trials are included here, skipping %d voxels'%(mm, len(voxel_inds)))
+                corr_each_feature[voxel_inds,:] = np.nan
                 continue
         
-        for ff in range(n_features):
-            if np.var(feat_act[:,ff])>0:
-                corr_each_feature[vv,ff] = stats_utils.numpy_corrcoef_warn(resp, feat_act[:,ff])[0,1]
-            else:
-                corr_each_feature[vv,ff] = np.nan
+        # corr is [n_voxels x n_features]
+        corr = stats_utils.get_corrcoef_all_pairs(resp, feat_act)
+        features_with_var = np.var(feat_act, axis=0)>0
+        if np.any(np.isnan(corr[:,features_with_var])):
+            print('There are nans in correlation coefficient')
+        corr[:,~features_with_var] = np.nan
+        corr_each_feature[voxel_inds,:] = corr
                 
     return corr_each_feature
-
@@ -7,6 +7,7 @@ def get_semantic_discrim(best_prf_inds, labels_all, unique_labels_each, val_voxe
     """
     Measure how well voxels' predicted responses distinguish between image patches with 
     different semantic content.
+    Voxels that share a best pRF are done together (each statistic computed for all of them at once).
     """
     
     n_voxels = val_voxel_data_pred.shape[1]
@@ -19,30 +20,36 @@ def get_semantic_discrim(best_prf_inds, labels_all, unique_labels_each, val_voxe
     n_samp_each_axis = np.zeros((n_voxels, n_sem_axes, max_categ),dtype=np.float32)
     mean_each_sem_level = np.zeros((n_voxels, n_sem_axes, max_categ),dtype=np.float32)
  
-    for vv in range(n_voxels):
+    voxels_to_do = np.arange(n_voxels)
+    if debug:
+        voxels_to_do = voxels_to_do[0:2]
+    best_prf_each_voxel = best_prf_inds[voxels_to_do,0]
+    
+    # voxels with the same best pRF have the same labels, so do them all at once.
+    for mm in np.unique(best_prf_each_voxel):
         
-        if debug and (vv>1):
-            continue
-        print('computing semantic discriminability for voxel %d of %d, prf %d\n'%(vv, n_voxels, best_prf_inds[vv,0]))
+        voxel_inds = voxels_to_do[best_prf_each_voxel==mm]
+        print('computing semantic discriminability for %d voxels with prf %d\n'%(len(voxel_inds), mm))
         
-        resp = val_voxel_data_pred[:,vv,0]
+        # resp is [n_voxels x n_trials]
+        resp = val_voxel_data_pred[:,voxel_inds,0].T
         
         if trials_use_each_prf is not None:
             # select subset of trials to work with
-            trials_use = trials_use_each_prf[:,best_prf_inds[vv,0]]
-            resp = resp[trials_use]
+            trials_use = trials_use_each_prf[:,mm]
+            resp = resp[:,trials_use]
             labels_use = labels_all[trials_use,:,:]
             if np.sum(trials_use)==0:
-                print('voxel %d: no trials are included here, skipping it'%vv)
-                sem_discrim_each_axis[vv,:] = np.nan
-                sem_corr_each_axis[vv,:] = np.nan
+                print('prf %d: no trials are included here, skipping %d voxels'%(mm, len(voxel_inds)))
+                sem_discrim_each_axis[voxel_inds,:] = np.nan
+                sem_corr_each_axis[voxel_inds,:] = np.nan
                 continue
         else:
             labels_use = labels_all
        
         for aa in range(n_sem_axes):
             
-            labels = labels_use[:,aa,best_prf_inds[vv,0]]
+            labels = labels_use[:,aa,mm]
             
             inds2use = ~np.isnan(labels)
             
@@ -51,31 +58,32 @@ def get_semantic_discrim(best_prf_inds, labels_all, unique_labels_each, val_voxe
             if np.all(np.isin(unique_labels_each[aa], unique_labels_actual)):
                 
                 # separate trials into those with the different labels for this semantic axis.
+                # each group is [n_voxels x n_trials_in_group]
                 group_inds = [(labels==ll) & inds2use for ll in unique_labels_actual]
-                groups = [resp[gi] for gi in group_inds]
+                groups = [resp[:,gi] for gi in group_inds]
                 
                 if len(unique_labels_actual)==2:
                     # use t-statistic as a measure of discriminability
                     # larger pos value means resp[label==1] > resp[label==0]
-                    sem_discrim_each_axis[vv,aa] = stats_utils.ttest_warn(groups[1], groups[0]).statistic
+                    sem_discrim_each_axis[voxel_inds,aa] = stats_utils.ttest_warn_rows(groups[1], groups[0]).statistic
                 else:
                     # if more than 2 classes, computing an F statistic 
-                    sem_discrim_each_axis[vv,aa] = stats_utils.anova_oneway_warn(groups).statistic
+                    sem_discrim_each_axis[voxel_inds,aa] = stats_utils.anova_oneway_warn_rows(groups).statistic
                 # also computing a correlation coefficient between semantic label/voxel response
                 # sign is consistent with t-statistic
-                sem_corr_each_axis[vv,aa] = stats_utils.numpy_corrcoef_warn(\
-                                        resp[inds2use],labels[inds2use])[0,1]
+                sem_corr_each_axis[voxel_inds,aa] = stats_utils.get_corrcoef_rows(\
+                                        resp[:,inds2use],labels[inds2use])
                 for gi, gg in enumerate(groups):
-                    n_samp_each_axis[vv,aa,gi] = len(gg)
+                    n_samp_each_axis[voxel_inds,aa,gi] = gg.shape[1]
                     # mean within each label group 
-                    mean_each_sem_level[vv,aa,gi] = np.mean(gg)
+                    mean_each_sem_level[voxel_inds,aa,gi] = np.mean(gg, axis=1)
             else:                
-                # at least one category is missing for this voxel's pRF and this semantic axis.
+                # at least one category is missing for this pRF and this semantic axis.
                 # skip it and put nans in the arrays.               
-                sem_discrim_each_axis[vv,aa] = np.nan
-                sem_corr_each_axis[vv,aa] = np.nan
-                n_samp_each_axis[vv,aa,:] = np.nan
-                mean_each_sem_level[vv,aa,:] = np.nan
+                sem_discrim_each_axis[voxel_inds,aa] = np.nan
+                sem_corr_each_axis[voxel_inds,aa] = np.nan
+                n_samp_each_axis[voxel_inds,aa,:] = np.nan
+                mean_each_sem_level[voxel_inds,aa,:] = np.nan
                 
     return sem_discrim_each_axis, sem_corr_each_axis, n_samp_each_axis, mean_each_sem_level
 
@@ -100,27 +108,34 @@ def get_semantic_partial_corrs(best_prf_inds, labels_all, axes_to_do, \
     max_categ = np.max([len(unique_labels_each[aa]) for aa in axes_to_do])
     n_samp_each_axis = np.zeros((n_voxels, n_sem_axes, max_categ),dtype=np.float32)
    
-    for vv in range(n_voxels):
+    voxels_to_do = np.arange(n_voxels)
+    if debug:
+        voxels_to_do = voxels_to_do[0:2]
+    best_prf_each_voxel = best_prf_inds[voxels_to_do,0]
+    
+    # the covariates only depend on the pRF, so all voxels with the same best pRF
+    # are regressed together.
+    for mm in np.unique(best_prf_each_voxel):
         
-        if debug and (vv>1):
-            continue
-        print('computing partial correlations for voxel %d of %d, prf %d\n'%(vv, n_voxels, best_prf_inds[vv,0]))
+        voxel_inds = voxels_to_do[best_prf_each_voxel==mm]
+        print('computing partial correlations for %d voxels with prf %d\n'%(len(voxel_inds), mm))
         
-        resp = val_voxel_data_pred[:,vv,0]
+        # resp is [n_trials x n_voxels]
+        resp = val_voxel_data_pred[:,voxel_inds,0]
         
         if trials_use_each_prf is not None:
             # select subset of trials to work with
-            trials_use = trials_use_each_prf[:,best_prf_inds[vv,0]]
-            resp = resp[trials_use]
+            trials_use = trials_use_each_prf[:,mm]
+            resp = resp[trials_use,:]
             labels_use = labels_all[trials_use,:,:]
             if np.sum(trials_use)==0:
-                print('voxel %d: no trials are included here, skipping it'%vv)
-                partial_corr_each_axis[vv,:] = np.nan
+                print('prf %d: no trials are included here, skipping %d voxels'%(mm, len(voxel_inds)))
+                partial_corr_each_axis[voxel_inds,:] = np.nan
                 continue
         else:
             labels_use = labels_all
         
-        inds2use = (np.sum(np.isnan(labels_use[:,:,best_prf_inds[vv,0]]), axis=1)==0)
+        inds2use = (np.sum(np.isnan(labels_use[:,:,mm]), axis=1)==0)
         
         for aa in range(n_sem_axes):
             
@@ -128,26 +143,27 @@ def get_semantic_partial_corrs(best_prf_inds, labels_all, axes_to_do, \
             
             # going to compute information about the current axis of interest, while
             # partialling out the other axes. 
-            labels_main_axis = labels_use[:,aa,best_prf_inds[vv,0]]
-            labels_other_axes = labels_use[:,other_axes,best_prf_inds[vv,0]]
+            labels_main_axis = labels_use[:,aa,mm]
+            labels_other_axes = labels_use[:,other_axes,mm]
 
             unique_labels_actual = np.unique(labels_main_axis[inds2use])
             
             if np.all(np.isin(unique_labels_each[aa], unique_labels_actual)):
                 
+                # [n_trials x n_voxels] y, so one regression for all voxels
                 partial_corr = stats_utils.compute_partial_corr(x=labels_main_axis[inds2use], \
-                                                                y=resp[inds2use], \
+                                                                y=resp[inds2use,:], \
                                                                 c=labels_other_axes[inds2use,:])
-                partial_corr_each_axis[vv,aa] = partial_corr
+                partial_corr_each_axis[voxel_inds,aa] = partial_corr
                 
                 for ui, uu in enumerate(unique_labels_actual):
-                    n_samp_each_axis[vv,aa,ui] = np.sum(labels_main_axis[inds2use]==uu)
+                    n_samp_each_axis[voxel_inds,aa,ui] = np.sum(labels_main_axis[inds2use]==uu)
                     
             else:                
-                # at least one category is missing for this voxel's pRF and this semantic axis.
+                # at least one category is missing for this pRF and this semantic axis.
                 # skip it and put nans in the arrays.               
-                partial_corr_each_axis[vv,aa] = np.nan
-                n_samp_each_axis[vv,aa,:] = np.nan
+                partial_corr_each_axis[voxel_inds,aa] = np.nan
+                n_samp_each_axis[voxel_inds,aa,:] = np.nan
                
     return partial_corr_each_axis, n_samp_each_axis
 
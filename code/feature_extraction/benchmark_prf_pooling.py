@@ -0,0 +1,102 @@
+import sys, os
+import numpy as np
+import time
+import torch
+import argparse
+
+# import custom modules
+code_dir = '/'.join(os.path.dirname(os.path.abspath(__file__)).split('/')[0:-1])
+sys.path.append(code_dir)
+from utils import prf_utils, torch_utils
+from feature_extraction import prf_pooling
+
+"""
+Micro-benchmark for pRF pooling of feature maps (as in the CNN feature extractors).
+Compares the old approach (make each pRF, multiply the full maps by it, then average, one pRF
+at a time) to prf_pooling.prf_pooler, with the separable and dense engines.
+"""
+
+def pool_old(maps, prf_models, aperture=1.0, device=None):
+
+    n_images, n_features, n_pix = maps.shape[0:3]
+    n_prfs = prf_models.shape[0]
+    features = torch.zeros((n_images, n_features, n_prfs), device=device)
+    maps_full_field = torch.moveaxis(maps, [0,1,2,3], [0,3,1,2])
+
+    for mm in range(n_prfs):
+        x,y,sigma = prf_models[mm,:]
+        prf = torch_utils._to_torch(prf_utils.gauss_2d(center=[x,y], sd=sigma, \
+                               patch_size=n_pix, aperture=aperture, dtype=np.float32), device=device)
+        minval = torch.min(prf)
+        maxval = torch.max(prf-minval)
+        prf_scaled = (prf - minval)/maxval
+        features[:,:,mm] = torch.mean(maps_full_field * prf_scaled.view([1,n_pix,n_pix,1]), dim=(1,2))
+
+    return features
+
+def run_benchmark(which_prf_grid=5, n_images=50, n_features=64, n_pix=27, \
+                  n_reps=3, max_elements=2**26, device='cpu:0'):
+
+    device = torch.device(device)
+
+    prf_models = prf_utils.get_prf_models(which_grid=which_prf_grid)
+    n_prfs = prf_models.shape[0]
+    maps = torch.rand((n_images, n_features, n_pix, n_pix), device=device)
+
+    print('grid %d (%d pRFs), maps size %s'%(which_prf_grid, n_prfs, str(tuple(maps.shape))))
+
+    features_old = pool_old(maps, prf_models, device=device)
+    poolers = dict()
+    for engine in ['separable', 'dense', 'auto']:
+        poolers[engine] = prf_pooling.prf_pooler(prf_models, n_pix, aperture=1.0, prf_scaling='max', \
+                                                 engine=engine, max_elements=max_elements, device=device)
+        features_new = poolers[engine](maps)
+        print('%s (uses %s): max abs difference %.3e'%(engine, poolers[engine].engine, \
+                                            torch.max(torch.abs(features_new - features_old))))
+    print('unique x profiles: %d'%len(poolers['separable'].prfs_each_x))
+
+    fns = [('old (one pRF at a time)', lambda: pool_old(maps, prf_models, device=device))]
+    fns += [('pooler, %s'%engine, lambda engine=engine: poolers[engine](maps)) \
+            for engine in ['separable', 'dense']]
+
+    for name, pool_fn in fns:
+        times = np.zeros((n_reps,))
+        for rr in range(n_reps):
+            if device.type=='cuda':
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            t = time.time()
+            features = pool_fn()
+            if device.type=='cuda':
+                torch.cuda.synchronize()
+            times[rr] = time.time() - t
+        if device.type=='cuda':
+            print('%s: %.5f sec (min %.5f sec) over %d reps, peak memory %.1f MB'\
+                  %(name, np.mean(times), np.min(times), n_reps, torch.cuda.max_memory_allocated()/1024**2))
+        else:
+            print('%s: %.5f sec (min %.5f sec) over %d reps'%(name, np.mean(times), np.min(times), n_reps))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--which_prf_grid", type=int, default=5,
+                    help="which version of prf grid to use")
+    parser.add_argument("--n_images", type=int, default=50,
+                    help="images per batch")
+    parser.add_argument("--n_features", type=int, default=64,
+                    help="number of feature maps (channels)")
+    parser.add_argument("--n_pix", type=int, default=27,
+                    help="resolution of feature maps")
+    parser.add_argument("--n_reps", type=int, default=3,
+                    help="how many times to repeat each timing")
+    parser.add_argument("--max_elements", type=int, default=2**26,
+                    help="limit on size of intermediate arrays in the pooler")
+    parser.add_argument("--device", type=str, default='cpu:0',
+                    help="device to run on")
+
+    args = parser.parse_args()
+
+    run_benchmark(which_prf_grid=args.which_prf_grid, n_images=args.n_images, n_features=args.n_features, \
+                  n_pix=args.n_pix, n_reps=args.n_reps, max_elements=args.max_elements, device=args.device)
@@ -13,6 +13,7 @@ import torch.nn as nn
 #import custom modules
 from utils import prf_utils, torch_utils, texture_utils, default_paths, nsd_utils, floc_utils
 from model_fitting import initialize_fitting
+from feature_extraction import prf_pooling
 
 dtype=np.float32
 
@@ -44,6 +45,7 @@ def extract_features(image_data, layer_inds,\
                           which_prf_grid=5,\
                           batch_size=50, \
                           blurface=False, \
+                          channels_last=False, \
                           debug=False):
 
     """
@@ -59,11 +61,6 @@ def extract_features(image_data, layer_inds,\
     # Params for the spatial aspect of the model (possible pRFs)
     prf_models = initialize_fitting.get_prf_models(which_grid=which_prf_grid)    
 
-    # Fix these params
-    n_prf_sd_out = 2
-    mult_patch_by_prf = True
-    do_avg_pool = True
-    
     n_layers = len(layer_inds)
 
     n_prfs = len(prf_models)
@@ -71,6 +68,17 @@ def extract_features(image_data, layer_inds,\
 
     n_batches = int(np.ceil(n_images/batch_size))
 
+    # pRF pooling modules, one for each layer.
+    # these get made once we know what the resolutions are (first batch).
+    _prf_poolers = dict()
+    flat_prfs = prf_models[:,2]==10
+
+    # model and hooks are set up once here, then used for every batch.
+    extractor = alexnet_extractor(layer_inds, device=device, \
+                                  padding_mode=padding_mode, \
+                                  blurface=blurface, \
+                                  channels_last=channels_last)
+    
     with torch.no_grad():
 
         for bb in range(n_batches):
@@ -88,75 +96,55 @@ def extract_features(image_data, layer_inds,\
             gc.collect()
             torch.cuda.empty_cache()
             
-            activ_batch = get_alexnet_activations_batch(image_batch, layer_inds, \
-                                                        device=device, \
-                                                        padding_mode=padding_mode, \
-                                                        blurface=blurface)
+            activ_batch = extractor(image_batch)
 
             for ll in range(n_layers):
 
                 print('Getting prf-specific activations for layer %s'%alexnet_layer_names[layer_inds[ll]])
 
-                maps_full_field = torch.moveaxis(activ_batch[ll], [0,1,2,3], [0,3,1,2])
-
-                for mm in range(n_prfs):
-
-                    if debug and mm>1:
-                        continue
-
-                    prf_params = prf_models[mm,:]
-                    x,y,sigma = prf_params
-                    print('Getting features for pRF [x,y,sigma]:')
-                    print([x,y,sigma])
-                    n_pix = maps_full_field.shape[1]
-
-                    # Define the RF for this "model" version
-                    prf = torch_utils._to_torch(prf_utils.gauss_2d(center=[x,y], sd=sigma, \
-                               patch_size=n_pix, aperture=1.0, dtype=np.float32), device=device)
-                    minval = torch.min(prf)
-                    maxval = torch.max(prf-minval)
-                    prf_scaled = (prf - minval)/maxval
-
-                    if sigma==10:
-                        # creating a "flat" pRF here which will average across entire feature map.
-                        prf_scaled = torch.ones(prf_scaled.shape)
-                        prf_scaled = prf_scaled/torch.sum(prf_scaled)
-                        prf_scaled = prf_scaled.to(device)
-
-                    if mult_patch_by_prf:
-                        # This effectively restricts the spatial location, so no need to crop
-                        maps = maps_full_field * prf_scaled.view([1,n_pix, n_pix,1])
-                    else:
-                        # This is a coarser way of choosing which spatial region to look at
-                        # Crop the patch +/- n SD away from center
-                        bbox = texture_utils.get_bbox_from_prf(prf_params, prf.shape, n_prf_sd_out, \
-                                                       min_pix=None, verbose=False, force_square=False)
-                        print('bbox to crop is:')
-                        print(bbox)
-                        maps = maps_full_field[:,bbox[0]:bbox[1], bbox[2]:bbox[3],:]
-
-                    if do_avg_pool:
-                        features_batch = torch.mean(maps, dim=(1,2))
-                    else:
-                        features_batch = torch.max(maps, dim=(1,2))
-
-                    print('model %d, min/max of features in batch: [%s, %s]'%(mm, \
-                                                  torch.min(features_batch), torch.max(features_batch))) 
-
-                    features_each_prf[ll][batch_inds,:,mm] = torch_utils.get_value(features_batch)
+                # maps are [n_images x n_features x n_pix x n_pix]
+                n_pix = activ_batch[ll].shape[2]
+                if ll not in _prf_poolers.keys():
+                    # each pRF is scaled to [0,1], then pRF-weighted maps are averaged over space
+                    _prf_poolers[ll] = prf_pooling.prf_pooler(prf_models, n_pix, \
+                                                              aperture=1.0, prf_scaling='max', \
+                                                              device=device)
+
+                # features_batch is [n_images x n_features x n_prfs]
+                features_batch = _prf_poolers[ll](activ_batch[ll])
+
+                if np.any(flat_prfs):
+                    # "flat" pRFs (sigma=10), these are weighted by a map of 1/n_pix**2
+                    # at each pixel, then averaged across the entire feature map.
+                    features_batch[:,:,flat_prfs] = torch.mean(activ_batch[ll], dim=(2,3))[:,:,None] / n_pix**2
+
+                print('min/max of features in batch: [%s, %s]'%(torch.min(features_batch), \
+                                                                torch.max(features_batch))) 
+
+                features_each_prf[ll][batch_inds,:,:] = torch_utils.get_value(features_batch)
 
+    extractor.remove_hooks()
+    
     return features_each_prf
     
 
-def get_alexnet_activations_batch(image_batch, layer_inds, device=None, padding_mode=None, blurface=False):
+# models that have been loaded already, so they only get loaded once per run.
+# keys are (blurface, padding_mode, channels_last, device)
+_alexnet_model_cache = dict()
+
+def get_alexnet_model(device=None, padding_mode=None, blurface=False, channels_last=False):
 
     """
-    Get activations for images in NSD, passed through pretrained AlexNet.
-    Specify which NSD images to look at, and which layers to return.
+    Load pretrained AlexNet (or get it from the cache if it was already loaded).
+    Returns model in eval mode, with padding mode and memory format changed if specified.
     """
-
+    
     if device is None:
         device = torch.device('cpu:0')
+        
+    key = (blurface, padding_mode, channels_last, str(device))
+    if key in _alexnet_model_cache.keys():
+        return _alexnet_model_cache[key]
        
     if blurface:
         # use model trained on face-blurred imagenet ims
@@ -193,54 +181,110 @@ def get_alexnet_activations_batch(image_batch, layer_inds, device=None, padding_
                 print('changing padding mode to %s'%padding_mode)
                 print(ff)
                 
-                
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+        
     model.eval()
     
-    is_fc = [('FC' in alexnet_layer_names[ll] or 'fc' in alexnet_layer_names[ll]) for ll in layer_inds]
+    _alexnet_model_cache[key] = model
     
-    if len(layer_inds)==0:
-        raise ValueError('your layer names do not match any of those specified in alexnet_features.py')
+    return model
+
 
+class alexnet_extractor():
+    
+    """
+    Holds a prepared AlexNet (pretrained weights, padding mode, eval mode) with forward 
+    hooks on the layers of interest, so it can be used for many batches of images 
+    without setting up the model each time.
+    Input parameters:
+        layer_inds     ~ indices into alexnet_layer_names, which layers to return
+        device         ~ device to run the model on
+        padding_mode   ~ padding mode for the conv layers (None to leave as default)
+        blurface       ~ use model trained on face-blurred images?
+        channels_last  ~ put model and images in channels-last memory format, 
+                         which is often faster for convolutions on cpu.
+    Calling it on a batch of images returns a list of activations, one for each layer.
+    Call remove_hooks() when done, because the model is shared through the cache.
+    """
     
-    # first making this subfunction that is needed to get the activation on a forward pass
-    def get_activ_fwd_hook(ii,ll):
-        def hook(self, input, output):            
-            print('hook for %s'%alexnet_layer_names[ll])           
-            activ[ii] = output
-            print(output.shape)
+    def __init__(self, layer_inds, device=None, padding_mode=None, blurface=False, channels_last=False):
+        
+        if len(layer_inds)==0:
+            raise ValueError('your layer names do not match any of those specified in alexnet_features.py')
+            
+        self.layer_inds = layer_inds
+        self.device = device if device is not None else torch.device('cpu:0')
+        self.channels_last = channels_last
+        
+        self.model = get_alexnet_model(self.device, padding_mode=padding_mode, \
+                                       blurface=blurface, channels_last=channels_last)
+            
+        is_fc = [('FC' in alexnet_layer_names[ll] or 'fc' in alexnet_layer_names[ll]) for ll in layer_inds]
+        
+        self.activ = [[] for ll in layer_inds]
+        self.hooks = [[] for ll in layer_inds]
+        
+        # adding this "hook" to the module corresponding to each layer, so we'll save activations at each layer
+        # this only modifies the "graph" e.g. what the model code does when run, but doesn't actually run it yet.
+        for ii, ll in enumerate(layer_inds):
+            if not is_fc[ii]:
+                h = self.model.features[ll].register_forward_hook(self.__get_activ_fwd_hook__(ii))
+            else:
+                h = self.model.classifier[ll-n_feature_layers].register_forward_hook(self.__get_activ_fwd_hook__(ii))
+            self.hooks[ii] = h
+            
+    def __get_activ_fwd_hook__(self, ii):
+        
+        # subfunction that is needed to get the activation on a forward pass
+        def hook(module, input, output):            
+            self.activ[ii] = output
         return hook
-   
-    # get image and labels for this batch
-    # image_tensors is [batch_size x 3 x 224 x 224]
-    image_tensors =  torch_utils._to_torch(image_batch, device=device).float()
-    activ = [[] for ll in layer_inds]
-    hook = [[] for ll in layer_inds]
     
-    model.eval()
+    def __call__(self, image_batch):
+        
+        # image_tensors is [batch_size x 3 x n_pix x n_pix]
+        image_tensors =  torch_utils._to_torch(image_batch, device=self.device).float()
+        if self.channels_last:
+            image_tensors = image_tensors.contiguous(memory_format=torch.channels_last)
+            
+        self.activ = [[] for ll in self.layer_inds]
+        
+        # do the forward pass of model, which now includes the forward hooks
+        # now the "activ" variable will get modified, because it gets altered during the hook function
+        with torch.inference_mode():
+            self.model(image_tensors)
+        
+        activ = self.activ
+        self.activ = [[] for ll in self.layer_inds]
+        
+        return activ
+    
+    def remove_hooks(self):
+        
+        for h in self.hooks:
+            h.remove()
+        self.hooks = []
+        
 
-    # adding this "hook" to the module corresponding to each layer, so we'll save activations at each layer
-    # this only modifies the "graph" e.g. what the model code does when run, but doesn't actually run it yet.
-    for ii, ll in enumerate(layer_inds):
-        if not is_fc[ii]:
-            h = model.features[ll].register_forward_hook(get_activ_fwd_hook(ii,ll))
-        else:
-            h = model.classifier[ll-n_feature_layers].register_forward_hook(get_activ_fwd_hook(ii,ll))
-        hook[ii] = h
-
-    # do the forward pass of model, which now includes the forward hooks
-    # now the "activ" variable will get modified, because it gets altered during the hook function
-    model(image_tensors)
+def get_alexnet_activations_batch(image_batch, layer_inds, device=None, padding_mode=None, blurface=False):
+
+    """
+    Get activations for images in NSD, passed through pretrained AlexNet.
+    Specify which NSD images to look at, and which layers to return.
+    (for many batches, better to make one alexnet_extractor and re-use it)
+    """
+
+    extractor = alexnet_extractor(layer_inds, device=device, padding_mode=padding_mode, blurface=blurface)
+    activ = extractor(image_batch)
+    extractor.remove_hooks()
     
-    # Now remove all the hooks
     for ii, ll in enumerate(layer_inds):
-        print(activ[ii].shape)
-        hook[ii].remove
+        print('%s: %s'%(alexnet_layer_names[ll], activ[ii].shape))
 
     return activ
 
 
-
-
 def proc_one_subject(subject, args):
 
     if args.blurface==1:
@@ -276,6 +320,7 @@ def proc_one_subject(subject, args):
                                          which_prf_grid=args.which_prf_grid, \
                                          batch_size=args.batch_size,
                                          blurface=args.blurface==1, 
+                                         channels_last=args.channels_last==1, \
                                          debug=args.debug)
     
     # Now save the results, one file for each alexnet layer 
@@ -320,6 +365,7 @@ def proc_other_image_set(image_set, args):
                                          which_prf_grid=args.which_prf_grid, \
                                          batch_size=args.batch_size,
                                          blurface=args.blurface==1, 
+                                         channels_last=args.channels_last==1, \
                                          debug=args.debug)
     
     # Now save the results, one file for each alexnet layer 
@@ -371,6 +417,8 @@ if __name__ == '__main__':
                     help="padding mode for alexnet convolutional layers")
     parser.add_argument("--blurface", type=int, default=0, 
                     help="use model trained with faces blurred? 1 for yes, 0 for no")
+    parser.add_argument("--channels_last", type=int, default=0, 
+                    help="use channels-last memory format (can be faster on cpu)? 1 for yes, 0 for no")
     
     args = parser.parse_args()
     
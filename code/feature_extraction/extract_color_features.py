@@ -8,6 +8,7 @@ import torch
 #import custom modules
 from utils import color_utils, nsd_utils, prf_utils, default_paths, floc_utils, torch_utils
 from model_fitting import initialize_fitting
+from feature_extraction import prf_pooling
 
 try:
     device = initialize_fitting.init_cuda()
@@ -32,6 +33,9 @@ def extract_color_features(image_data, batch_size=100, \
     
     features_each_prf = np.zeros((n_images, n_features, n_prfs), dtype=np.float32)
 
+    # each pRF sums to 1, so this gives the pRF-weighted sum of each map.
+    _prf_pooler = prf_pooling.prf_pooler(models, n_pix, aperture=1.0, prf_scaling='sum', device=device)
+    
     for bb in range(n_batches):
         
         if debug and bb>1:
@@ -67,18 +71,11 @@ def extract_color_features(image_data, batch_size=100, \
         
         fmaps_batch = torch_utils._to_torch(fmaps_batch, device=device)
         
-        for mm in range(n_prfs):
-
-            x,y,sigma = models[mm,:]
-            
-            prf = torch_utils._to_torch(prf_utils.gauss_2d(center=[x,y], sd=sigma, \
-                                   patch_size=n_pix, aperture=1.0, dtype=np.float32), device=device)
+        # weighted sum of color feature values in each pRF, for all pRFs at once.
+        # fmaps_batch is [n_images x n_pix x n_pix x n_features]
+        features_batch = _prf_pooler(fmaps_batch, channels_last=True)
             
-            # weighted sum of color feature values in the pRF
-            features_batch = torch.tensordot(fmaps_batch, prf, dims=[[1,2],[0,1]])
-            
-            features_each_prf[batch_inds,:,mm] = torch_utils.get_value(features_batch)
-
+        features_each_prf[batch_inds,:,:] = torch_utils.get_value(features_batch)
             
         elapsed = time.time() - st
         print('took %.5f s to multiply maps by pRFs'%elapsed)
@@ -15,11 +15,19 @@ except:
 
 os.environ["HDF5_USE_FILE_LOCKING"] = "FALSE"
 
-def extract_color_features(image_data,
-                           prf_mask, 
-                           batch_size=100, 
-                           device=None,
-                           debug=False):
+def get_color_maps(image_data, 
+                   batch_size=100, 
+                   device=None,
+                   debug=False, 
+                   maps_filename=None):
+    
+    """
+    Compute the color feature maps [L*, a*, b*, saturation] for all images, once.
+    These get re-used for every pRF (each pRF just selects a subset of pixels).
+    If maps_filename is given, maps are written to a memory-mapped .npy file
+    there, rather than held in memory.
+    Returns [n_images x n_pix x n_pix x 4]
+    """
     
     n_pix = image_data.shape[2]
     n_images = image_data.shape[0]
@@ -27,12 +35,13 @@ def extract_color_features(image_data,
     n_batches = int(np.ceil(n_images/batch_size))
     
     n_features_color = 4 # [L*, a*, b*, saturation]   
-    n_features_spat = np.sum(prf_mask)
-    n_features_total = n_features_color * n_features_spat
     
-    print('number of [images, features] total: %d, %d'%(n_images,n_features_total))
-    
-    features = np.zeros((n_images, n_features_total), dtype=np.float32)
+    if maps_filename is not None:
+        print('Writing color maps to %s'%maps_filename)
+        color_maps = np.lib.format.open_memmap(maps_filename, mode='w+', dtype=np.float32, \
+                                               shape=(n_images, n_pix, n_pix, n_features_color))
+    else:
+        color_maps = np.zeros((n_images, n_pix, n_pix, n_features_color), dtype=np.float32)
 
     st = time.time()
     
@@ -61,27 +70,47 @@ def extract_color_features(image_data,
               
         # 4 color feature channels concatenated here
         fmaps = np.concatenate([image_lab, image_sat], axis=2)
-
-        # apply the prf mask      
-        fmaps_masked = fmaps[prf_mask]
         
-        if bb==0:
-            
-            print('size of prf mask is:')
-            print(prf_mask.shape)
-            print('sum of prf mask is:')
-            print(np.sum(prf_mask))   
-            print('size of fmaps_masked is:')
-            print(fmaps_masked.shape)
-        
-        fmaps_masked_reshaped = np.moveaxis(fmaps_masked, [2],[0])
-        
-        # all the color and spatial channels going into one big dimension.
-        features[batch_inds,:] = np.reshape(fmaps_masked_reshaped, [len(batch_inds),-1])
+        # [n_pix x n_pix x 4 x n_images] to [n_images x n_pix x n_pix x 4]
+        color_maps[batch_inds,:,:,:] = np.moveaxis(fmaps, [3],[0])
 
+    if maps_filename is not None:
+        color_maps.flush()
+        
     elapsed = time.time() - st
     print('took %.5f s to gather color feature maps'%elapsed)
+    
+    return color_maps
+
 
+def extract_color_features(color_maps,
+                           prf_mask):
+    
+    """
+    Get the color features for all pixels in one pRF mask.
+    color_maps is [n_images x n_pix x n_pix x 4], from get_color_maps.
+    Returns [n_images x (n_pixels_in_mask*4)]
+    """
+    
+    n_images = color_maps.shape[0]
+    n_features_color = color_maps.shape[3]
+    n_features_spat = np.sum(prf_mask)
+    n_features_total = n_features_color * n_features_spat
+    
+    print('number of [images, features] total: %d, %d'%(n_images,n_features_total))
+    
+    # apply the prf mask, fmaps_masked is [n_images x n_pixels_in_mask x 4]
+    fmaps_masked = color_maps[:,prf_mask,:]
+    
+    print('size of prf mask is:')
+    print(prf_mask.shape)
+    print('sum of prf mask is:')
+    print(np.sum(prf_mask))   
+    print('size of fmaps_masked is:')
+    print(fmaps_masked.shape)
+        
+    # all the color and spatial channels going into one big dimension.
+    features = np.reshape(fmaps_masked, [n_images,-1])
             
     return features
       
@@ -122,6 +151,17 @@ def proc_one_subject(subject, args):
     n_pix = image_data.shape[2]
      
     n_prf_sd_out = 1.5
+    
+    # color maps computed once here, then masked for each pRF
+    if args.memmap_maps:
+        maps_filename = os.path.join(path_to_save, 'S%d_cielab_plus_sat_maps_tmp.npy'%subject)
+    else:
+        maps_filename = None
+    color_maps = get_color_maps(image_data, \
+                                batch_size=args.batch_size, \
+                                debug=args.debug, \
+                                device=device, \
+                                maps_filename=maps_filename)
    
     for mm in range(n_prfs):
 
@@ -143,11 +183,8 @@ def proc_one_subject(subject, args):
         assert(np.sum(prf_mask)>0)
         
         # first extract features for all pixels/feature channels 
-        features_raw = extract_color_features(image_data, \
-                                              prf_mask = prf_mask,
-                                              batch_size=args.batch_size,
-                                              debug=args.debug, 
-                                              device=device)
+        features_raw = extract_color_features(color_maps, \
+                                              prf_mask = prf_mask)
 
         # then do pca to make these less huge
         filename_save_pca = os.path.join(path_to_save, \
@@ -183,6 +220,11 @@ def proc_one_subject(subject, args):
                                     save_dtype=np.float32, compress=True, \
                                     debug=args.debug)
 
+    if maps_filename is not None:
+        color_maps = None
+        print('Removing %s'%maps_filename)
+        os.remove(maps_filename)
+
 
 
     
@@ -220,6 +262,16 @@ def proc_other_image_set(image_set, args):
     
     n_prf_sd_out = 1.5
         
+    # color maps computed once here, then masked for each pRF
+    if args.memmap_maps:
+        maps_filename = os.path.join(path_to_save, '%s_cielab_plus_sat_maps_tmp.npy'%image_set)
+    else:
+        maps_filename = None
+    color_maps = get_color_maps(image_data, \
+                                batch_size=args.batch_size, \
+                                debug=args.debug, \
+                                device=device, \
+                                maps_filename=maps_filename)
     
     for mm in range(n_prfs):
         
@@ -240,11 +292,8 @@ def proc_other_image_set(image_set, args):
 
         assert(np.sum(prf_mask)>0)
         
-        features_raw = extract_color_features(image_data, \
-                                              prf_mask = prf_mask,
-                                              batch_size=args.batch_size,
-                                              debug=args.debug, 
-                                              device=device)
+        features_raw = extract_color_features(color_maps, \
+                                              prf_mask = prf_mask)
 
         subjects_pca=np.arange(1,9)
 
@@ -266,6 +315,11 @@ def proc_other_image_set(image_set, args):
                                         save_dtype=np.float32, compress=True, \
                                         debug=args.debug)
 
+    if maps_filename is not None:
+        color_maps = None
+        print('Removing %s'%maps_filename)
+        os.remove(maps_filename)
+
 
 
     
@@ -286,6 +340,9 @@ if __name__ == '__main__':
     parser.add_argument("--batch_size", type=int,default=100,
                     help="batch size for color feature extraction")
     
+    parser.add_argument("--memmap_maps", type=int,default=0,
+                    help="want to keep color maps in a memory-mapped file instead of in memory? 1 for yes, 0 for no")
+    
     parser.add_argument("--max_pc_to_retain", type=int,default=0,
                     help="max pc to retain? enter 0 for None")
     parser.add_argument("--min_pct_var", type=int,default=95,
@@ -6,9 +6,9 @@ import time
 import h5py
 
 #import custom modules
-from utils import numpy_utils, torch_utils, nsd_utils, prf_utils, default_paths
+from utils import torch_utils, nsd_utils, default_paths
 from model_fitting import initialize_fitting
-from feature_extraction import gabor_feature_extractor
+from feature_extraction import gabor_feature_extractor, prf_pooling
 
 try:
     device = initialize_fitting.init_cuda()
@@ -63,6 +63,18 @@ def extract_features(image_data,\
     
     features_each_prf = np.zeros((n_images, n_features, n_prfs), dtype=np.float32)
 
+    prfs_use = np.arange(n_prfs)
+    if debug:
+        prfs_use = prfs_use[0:2]
+        
+    # Set up pooling for every pRF at once, at each resolution of the feature maps.
+    # each pRF sums to 1, so this is the pRF-weighted sum of each map.
+    print('Making pRF pooling modules at resolutions:')
+    print(_gabor_ext_complex.resolutions_each_sf)
+    _prf_poolers = [prf_pooling.prf_pooler(models[prfs_use,:], n_pix_fm, aperture=1.0, \
+                                           prf_scaling='sum', device=device) \
+                   for n_pix_fm in _gabor_ext_complex.resolutions_each_sf]
+    
     with torch.no_grad():
         
         for bb in range(n_batches):
@@ -76,85 +88,45 @@ def extract_features(image_data,\
 
             image_batch = torch_utils._to_torch(image_data[batch_inds,:,:,:], device)
 
-            for mm in range(n_prfs):
-
-                if debug and mm>1:
-                    continue
-
-                x,y,sigma = models[mm,:]
-                print('Getting features for pRF [x,y,sigma]:')
-                print([x,y,sigma])
-                
-                print('Computing complex cell features...')
-                t = time.time()
-                features_batch = get_avg_features_in_prf(_gabor_ext_complex, image_batch, models[mm,:],\
-                                                                sample_batch_size=sample_batch_size, \
-                                                                aperture=1.0, device=device, to_numpy=True)
-                elapsed =  time.time() - t
-                print('time elapsed = %.5f'%elapsed)
+            print('Computing complex cell features...')
+            t = time.time()
+            features_batch = get_avg_features_all_prfs(_gabor_ext_complex, image_batch, _prf_poolers, \
+                                                       to_numpy=True)
+            elapsed =  time.time() - t
+            print('time elapsed = %.5f'%elapsed)
 
-                print('model %d, min/max of features in batch: [%s, %s]'%(mm, \
-                                          np.min(features_batch), np.max(features_batch))) 
+            print('min/max of features in batch: [%s, %s]'%(np.min(features_batch), np.max(features_batch))) 
 
-                features_each_prf[batch_inds,:,mm] = features_batch
+            features_each_prf[batch_inds,:,0:len(prfs_use)] = features_batch
 
-                sys.stdout.flush()
+            sys.stdout.flush()
                 
     return features_each_prf
                                               
     
     
-def get_avg_features_in_prf(_fmaps_fn, images, prf_params, sample_batch_size, aperture, device, \
-                            dtype=np.float32, to_numpy=True):
+def get_avg_features_all_prfs(_fmaps_fn, images, _prf_poolers, to_numpy=True):
     
     """
-    For a given set of images and a specified pRF position and size, compute the mean (weighted by pRF)
-    in each feature map channel. Returns [nImages x nFeatures]
+    For a given batch of images, compute the feature maps once and then get the mean (weighted by pRF)
+    in each feature map channel, for all pRFs at once. 
+    _prf_poolers is a list of prf_pooling.prf_pooler modules, one per resolution 
+    in _fmaps_fn.resolutions_each_sf.
+    Returns [nImages x nFeatures x nPRFs]
     """
     
-    x,y,sigma = prf_params
-    n_trials = images.shape[0]
-    n_features = _fmaps_fn.n_features
-    fmaps_rez = _fmaps_fn.resolutions_each_sf
-
-    features = np.zeros(shape=(n_trials, n_features), dtype=dtype)
-    if to_numpy==False:
-         features = torch_utils._to_torch(features, device=device)
-
-    # Define the RF for this "model" version - at several resolutions.
-    _prfs = [torch_utils._to_torch(prf_utils.gauss_2d(center=[x,y], sd=sigma, \
-                                   patch_size=n_pix, aperture=aperture, dtype=dtype), \
-                                   device=device) for n_pix in fmaps_rez]
-
-    # To make full design matrix for all trials, first looping over trials in batches to get the features
-    # Only reason to loop is memory constraints, because all trials is big matrices.
-    t = time.time()
-    n_batches = np.ceil(n_trials/sample_batch_size)
-    bb=-1
-    for rt,rl in numpy_utils.iterate_range(0, n_trials, sample_batch_size):
-
-        bb=bb+1
-
-        # Multiplying feature maps by RFs here. 
-        # Feature maps in _fm go [nTrials x nFeatures(orientations) x nPixels x nPixels]
-        # Spatial RFs in _prfs go [nPixels x nPixels]
-        # Once we multiply, get [nTrials x nFeatures]
-        # note this is concatenating SFs together from low (smallest maps) to high (biggest maps). 
-        # Cycles through all orient channels in order for first SF, then again for next SF, etc.
-        _features = torch.cat([torch.tensordot(_fm, _prf, dims=[[2,3], [0,1]]) \
-                               for _fm,_prf in zip(_fmaps_fn(images[rt]), _prfs)], dim=1) # [#samples, #features]
-
-        # Add features for this batch to full design matrix over all trials
-        if to_numpy:
-            features[rt] = torch_utils.get_value(_features)
-        else:
-            features[rt] = _features
-
-        elapsed = time.time() - t
-
-    return features
-
-
+    # Feature maps in _fm go [nTrials x nFeatures(orientations) x nPixels x nPixels]
+    # Once we pool within each pRF, get [nTrials x nFeatures x nPRFs]
+    # SFs are concatenated from low (smallest maps) to high (biggest maps): all orientation 
+    # channels in order for the first SF, then again for the next SF, etc.
+    _features = torch.cat([_pooler(_fm) for _fm,_pooler in zip(_fmaps_fn(images), _prf_poolers)], dim=1)
+    
+    if to_numpy:
+        return torch_utils.get_value(_features)
+    else:
+        return _features
+    
+    
 def proc_one_subject(subject, args):
 
     if args.use_node_storage:
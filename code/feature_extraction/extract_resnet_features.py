@@ -14,7 +14,7 @@ import torchvision.models as models
 #import custom modules
 from utils import prf_utils, torch_utils, texture_utils, default_paths, nsd_utils, floc_utils
 from model_fitting import initialize_fitting
-from feature_extraction import pca_feats
+from feature_extraction import pca_feats, prf_pooling
 
 # clip implemented in this package, from:
 # https://github.com/openai/CLIP
@@ -40,36 +40,49 @@ def extract_features(image_data, \
     """ 
     Extract the portion of CNN feature maps corresponding to each pRF in the grid.
     Save values of the features in each pRF, for each layer of interest.
+    The model is loaded once, and each batch of images goes through the network once, 
+    with hooks on all the blocks in block_inds. Each block's feature maps are pooled 
+    into all the pRFs at once, and written straight into that block's files.
+    save_batch_filenames is a list over blocks, each a list of filenames over pRF batches.
     """
 
-    prf_models = initialize_fitting.get_prf_models(which_grid=args.which_prf_grid)  
+    prf_models = initialize_fitting.get_prf_models(which_grid=which_prf_grid)  
     
-    assert(len(block_inds)==1)
-    ll = block_inds[0]
+    assert(len(save_batch_filenames)==len(block_inds))
     
     n_images = image_data.shape[0]
     
     # Keep these params fixed
-    n_prf_sd_out = 2
     batch_size = 100 # batches in image dimension
-    mult_patch_by_prf = True
-    do_avg_pool = True
     model_architecture='RN50'
 
     n_prf_batches = len(prf_batch_inds)
+    prfs_use = np.concatenate(prf_batch_inds, axis=0)
     
     n_batches = int(np.ceil(n_images/batch_size))
 
-    with torch.no_grad():
-
-        # separate the prfs into batches to save memory.  
+    model = get_resnet_model(model_architecture, training_type, device=device)
+    
+    # pRF pooling modules, one for each feature map resolution. 
+    # these get made once we know what the resolutions are (first batch).
+    _prf_poolers = dict()
+    
+    # open a file for each block and each batch of pRFs, we'll write to these one image batch at a time.
+    # doing it this way because the features for all pRFs and blocks are too big to hold in memory.
+    files = []
+    dsets = [[] for ll in block_inds]
+    for bi, ll in enumerate(block_inds):
         for pb in range(n_prf_batches):
-
-            prfs_this_batch = prf_batch_inds[pb]
-            # doing the whole procedure of feature extraction one layer at a time
-            # otherwise will run out of memory bc huge arrays.
-            features_each_prf = np.zeros((n_images, n_features_each_resnet_block[ll], \
-                                          len(prfs_this_batch)),dtype=save_dtype)
+            print('Will write prf features to %s'%save_batch_filenames[bi][pb])
+            f = h5py.File(save_batch_filenames[bi][pb], 'w')
+            dsets[bi].append(f.create_dataset("features", \
+                                              (n_images, n_features_each_resnet_block[ll], len(prf_batch_inds[pb])), \
+                                              dtype=save_dtype))
+            files.append(f)
+            
+    try:
+        
+        with torch.no_grad():
 
             for bb in range(n_batches):
 
@@ -87,72 +100,158 @@ def extract_features(image_data, \
                 torch.cuda.empty_cache()
 
                 activ_batch = get_resnet_activations_batch(image_batch, block_inds, \
-                                                     model_architecture, training_type, device=device)
-
-
-                print('Getting prf-specific activations for %s'%resnet_block_names[ll])
-
-                maps_full_field = torch.moveaxis(activ_batch[0], [0,1,2,3], [0,3,1,2])
-
-                if bb==0:
-                    print('size of maps stack for first batch is:')
-                    print(maps_full_field.shape)
-
-                for mi, mm in enumerate(prfs_this_batch):
+                                                     model_architecture, training_type, device=device, \
+                                                     model=model)
+
+                t = time.time()
+                
+                for bi, ll in enumerate(block_inds):
+
+                    # maps are [n_images x n_features x n_pix x n_pix]
+                    n_pix = activ_batch[bi].shape[2]
+                    if bb==0:
+                        print('size of maps stack for %s is:'%resnet_block_names[ll])
+                        print(activ_batch[bi].shape)
+                    if n_pix not in _prf_poolers.keys():
+                        # each pRF is scaled to [0,1], then pRF-weighted maps are averaged over space
+                        _prf_poolers[n_pix] = prf_pooling.prf_pooler(prf_models[prfs_use,:], n_pix, \
+                                                                     aperture=1.0, prf_scaling='max', \
+                                                                     device=device)
+
+                    # features_batch is [n_images x n_features x n_prfs]
+                    features_batch = _prf_poolers[n_pix](activ_batch[bi])
+                    features_batch = torch_utils.get_value(features_batch)
+                    
+                    print('%s, min/max of features in batch: [%s, %s]'%(resnet_block_names[ll], \
+                                                  np.min(features_batch), np.max(features_batch))) 
+
+                    pi = 0
+                    for pb in range(n_prf_batches):
+                        n_prfs_batch = len(prf_batch_inds[pb])
+                        dsets[bi][pb][batch_inds[0]:batch_inds[-1]+1,:,:] = features_batch[:,:,pi:pi+n_prfs_batch]
+                        pi += n_prfs_batch
+                        
+                activ_batch = None
+                print('time to get pRF features for all blocks = %.5f'%(time.time() - t))
+                sys.stdout.flush()
+                
+    finally:
+        
+        for f in files:
+            f.close()
+        
+        
+def extract_features_pca(image_data, \
+                    block_inds, \
+                    prf_batch_inds, \
+                    pca_each_block, \
+                    which_prf_grid=5, \
+                    training_type='clip', \
+                    debug=False):
+    """ 
+    Same as extract_features, but the features for each block and pRF batch go straight into 
+    streaming PCA (pca_feats.streaming_pca), so the raw features never get written to disk.
+    pca_each_block is a list over blocks, each a list over pRF batches, each a list of 
+    streaming_pca objects that use those features (more than one if applying several sets 
+    of saved weights to the same features).
+    Each pRF batch needs two passes through the images (first to fit the pca, then to project), 
+    so the first pass for one pRF batch is done along with the second pass for the batch before it.
+    """
 
-                    if debug and mi>1:
-                        continue
+    prf_models = initialize_fitting.get_prf_models(which_grid=which_prf_grid)  
+    
+    assert(len(pca_each_block)==len(block_inds))
+    
+    n_images = image_data.shape[0]
+    
+    # Keep these params fixed
+    batch_size = 100 # batches in image dimension
+    model_architecture='RN50'
 
-                    prf_params = prf_models[mm,:]
-                    x,y,sigma = prf_params
-                    print('Getting features for pRF [x,y,sigma]:')
-                    print([x,y,sigma])
-                    n_pix = maps_full_field.shape[1]
+    n_prf_batches = len(prf_batch_inds)
+    n_batches = int(np.ceil(n_images/batch_size))
 
-                    # Define the RF for this "model" version
-                    prf = torch_utils._to_torch(prf_utils.gauss_2d(center=[x,y], sd=sigma, \
-                               patch_size=n_pix, aperture=1.0, dtype=np.float32), device=device)
-                    minval = torch.min(prf)
-                    maxval = torch.max(prf-minval)
-                    prf_scaled = (prf - minval)/maxval
+    model = get_resnet_model(model_architecture, training_type, device=device)
+    
+    # pRF pooling modules, one for each feature map resolution and pRF batch.
+    _prf_poolers = dict()
+    
+    with torch.no_grad():
+        
+        for pp in range(n_prf_batches+1):
+            
+            prf_batches_fit = [pp] if pp<n_prf_batches else []
+            prf_batches_project = [pp-1] if pp>0 else []
+            print('Pass %d of %d through images: fitting pca for prf batch %s, projecting prf batch %s'\
+                  %(pp, n_prf_batches+1, prf_batches_fit, prf_batches_project))
+            
+            for bb in range(n_batches):
 
-                    if mult_patch_by_prf:
-                        # This effectively restricts the spatial location, so no need to crop
-                        maps = maps_full_field * prf_scaled.view([1,n_pix, n_pix,1])
-                    else:
-                        # This is a coarser way of choosing which spatial region to look at
-                        # Crop the patch +/- n SD away from center
-                        bbox = texture_utils.get_bbox_from_prf(prf_params, prf.shape, n_prf_sd_out, \
-                                                       min_pix=None, verbose=False, force_square=False)
-                        print('bbox to crop is:')
-                        print(bbox)
-                        maps = maps_full_field[:,bbox[0]:bbox[1], bbox[2]:bbox[3],:]
+                if debug and bb>1:
+                    continue
+                print('Processing images for batch %d of %d'%(bb, n_batches))
 
-                    if do_avg_pool:
-                        features_batch = torch.mean(maps, dim=(1,2))
-                    else:
-                        features_batch = torch.max(maps, dim=(1,2))
+                batch_inds = np.arange(batch_size * bb, np.min([batch_size * (bb+1), n_images]))
 
-                    print('model %d, min/max of features in batch: [%s, %s]'%(mm, \
-                                                  torch.min(features_batch), torch.max(features_batch))) 
+                # using grayscale images for better comparison w my other models.
+                # need to tile to 3 so model weights will be right size
+                image_batch = np.tile(image_data[batch_inds,:,:,:], [1,3,1,1])
 
-                    features_each_prf[batch_inds,:,mi] = torch_utils.get_value(features_batch)
+                gc.collect()
+                torch.cuda.empty_cache()
 
-            # Now save the results
-            save_features(features_each_prf, save_batch_filenames[pb], save_dtype)
-          
+                activ_batch = get_resnet_activations_batch(image_batch, block_inds, \
+                                                     model_architecture, training_type, device=device, \
+                                                     model=model)
+
+                t = time.time()
+                
+                for bi, ll in enumerate(block_inds):
+
+                    # maps are [n_images x n_features x n_pix x n_pix]
+                    n_pix = activ_batch[bi].shape[2]
+                    
+                    for pb in prf_batches_fit + prf_batches_project:
+                        
+                        if (n_pix, pb) not in _prf_poolers.keys():
+                            _prf_poolers[(n_pix, pb)] = prf_pooling.prf_pooler(prf_models[prf_batch_inds[pb],:], \
+                                                                               n_pix, aperture=1.0, \
+                                                                               prf_scaling='max', \
+                                                                               device=device)
+                        # features_batch is [n_images x n_features x n_prfs]
+                        features_batch = _prf_poolers[(n_pix, pb)](activ_batch[bi])
+                        
+                        for pca in pca_each_block[bi][pb]:
+                            if pb in prf_batches_fit:
+                                pca.add_batch(features_batch, batch_inds)
+                            else:
+                                pca.transform_batch(features_batch, batch_inds)
+                        
+                activ_batch = None
+                print('time to get pRF features for all blocks = %.5f'%(time.time() - t))
+                sys.stdout.flush()
+            
+            for pb in prf_batches_fit:
+                for bi, ll in enumerate(block_inds):
+                    print('Fitting pca for %s, prf batch %d'%(resnet_block_names[ll], pb))
+                    for pca in pca_each_block[bi][pb]:
+                        pca.fit()
+                sys.stdout.flush()
+            for pb in prf_batches_project:
+                # done with this prf batch, free everything but the scores (and weights to save)
+                for bi, ll in enumerate(block_inds):
+                    for pca in pca_each_block[bi][pb]:
+                        pca.finish()
+                gc.collect()
+                torch.cuda.empty_cache()
         
-def get_resnet_activations_batch(image_batch, \
-                               block_inds, \
-                               model_architecture, \
-                               training_type, \
-                               device=None):
+        
+def get_resnet_model(model_architecture, training_type, device=None):
 
     """
-    Get activations for images in NSD, passed through pretrained resnet model.
-    Specify which NSD images to look at, and which layers to return.
+    Load pretrained resnet model (CLIP image encoder, or resnet50 trained on imagenet)
     """
-
+    
     if device is None:
         device = torch.device('cpu:0')
        
@@ -190,6 +289,28 @@ def get_resnet_activations_batch(image_batch, \
         
     model.eval()
     
+    return model
+
+        
+def get_resnet_activations_batch(image_batch, \
+                               block_inds, \
+                               model_architecture, \
+                               training_type, \
+                               device=None, \
+                               model=None):
+
+    """
+    Get activations for images in NSD, passed through pretrained resnet model.
+    Specify which NSD images to look at, and which layers to return.
+    Can pass in an already loaded model (from get_resnet_model), otherwise it is loaded here.
+    """
+
+    if device is None:
+        device = torch.device('cpu:0')
+       
+    if model is None:
+        model = get_resnet_model(model_architecture, training_type, device=device)
+    
     # The 16 residual blocks are segmented into 4 groups here, which have different numbers of features.
     blocks_each= [len(model.layer1), len(model.layer2), len(model.layer3),len(model.layer4)]
     which_group = np.repeat(np.arange(4), blocks_each)
@@ -226,13 +347,13 @@ def get_resnet_activations_batch(image_batch, \
                 h=None
             hooks[ii] = h
 
-        # Pass images though the model (hooks get run now)
-        image_features = model(image_tensors)
-
-        # Now remove all the hooks
-        for ii, ll in enumerate(block_inds):
-            print(activ[ii].shape)
-            hooks[ii].remove
+        try:
+            # Pass images though the model (hooks get run now)
+            image_features = model(image_tensors)
+        finally:
+            # Now remove all the hooks (model may get used again)
+            for ii, ll in enumerate(block_inds):
+                hooks[ii].remove()
 
     # Sanity check that we grabbed the right activations - check their sizes against expected
     # output size of each block
@@ -243,6 +364,19 @@ def get_resnet_activations_batch(image_batch, \
     return activ
 
 
+def get_block_passes(blocks_to_do, n_blocks_per_pass):
+    
+    """
+    Split the blocks into groups that get extracted in one pass through the network.
+    n_blocks_per_pass=0 means all blocks in one pass.
+    """
+    
+    if n_blocks_per_pass==0:
+        n_blocks_per_pass = len(blocks_to_do)
+    n_passes = int(np.ceil(len(blocks_to_do)/n_blocks_per_pass))
+    
+    return [blocks_to_do[pp*n_blocks_per_pass:(pp+1)*n_blocks_per_pass] for pp in range(n_passes)]
+
 def proc_one_subject(subject, args):
     
     if args.training_type=='clip':
@@ -289,16 +423,68 @@ def proc_one_subject(subject, args):
     prf_batch_inds = [np.arange(pb*prf_batch_size, np.min([(pb+1)*prf_batch_size, n_prfs])) \
                       for pb in range(n_prf_batches)]
     
-    for ll in blocks_to_do:
+    model_architecture='RN50'
+    
+    if args.streaming_pca:
+        
+        # raw features go straight into pca, without saving them first
+        path_to_save = os.path.join(feat_path, 'PCA')
+        if not os.path.exists(path_to_save):
+            os.makedirs(path_to_save)
+        if subject==999:
+            fit_inds = np.ones((image_data.shape[0],),dtype=bool)
+        else:
+            # training / validation data always split the same way - shared 1000 inds are validation.
+            subject_df = nsd_utils.get_subj_df(subject)
+            fit_inds = np.array(subject_df['shared1000']==False)
+        
+        for blocks_this_pass in get_block_passes(blocks_to_do, args.n_blocks_per_pass):
+            
+            file_prefixes = [os.path.join(path_to_save, 'S%d_%s_%s_PCA'%\
+                                          (subject, model_architecture, resnet_block_names[ll])) \
+                             for ll in blocks_this_pass]
+            
+            pca_each_block = [[[pca_feats.streaming_pca(image_data.shape[0], \
+                                            n_features_each_resnet_block[ll], \
+                                            prf_batch_inds[pb], \
+                                            fit_inds=fit_inds, \
+                                            zscore_before_pca=True, \
+                                            min_pct_var=args.min_pct_var, \
+                                            max_pc_to_retain=args.max_pc_to_retain, \
+                                            use_saved_ncomp=args.use_saved_ncomp==1, \
+                                            ncomp_filename='%s_grid%d_ncomp.npy'%(prefix, args.which_prf_grid), \
+                                            keep_weights=args.save_pca_weights==1, \
+                                            device=device)] \
+                                for pb in range(n_prf_batches)] \
+                              for ll, prefix in zip(blocks_this_pass, file_prefixes)]
+            
+            extract_features_pca(image_data, \
+                                 blocks_this_pass, \
+                                 prf_batch_inds, \
+                                 pca_each_block, \
+                                 which_prf_grid=args.which_prf_grid, \
+                                 training_type=args.training_type, \
+                                 debug=args.debug)
+            
+            for bi, prefix in enumerate(file_prefixes):
+                pca_feats.save_streaming_pca([pcas[0] for pcas in pca_each_block[bi]], \
+                                             '%s_grid%d.h5py'%(prefix, args.which_prf_grid), \
+                                             save_weights=args.save_pca_weights==1, \
+                                             save_weights_filename='%s_weights_grid%d.npy'\
+                                                                    %(prefix, args.which_prf_grid))
+            sys.stdout.flush()
+            
+        return
+    
+    for blocks_this_pass in get_block_passes(blocks_to_do, args.n_blocks_per_pass):
 
         # each batch will be in a separate file, since they're big features
-        model_architecture='RN50'
-        save_batch_filenames = [os.path.join(feat_path, \
+        save_batch_filenames = [[os.path.join(feat_path, \
                'S%d_%s_%s_features_each_prf_grid%d_prfbatch%d.h5py'%\
                 (subject, model_architecture, resnet_block_names[ll], args.which_prf_grid, pb)) \
-                                for pb in range(n_prf_batches)]
+                                for pb in range(n_prf_batches)] for ll in blocks_this_pass]
         
-        block_inds = [ll]
+        block_inds = blocks_this_pass
        
         extract_features(image_data,\
                           block_inds,\
@@ -311,25 +497,27 @@ def proc_one_subject(subject, args):
 
         sys.stdout.flush()
             
-        layer = 'block%d'%(ll)
-        pca_feats.run_pca(subject=subject, \
-                          feature_type='resnet_%s'%args.training_type, \
-                          layer_name = layer, \
-                          which_prf_grid=args.which_prf_grid,\
-                          min_pct_var=args.min_pct_var,\
-                          max_pc_to_retain=args.max_pc_to_retain, \
-                          save_weights = args.save_pca_weights==1, \
-                          use_saved_ncomp = args.use_saved_ncomp==1, \
-                          debug=args.debug)
-        
-        # now removing the large intermediate files, leaving only the pca versions
-        for big_fn in save_batch_filenames:
+        for bi, ll in enumerate(blocks_this_pass):
             
-            print('removing big activations file: %s'%big_fn)
-            sys.stdout.flush()
-            os.remove(big_fn)
+            layer = 'block%d'%(ll)
+            pca_feats.run_pca(subject=subject, \
+                              feature_type='resnet_%s'%args.training_type, \
+                              layer_name = layer, \
+                              which_prf_grid=args.which_prf_grid,\
+                              min_pct_var=args.min_pct_var,\
+                              max_pc_to_retain=args.max_pc_to_retain, \
+                              save_weights = args.save_pca_weights==1, \
+                              use_saved_ncomp = args.use_saved_ncomp==1, \
+                              debug=args.debug)
+
+            # now removing the large intermediate files, leaving only the pca versions
+            for big_fn in save_batch_filenames[bi]:
 
-            print('big file removed.')
+                print('removing big activations file: %s'%big_fn)
+                sys.stdout.flush()
+                os.remove(big_fn)
+
+                print('big file removed.')
 
             
 def proc_other_image_set(image_set, args):
@@ -373,16 +561,56 @@ def proc_other_image_set(image_set, args):
     
     subjects_pca = np.arange(1,9)
        
-    for ll in blocks_to_do:
+    model_architecture='RN50'
+    
+    if args.streaming_pca:
+        
+        # raw features go straight into pca (using weights from each subject), without saving them first
+        path_to_save = os.path.join(feat_path, 'PCA')
+        
+        for blocks_this_pass in get_block_passes(blocks_to_do, args.n_blocks_per_pass):
+            
+            pca_each_block = [[[pca_feats.streaming_pca(image_data.shape[0], \
+                                            n_features_each_resnet_block[ll], \
+                                            prf_batch_inds[pb], \
+                                            zscore_before_pca=True, \
+                                            load_weights_filename=os.path.join(path_to_save, \
+                                                    'S%d_%s_%s_PCA_weights_grid%d.npy'%\
+                                                    (ss, model_architecture, resnet_block_names[ll], \
+                                                     args.which_prf_grid)), \
+                                            keep_weights=False, \
+                                            device=device) \
+                                 for ss in subjects_pca] \
+                                for pb in range(n_prf_batches)] \
+                              for ll in blocks_this_pass]
+            
+            extract_features_pca(image_data, \
+                                 blocks_this_pass, \
+                                 prf_batch_inds, \
+                                 pca_each_block, \
+                                 which_prf_grid=args.which_prf_grid, \
+                                 training_type=args.training_type, \
+                                 debug=args.debug)
+            
+            for bi, ll in enumerate(blocks_this_pass):
+                for si, ss in enumerate(subjects_pca):
+                    pca_filename = os.path.join(path_to_save, '%s_%s_%s_PCA_wtsfromS%d_grid%d.h5py'%\
+                                                (image_set, model_architecture, resnet_block_names[ll], \
+                                                 ss, args.which_prf_grid))
+                    pca_feats.save_streaming_pca([pcas[si] for pcas in pca_each_block[bi]], pca_filename)
+            sys.stdout.flush()
+            
+        return
+       
+    for blocks_this_pass in get_block_passes(blocks_to_do, args.n_blocks_per_pass):
 
         # each batch will be in a separate file, since they're big features
-        model_architecture='RN50'
-        save_batch_filenames = [os.path.join(feat_path, \
+        save_batch_filenames = [[os.path.join(feat_path, \
                '%s_%s_%s_features_each_prf_grid%d_prfbatch%d.h5py'%\
                 (image_set, model_architecture, resnet_block_names[ll], args.which_prf_grid, pb)) \
-                                for pb in range(n_prf_batches)]
+                                for pb in range(n_prf_batches)] for ll in blocks_this_pass]
         
-        block_inds = [ll]
+        block_inds = blocks_this_pass
         
         extract_features(image_data,\
                           block_inds,\
@@ -395,28 +623,30 @@ def proc_other_image_set(image_set, args):
 
         sys.stdout.flush()
             
-        layer = 'block%d'%(ll)
-        for ss in subjects_pca:
-            
-            pca_feats.run_pca(subject=ss, \
-                              image_set=image_set, \
-                              feature_type='resnet_%s'%args.training_type, \
-                              layer_name = layer, \
-                              which_prf_grid=args.which_prf_grid,\
-                              min_pct_var=args.min_pct_var,\
-                              max_pc_to_retain=args.max_pc_to_retain, \
-                              save_weights = False,
-                              use_saved_ncomp = args.use_saved_ncomp==1, \
-                              debug=args.debug)
-
-        # now removing the large intermediate files, leaving only the pca versions
-        for big_fn in save_batch_filenames:
+        for bi, ll in enumerate(blocks_this_pass):
             
-            print('removing big activations file: %s'%big_fn)
-            sys.stdout.flush()
-            os.remove(big_fn)
-
-            print('big file removed.')
+            layer = 'block%d'%(ll)
+            for ss in subjects_pca:
+
+                pca_feats.run_pca(subject=ss, \
+                                  image_set=image_set, \
+                                  feature_type='resnet_%s'%args.training_type, \
+                                  layer_name = layer, \
+                                  which_prf_grid=args.which_prf_grid,\
+                                  min_pct_var=args.min_pct_var,\
+                                  max_pc_to_retain=args.max_pc_to_retain, \
+                                  save_weights = False,
+                                  use_saved_ncomp = args.use_saved_ncomp==1, \
+                                  debug=args.debug)
+
+            # now removing the large intermediate files, leaving only the pca versions
+            for big_fn in save_batch_filenames[bi]:
+
+                print('removing big activations file: %s'%big_fn)
+                sys.stdout.flush()
+                os.remove(big_fn)
+
+                print('big file removed.')
   
             
 def save_features(features_each_prf, filename_save, save_dtype):
@@ -448,6 +678,8 @@ if __name__ == '__main__':
                     help="which network layer to start from?")
     parser.add_argument("--n_layers_save", type=int,default=16,
                     help="how many layers to save?")
+    parser.add_argument("--n_blocks_per_pass", type=int,default=0,
+                    help="how many layers to extract in each pass through the images? 0 for all at once (needs disk space for all of them)")
     
     parser.add_argument("--debug", type=int,default=0,
                     help="want to run a fast test version of this script to debug? 1 for yes, 0 for no")
@@ -461,6 +693,8 @@ if __name__ == '__main__':
                     help="want to save the weights to reproduce the pca later? 1 for yes, 0 for no")
     parser.add_argument("--use_saved_ncomp", type=int,default=0,
                     help="want to use a previously saved number of components? 1 for yes, 0 for no")
+    parser.add_argument("--streaming_pca", type=int,default=0,
+                    help="want to do pca on features as they are extracted, without saving raw features? 1 for yes, 0 for no")
 
 
     args = parser.parse_args()
@@ -469,6 +703,8 @@ if __name__ == '__main__':
         args.subject=None
     if args.image_set=='none':
         args.image_set=None
+    if args.max_pc_to_retain==0:
+        args.max_pc_to_retain = None
                          
     args.debug = (args.debug==1)     
     
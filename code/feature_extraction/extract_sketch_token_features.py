@@ -8,6 +8,7 @@ import h5py
 #import custom modules
 from utils import prf_utils, torch_utils, texture_utils, default_paths
 from model_fitting import initialize_fitting
+from feature_extraction import prf_pooling
 
 if torch.cuda.is_available():
     device = initialize_fitting.init_cuda()
@@ -38,6 +39,9 @@ def get_features_each_prf(features_file, models, mult_patch_by_prf=True, do_avg_
     features_each_prf = np.zeros((n_images, n_features, n_prfs))
     n_batches = int(np.ceil(n_images/batch_size))
 
+    # made on first batch, used for all pRFs at once when multiplying by pRF and averaging.
+    _prf_pooler = None
+    
     for bb in range(n_batches):
 
         if debug and bb>1:
@@ -60,46 +64,62 @@ def get_features_each_prf(features_file, models, mult_patch_by_prf=True, do_avg_
 
         maps_full_field = torch_utils._to_torch(fmaps_batch, device=device)
 
-        for mm in range(n_prfs):
+        if mult_patch_by_prf and do_avg_pool:
+
+            if _prf_pooler is None:
+                # in debug mode, only doing the first two pRFs (same as loop below)
+                n_prfs_pool = np.min([2, n_prfs]) if debug else n_prfs
+                # each pRF is scaled to [0,1], then pRF-weighted maps are averaged over space
+                _prf_pooler = prf_pooling.prf_pooler(models[0:n_prfs_pool,:], map_resolution, \
+                                                     aperture=aperture, prf_scaling='max', device=device)
+
+            # maps are [n_images x n_pix x n_pix x n_features], features_batch is [n_images x n_features x n_prfs]
+            features_batch = _prf_pooler(maps_full_field, channels_last=True)
+            print('min/max of features in batch: [%s, %s]'%(torch.min(features_batch), \
+                                                            torch.max(features_batch))) 
+            features_each_prf[batch_inds,:,0:n_prfs_pool] = torch_utils.get_value(features_batch)
+
+        else:
+            for mm in range(n_prfs):
 
-            if debug and mm>1:
-                continue
+                if debug and mm>1:
+                    continue
 
-            prf_params = models[mm,:]
-            x,y,sigma = prf_params
-            print('Getting features for pRF [x,y,sigma]:')
-            print([x,y,sigma])
-            n_pix = map_resolution
+                prf_params = models[mm,:]
+                x,y,sigma = prf_params
+                print('Getting features for pRF [x,y,sigma]:')
+                print([x,y,sigma])
+                n_pix = map_resolution
 
-            # Define the RF for this "model" version
-            prf = torch_utils._to_torch(prf_utils.gauss_2d(center=[x,y], sd=sigma, \
-                               patch_size=n_pix, aperture=aperture, dtype=np.float32), device=device)
-            minval = torch.min(prf)
-            maxval = torch.max(prf-minval)
-            prf_scaled = (prf - minval)/maxval
+                # Define the RF for this "model" version
+                prf = torch_utils._to_torch(prf_utils.gauss_2d(center=[x,y], sd=sigma, \
+                                   patch_size=n_pix, aperture=aperture, dtype=np.float32), device=device)
+                minval = torch.min(prf)
+                maxval = torch.max(prf-minval)
+                prf_scaled = (prf - minval)/maxval
 
-            if mult_patch_by_prf:         
-                # This effectively restricts the spatial location, so no need to crop
-                maps = maps_full_field * prf_scaled.view([1,map_resolution,map_resolution,1])
-            else:
-                # This is a coarser way of choosing which spatial region to look at
-                # Crop the patch +/- n SD away from center
-                n_prf_sd_out = 2
-                bbox = texture_utils.get_bbox_from_prf(prf_params, prf.shape, \
-                               n_prf_sd_out, min_pix=None, verbose=False, force_square=False)
-                print('bbox to crop is:')
-                print(bbox)
-                maps = maps_full_field[:,bbox[0]:bbox[1], bbox[2]:bbox[3],:]
+                if mult_patch_by_prf:         
+                    # This effectively restricts the spatial location, so no need to crop
+                    maps = maps_full_field * prf_scaled.view([1,map_resolution,map_resolution,1])
+                else:
+                    # This is a coarser way of choosing which spatial region to look at
+                    # Crop the patch +/- n SD away from center
+                    n_prf_sd_out = 2
+                    bbox = texture_utils.get_bbox_from_prf(prf_params, prf.shape, \
+                                   n_prf_sd_out, min_pix=None, verbose=False, force_square=False)
+                    print('bbox to crop is:')
+                    print(bbox)
+                    maps = maps_full_field[:,bbox[0]:bbox[1], bbox[2]:bbox[3],:]
 
-            if do_avg_pool:
-                features_batch = torch.mean(maps, dim=(1,2))
-            else:
-                features_batch = torch.max(maps, dim=(1,2))
+                if do_avg_pool:
+                    features_batch = torch.mean(maps, dim=(1,2))
+                else:
+                    features_batch = torch.max(maps, dim=(1,2))
                 
-            print('model %d, min/max of features in batch: [%s, %s]'%(mm, \
-                                  torch.min(features_batch), torch.max(features_batch))) 
+                print('model %d, min/max of features in batch: [%s, %s]'%(mm, \
+                                      torch.min(features_batch), torch.max(features_batch))) 
 
-            features_each_prf[batch_inds,:,mm] = torch_utils.get_value(features_batch)
+                features_each_prf[batch_inds,:,mm] = torch_utils.get_value(features_batch)
                       
     return features_each_prf
 
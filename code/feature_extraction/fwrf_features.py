@@ -3,9 +3,11 @@ import os
 import time
 import h5py
 import copy
+import concurrent.futures
 
 from utils import default_paths
 from model_fitting import initialize_fitting
+from feature_extraction import prf_major_features
 
 """
 Code to load pre-computed features from various models (gabor, alexnet, semantic, etc.)
@@ -53,6 +55,19 @@ class fwrf_feature_loader:
 
         if not os.path.exists(self.features_file):
             raise RuntimeError('Looking at %s for precomputed features, not found.'%self.features_file)
+            
+        # if a pRF-major copy of the features file exists, can read from that (faster)
+        self.use_prf_major = kwargs['use_prf_major'] \
+            if 'use_prf_major' in kwargs.keys() else True
+        self.prf_major_file = prf_major_features.get_prf_major_filename(self.features_file)
+        if not (self.use_prf_major and os.path.exists(self.prf_major_file)):
+            self.prf_major_file = None
+        elif not prf_major_features.is_up_to_date(self.prf_major_file, self.features_file):
+            print('pRF-major file %s does not match %s (re-run conversion), will load from original file'\
+                  %(self.prf_major_file, self.features_file))
+            self.prf_major_file = None
+        else:
+            print('will load features from pRF-major file %s'%self.prf_major_file)
 
     def __init_gabor__(self, kwargs):
         
@@ -377,6 +392,14 @@ class fwrf_feature_loader:
         self.features_each_prf_batch = None
         self.prf_inds_loaded = []
         
+        # optionally, load the next batch of pRFs in a background thread while current one is used.
+        # at most two batches are in memory at once (current and next).
+        self.prefetch = kwargs['prefetch'] if 'prefetch' in kwargs.keys() else False
+        self.prefetch_executor = None
+        self.prefetch_future = None
+        self.prefetch_batch = None
+        self.prefetch_image_inds = None
+        
     def clear_big_features(self):
         
         print('Clearing features from memory')
@@ -384,6 +407,17 @@ class fwrf_feature_loader:
         self.prf_inds_loaded = []
         if hasattr(self,'is_defined_each_prf_batch'):
             self.is_defined_each_prf_batch = None
+        self.__clear_prefetch__()
+            
+    def __clear_prefetch__(self):
+        
+        # wait for any background loading to finish, and discard it
+        if self.prefetch_executor is not None:
+            self.prefetch_executor.shutdown(wait=True)
+        self.prefetch_executor = None
+        self.prefetch_future = None
+        self.prefetch_batch = None
+        self.prefetch_image_inds = None
         
     def get_partial_versions(self):
 
@@ -422,41 +456,84 @@ class fwrf_feature_loader:
     def __load_features_prf_batch__(self, image_inds, prf_model_index):
         
         # loading features for pRFs in batches to speed up a little
-        t = time.time()
         batch_to_use = np.where([prf_model_index in self.prf_batch_inds[bb] for \
                                      bb in range(len(self.prf_batch_inds))])[0][0]
         assert(prf_model_index in self.prf_batch_inds[batch_to_use])
+        self.features_each_prf_batch = None
+        if hasattr(self,'is_defined_each_prf_batch'):
+            self.is_defined_each_prf_batch = None
+        
+        if self.prefetch_future is not None and self.prefetch_batch==batch_to_use \
+                and np.array_equal(self.prefetch_image_inds, image_inds):
+            # this batch was already being loaded in background
+            print('Using pre-fetched features for models [%d - %d]'%\
+                   (self.prf_batch_inds[batch_to_use][0], self.prf_batch_inds[batch_to_use][-1]))
+            t = time.time()
+            values, is_defined = self.prefetch_future.result()
+            elapsed = time.time() - t
+            print('Waited %.5f seconds for pre-fetched batch'%elapsed)
+        else:
+            if self.prefetch_future is not None:
+                # a different batch was pre-fetched, discard it first so memory stays bounded
+                self.prefetch_future.cancel()
+                concurrent.futures.wait([self.prefetch_future])
+                self.prefetch_future = None
+            values, is_defined = self.__read_prf_batch__(image_inds, batch_to_use)
+        self.prefetch_future = None
+        
         self.prf_inds_loaded = self.prf_batch_inds[batch_to_use]
+        self.features_each_prf_batch = values
+        values = None
+        print('Size of features array for this image set and batch is:')
+        print(self.features_each_prf_batch.shape)
+
+        if self.use_pca_feats:
+            self.is_defined_each_prf_batch = is_defined
+            print('Number of nans in each prf this batch:')
+            print([np.sum(~d) for d in is_defined])
+            
+        if self.prefetch and batch_to_use+1 < len(self.prf_batch_inds):
+            # start loading the next batch now
+            if self.prefetch_executor is None:
+                self.prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self.prefetch_batch = batch_to_use+1
+            self.prefetch_image_inds = np.copy(image_inds)
+            self.prefetch_future = self.prefetch_executor.submit(self.__read_prf_batch__, \
+                                                                 self.prefetch_image_inds, self.prefetch_batch)
+            
+    def __read_prf_batch__(self, image_inds, batch_to_use):
+        
+        # read one batch of pRFs from disk. 
+        # doesn't change any attributes, so it is safe to run in a background thread.
         print('Loading pre-computed features for models [%d - %d] from %s'%\
                (self.prf_batch_inds[batch_to_use][0], self.prf_batch_inds[batch_to_use][-1], \
                 self.features_file))
-        self.features_each_prf_batch = None
-
+        
         t = time.time()
-        with h5py.File(self.features_file, 'r') as data_set:
-            values = np.copy(data_set['/features'][:,:,self.prf_batch_inds[batch_to_use]])
-            data_set.close() 
+        if self.prf_major_file is not None:
+            # only reads the images and pRFs that we need
+            values = prf_major_features.load_features(self.prf_major_file, image_inds, \
+                                                      self.prf_batch_inds[batch_to_use])
+        else:
+            with h5py.File(self.features_file, 'r') as data_set:
+                values = np.copy(data_set['/features'][:,:,self.prf_batch_inds[batch_to_use]])
+                data_set.close() 
+            values = values[image_inds,:,:]
         elapsed = time.time() - t
         print('Took %.5f seconds to load file'%elapsed)
 
-        self.features_each_prf_batch = values[image_inds,:,:]
-        self.features_each_prf_batch = self.features_each_prf_batch[:,0:self.max_features,:]
-        values = None
-        print('Size of features array for this image set and batch is:')
-        print(self.features_each_prf_batch.shape)
-
+        values = values[:,0:self.max_features,:]
+        
         if self.use_pca_feats:
-
             # if the features have been reduced with PCA, then they will have different dimension
             # for different pRFs. The remaining values are filled in with nans, so we need to find 
             # the non-nan values here.
-            nan_inds = [np.isnan(self.features_each_prf_batch[0,:,mm]) \
-                        for mm in range(len(self.prf_batch_inds[batch_to_use]))]
-            self.is_defined_each_prf_batch = [~n for n in nan_inds]
-                
-            print('Number of nans in each prf this batch:')
-            print([np.sum(n) for n in nan_inds])
+            is_defined = [~np.isnan(values[0,:,mm]) \
+                          for mm in range(len(self.prf_batch_inds[batch_to_use]))]
+        else:
+            is_defined = None
             
+        return values, is_defined
     
     def load(self, image_inds, prf_model_index):
          
@@ -1,6 +1,7 @@
 import sys, os
 import numpy as np
 import time, h5py
+import torch
 
 from utils import default_paths, numpy_utils, nsd_utils
 from model_fitting import initialize_fitting 
@@ -566,6 +567,307 @@ def apply_pca_oneprf(features_raw,
     
     
     
+class streaming_pca():
+    
+    """
+    PCA for features that are extracted one batch of images at a time, for a batch of pRFs,
+    so that the raw [n_images x n_features x n_prfs] features never have to be written to disk.
+    Gives the same result as run_pca_each_prf (or apply_pca_each_prf, if load_weights_filename
+    is given), but uses sums and cross-products of the features (accumulated in float64)
+    instead of the full features matrix. Needs two passes through the images:
+        first pass: add_batch() for each batch of images, then fit()
+        second pass: transform_batch() for each batch of images
+    The scores are in self.scores, use save_streaming_pca to save them.
+    
+    Z-scoring (if zscore_before_pca) is done like in run_pca_each_prf: training (fit_inds) and 
+    validation trials are z-scored separately, one mean/std for each group in zgroup_labels.
+    """
+    
+    def __init__(self, n_trials, n_features, prf_inds, fit_inds=None, \
+                 zscore_before_pca=False, zgroup_labels=None, \
+                 min_pct_var=95, max_pc_to_retain=None, \
+                 use_saved_ncomp=False, ncomp_filename=None, \
+                 load_weights_filename=None, keep_weights=True, \
+                 save_dtype=np.float32, device=None):
+        
+        self.n_trials = n_trials
+        self.n_features = n_features
+        self.prf_inds = np.array(prf_inds)
+        self.n_prfs = len(prf_inds)
+        self.min_pct_var = min_pct_var
+        self.save_dtype = save_dtype
+        self.device = device
+        
+        self.apply_weights = load_weights_filename is not None
+        if fit_inds is None or self.apply_weights:
+            # when applying saved weights, all trials are z-scored together
+            fit_inds = np.ones((n_trials,), dtype=bool)
+        assert(len(fit_inds)==n_trials)
+        self.fit_inds = np.array(fit_inds)
+        
+        if max_pc_to_retain is None:
+            max_pc_to_retain = n_features
+        else:
+            max_pc_to_retain = np.minimum(max_pc_to_retain, n_features)
+        self.max_pc_to_retain = max_pc_to_retain
+        self.n_comp = int(np.min([max_pc_to_retain, np.sum(self.fit_inds)]))
+        
+        self.zscore_before_pca = zscore_before_pca
+        if zscore_before_pca and zgroup_labels is None:
+            zgroup_labels = np.ones(shape=(1,n_features))
+        if zscore_before_pca:
+            zgroup_labels = np.squeeze(zgroup_labels)[0:n_features]
+            self.zgroups = [np.where(zgroup_labels==gg)[0] for gg in np.unique(zgroup_labels)]
+        
+        if use_saved_ncomp:
+            print('loading ncomp from %s'%ncomp_filename)
+            self.saved_ncomp = np.load(ncomp_filename).astype(int)[self.prf_inds]
+        else:
+            self.saved_ncomp = None
+            
+        self.load_weights_filename = load_weights_filename
+        self.keep_weights = keep_weights
+        
+        # the weights (if applying saved ones) and the sums/cross-products are only made 
+        # when the first batch comes in (see __init_accumulators__), so that many of these 
+        # can be created ahead of time without using memory.
+        self.sums = None
+        
+        self.scores = None
+        
+    def __init_accumulators__(self):
+        
+        if self.apply_weights:
+            print('loading pre-computed pca weights from %s'%(self.load_weights_filename))
+            w = np.load(self.load_weights_filename, allow_pickle=True).item()
+            assert(len(w['pca_wts'].shape)==3)
+            self.ncomp = np.array(w['pca_ncomp'][self.prf_inds]).astype(int)
+            # wts is [n_prfs x n_features x n_components], only the components that are used
+            self.wts = torch.tensor(np.moveaxis(w['pca_wts'][:,0:np.max(self.ncomp),self.prf_inds], [2], [0]), \
+                                    dtype=torch.float32, device=self.device)
+            self.pre_mean = torch.tensor(w['pca_premean'][:,self.prf_inds].T, \
+                                         dtype=torch.float32, device=self.device)
+            w = None
+        
+        # sums over trials, separately for trn (fit_inds) and val trials.
+        # features are shifted by the first trial seen, to keep sums of squares accurate.
+        self.shift = None
+        self.counts = [0, 0]
+        self.sums = [torch.zeros((self.n_prfs, self.n_features), dtype=torch.float64, device=self.device) \
+                     for ii in range(2)]
+        self.sumsq = [torch.zeros((self.n_prfs, self.n_features), dtype=torch.float64, device=self.device) \
+                      for ii in range(2)]
+        if not self.apply_weights:
+            # cross-products for trn trials only, [n_prfs x n_features x n_features]
+            self.xprod = torch.zeros((self.n_prfs, self.n_features, self.n_features), \
+                                     dtype=torch.float64, device=self.device)
+            
+    def __get_trial_sets__(self, batch_inds):
+        
+        is_trn = self.fit_inds[batch_inds]
+        return [np.where(is_trn)[0], np.where(~is_trn)[0]]
+    
+    def __to_torch__(self, features):
+        
+        # features come in as [n_images x n_features x n_prfs], make them [n_prfs x n_images x n_features]
+        if not torch.is_tensor(features):
+            features = torch.tensor(features)
+        return torch.moveaxis(features.to(device=self.device, dtype=torch.float32), [2], [0])
+        
+    def add_batch(self, features, batch_inds):
+        
+        if self.sums is None:
+            self.__init_accumulators__()
+        _features = self.__to_torch__(features)
+        if self.shift is None:
+            self.shift = _features[:,0:1,:].clone()
+        _features = _features - self.shift
+        
+        for si, inds in enumerate(self.__get_trial_sets__(batch_inds)):
+            if len(inds)==0:
+                continue
+            _f = _features[:,inds,:]
+            self.counts[si] += len(inds)
+            self.sums[si] += torch.sum(_f, dim=1).double()
+            self.sumsq[si] += torch.sum(_f**2, dim=1).double()
+            if si==0 and not self.apply_weights:
+                self.xprod += (_f.transpose(1,2) @ _f).double()
+                
+    def __get_zscore_pars__(self, si):
+        
+        # mean and variance of each feature (column), for one set of trials.
+        n = self.counts[si]
+        col_mean_shifted = self.sums[si]/n
+        col_var = self.sumsq[si]/n - col_mean_shifted**2
+        col_mean = col_mean_shifted + self.shift[:,0,:].double()
+        
+        # one mean/std for each group of columns, same as numpy_utils.zscore_in_groups
+        z_mean = torch.zeros_like(col_mean)
+        z_std = torch.ones_like(col_mean)
+        if self.zscore_before_pca:
+            for cols in self.zgroups:
+                group_mean = torch.mean(col_mean[:,cols], dim=1, keepdim=True)
+                group_var = torch.mean(col_var[:,cols] + (col_mean[:,cols] - group_mean)**2, dim=1, keepdim=True)
+                z_mean[:,cols] = group_mean
+                z_std[:,cols] = torch.sqrt(group_var)
+                
+        zero_var = col_var <= 0
+        
+        return col_mean, z_mean, z_std, zero_var
+    
+    def fit(self):
+        
+        self.zpars = [self.__get_zscore_pars__(si) if self.counts[si]>0 else None for si in range(2)]
+        
+        if self.zscore_before_pca and not self.apply_weights:
+            # columns with no variance (in trn or val) don't contribute to the pca
+            self.zero_var = self.zpars[0][3]
+            if self.zpars[1] is not None:
+                self.zero_var = self.zero_var | self.zpars[1][3]
+            print('there are [%s] columns with zero variance'%(torch.sum(self.zero_var, dim=1).cpu().numpy()))
+        else:
+            self.zero_var = torch.zeros((self.n_prfs, self.n_features), dtype=bool, device=self.device)
+        
+        if not self.apply_weights:
+            
+            n = self.counts[0]
+            col_mean, z_mean, z_std, _ = self.zpars[0]
+            col_mean_shifted = self.sums[0]/n
+            cov = self.xprod/n - col_mean_shifted[:,:,None] * col_mean_shifted[:,None,:]
+            cov = cov / (z_std[:,:,None] * z_std[:,None,:])
+            cov[self.zero_var[:,:,None].expand(cov.shape)] = 0
+            cov[self.zero_var[:,None,:].expand(cov.shape)] = 0
+            
+            print('Running PCA for %d pRFs: size of covariance matrix is [%d x %d]'\
+                  %(self.n_prfs, self.n_features, self.n_features))
+            t = time.time()
+            evals, evecs = torch.linalg.eigh(cov)
+            # largest components first
+            evals = torch.flip(evals, dims=[1])[:,0:self.n_comp]
+            evecs = torch.flip(evecs, dims=[2])[:,:,0:self.n_comp]
+            # same sign convention as sklearn: largest abs value of each component is positive
+            max_inds = torch.argmax(torch.abs(evecs), dim=1, keepdim=True)
+            evecs = evecs * torch.sign(torch.gather(evecs, 1, max_inds))
+            print('Time elapsed: %.5f'%(time.time() - t))
+            
+            self.wts = evecs.float()
+            self.pre_mean = ((col_mean - z_mean)/z_std).float()
+            ev = torch.clamp(evals, min=0)
+            ev = (ev/torch.sum(ev, dim=1, keepdim=True)*100).cpu().numpy()
+            
+            if self.saved_ncomp is not None:
+                self.ncomp = self.saved_ncomp
+            else:
+                self.ncomp = np.zeros((self.n_prfs,), dtype=int)
+                for mm in range(self.n_prfs):
+                    n_comp_needed = np.where(np.cumsum(ev[mm,:])>self.min_pct_var)
+                    if np.size(n_comp_needed)>0:
+                        self.ncomp[mm] = n_comp_needed[0][0]+1
+                    else:
+                        self.ncomp[mm] = self.n_comp
+            print('Retaining [%s] components to explain %d pct var'%(self.ncomp, self.min_pct_var))
+            
+        self.scores = np.zeros((self.n_trials, np.max(self.ncomp), self.n_prfs), dtype=self.save_dtype)
+        for mm in range(self.n_prfs):
+            self.scores[:,self.ncomp[mm]:,mm] = np.nan
+        
+        # don't need these anymore
+        self.xprod = None
+        
+    def transform_batch(self, features, batch_inds):
+        
+        _features = self.__to_torch__(features)
+        n_comp_keep = np.max(self.ncomp)
+        _wts = self.wts[:,:,0:n_comp_keep]
+        
+        for si, inds in enumerate(self.__get_trial_sets__(batch_inds)):
+            if len(inds)==0:
+                continue
+            _, z_mean, z_std, _ = self.zpars[si]
+            _f = (_features[:,inds,:] - z_mean[:,None,:].float()) / z_std[:,None,:].float()
+            _f = _f - self.pre_mean[:,None,:]
+            _f[self.zero_var[:,None,:].expand(_f.shape)] = 0
+            # scores is [n_prfs x n_images x n_components]
+            _scores = (_f @ _wts).cpu().numpy()
+            for mm in range(self.n_prfs):
+                self.scores[batch_inds[inds],0:self.ncomp[mm],mm] = _scores[mm,:,0:self.ncomp[mm]]
+                
+    def finish(self):
+        
+        """
+        Call after the second pass (transform_batch for all images). Frees everything except 
+        the scores, and the weights if they are needed for saving (moved to cpu, only the 
+        retained components).
+        """
+        
+        if self.keep_weights:
+            n_comp_keep = np.max(self.ncomp)
+            self.wts = self.wts[:,:,0:n_comp_keep].cpu()
+            self.pre_mean = self.pre_mean.cpu()
+        else:
+            self.wts = None
+            self.pre_mean = None
+        self.sums = None; self.sumsq = None; self.shift = None
+        self.zpars = None; self.zero_var = None
+        
+    def get_weights(self):
+        
+        # in same format as run_pca_each_prf: wts are [n_features x n_components x n_prfs]
+        wts = torch.moveaxis(self.wts, [0], [2]).cpu().numpy()
+        pre_mean = self.pre_mean.T.cpu().numpy()
+        
+        return wts, pre_mean, self.ncomp
+        
+
+def save_streaming_pca(pca_list, pca_filename, save_weights=False, save_weights_filename=None, \
+                       save_dtype=np.float32, compress=True):
+    
+    """
+    Gather the scores from a list of streaming_pca objects (one per batch of pRFs, in order), 
+    and save them in the same format as run_pca_each_prf.
+    """
+    
+    n_trials = pca_list[0].n_trials
+    n_prfs = np.sum([pca.n_prfs for pca in pca_list])
+    actual_max_ncomp = np.max([np.max(pca.ncomp) for pca in pca_list])
+    
+    scores_each_prf = np.full((n_trials, actual_max_ncomp, n_prfs), np.nan, dtype=save_dtype)
+    for pca in pca_list:
+        scores_each_prf[:,0:pca.scores.shape[1],pca.prf_inds] = pca.scores
+        
+    print('final size of array to save:')
+    print(scores_each_prf.shape)    
+    print('saving to %s'%pca_filename)
+    
+    t = time.time()
+    
+    with h5py.File(pca_filename, 'w') as data_set:
+        if compress==True:
+            dset = data_set.create_dataset("features", np.shape(scores_each_prf), dtype=save_dtype, compression='gzip')
+        else:
+            dset = data_set.create_dataset("features", np.shape(scores_each_prf), dtype=save_dtype)
+        data_set['/features'][:,:,:] = scores_each_prf
+        data_set.close() 
+    elapsed = time.time() - t
+
+    print('Took %.5f sec to write file'%elapsed)
+    
+    if save_weights:
+        n_features = pca_list[0].n_features
+        max_pc_to_retain = pca_list[0].max_pc_to_retain
+        pca_wts = np.zeros((n_features, max_pc_to_retain, n_prfs), dtype=save_dtype)
+        pca_premean = np.zeros((n_features, n_prfs), dtype=save_dtype)
+        pca_ncomp = np.zeros((n_prfs,),dtype=save_dtype)
+        for pca in pca_list:
+            wts, pre_mean, ncomp = pca.get_weights()
+            pca_wts[:,0:wts.shape[1],pca.prf_inds] = wts
+            pca_premean[:,pca.prf_inds] = pre_mean
+            pca_ncomp[pca.prf_inds] = ncomp
+        wts = {'pca_wts': pca_wts, 'pca_premean': pca_premean, 'pca_ncomp': pca_ncomp}
+        print('saving the weights for this pca to %s'%save_weights_filename)
+        np.save(save_weights_filename, wts, allow_pickle=True)
+    
+    
 def run_pca(subject=None, \
             image_set=None, \
             feature_type=None, \
@@ -0,0 +1,203 @@
+import sys, os
+import numpy as np
+import time, h5py
+import argparse
+
+os.environ["HDF5_USE_FILE_LOCKING"] = "FALSE"
+
+"""
+Code to convert pre-computed feature files into a "pRF-major" layout, and to read from them.
+Original files have a '/features' dataset that is [n_images x n_features x n_prfs].
+Reading one batch of pRFs from these means reading (and decompressing) all images, even if we
+only need a few of them.
+The pRF-major files have a '/features_prfmajor' dataset that is [n_prfs x n_images x n_features].
+If saved without compression, the dataset is contiguous and can be memory-mapped, so only the
+requested images and pRFs are ever read from disk. If compressed, each chunk is one pRF and a
+block of images, so only the chunks that have the requested images get decompressed.
+The shape and modification time of the original file are saved with the pRF-major file, so
+a pRF-major file that is out of date with its original can be detected (see is_up_to_date).
+"""
+
+def get_prf_major_filename(features_file):
+
+    return features_file.split('.h5py')[0] + '_prfmajor.h5py'
+
+
+def get_source_info(features_file):
+
+    with h5py.File(features_file, 'r') as data_set:
+        shape = data_set['/features'].shape
+        data_set.close()
+
+    return np.array(shape), os.path.getmtime(features_file)
+
+
+def is_up_to_date(prf_major_file, features_file):
+
+    """
+    Check whether a pRF-major file was made from the current version of features_file
+    (same shape and modification time as when it was converted).
+    """
+
+    shape, mtime = get_source_info(features_file)
+
+    with h5py.File(prf_major_file, 'r') as data_set:
+        attrs = data_set['/features_prfmajor'].attrs
+        if ('source_shape' not in attrs.keys()) or ('source_mtime' not in attrs.keys()):
+            # converted before these were saved, can't tell
+            up_to_date = False
+        else:
+            up_to_date = np.array_equal(attrs['source_shape'], shape) and \
+                         attrs['source_mtime']==mtime
+        data_set.close()
+
+    return up_to_date
+
+
+def convert_to_prf_major(features_file, filename_save=None, \
+                         compression=None, prf_batch_size=100, \
+                         image_chunk_size=None, overwrite=False):
+
+    """
+    Convert a file with [n_images x n_features x n_prfs] features into the pRF-major layout.
+    compression=None makes a contiguous (memory-mappable) dataset,
+    compression='gzip' makes a dataset chunked as [1 x image_chunk_size x n_features]
+    (default image_chunk_size gives chunks of about 1 MB).
+    An existing file is only kept if it is up to date with features_file.
+    """
+
+    if filename_save is None:
+        filename_save = get_prf_major_filename(features_file)
+    if os.path.exists(filename_save) and not overwrite:
+        if is_up_to_date(filename_save, features_file):
+            print('%s already exists, skipping'%filename_save)
+            return filename_save
+        print('%s is out of date with %s, will overwrite'%(filename_save, features_file))
+
+    source_shape, source_mtime = get_source_info(features_file)
+    n_images, n_features, n_prfs = source_shape
+
+    print('Converting %s (%d images, %d features, %d prfs)'%(features_file, n_images, n_features, n_prfs))
+    print('Writing to %s'%filename_save)
+
+    if compression is None:
+        chunks = None
+    else:
+        if image_chunk_size is None:
+            image_chunk_size = int(np.max([1, 2**18 // n_features]))
+        chunks = (1, int(np.min([image_chunk_size, n_images])), n_features)
+
+    n_prf_batches = int(np.ceil(n_prfs/prf_batch_size))
+    prf_batch_inds = [np.arange(prf_batch_size*bb, np.min([prf_batch_size*(bb+1), n_prfs])) \
+                           for bb in range(n_prf_batches)]
+
+    t = time.time()
+    with h5py.File(filename_save, 'w') as data_set_save:
+
+        dset = data_set_save.create_dataset("features_prfmajor", (n_prfs, n_images, n_features), \
+                                            dtype=np.float32, chunks=chunks, compression=compression)
+        dset.attrs['source_file'] = features_file
+        dset.attrs['source_shape'] = source_shape
+        dset.attrs['source_mtime'] = source_mtime
+
+        for bb, batch in enumerate(prf_batch_inds):
+
+            print('converting prfs [%d - %d]'%(batch[0], batch[-1]))
+            sys.stdout.flush()
+            with h5py.File(features_file, 'r') as data_set:
+                values = np.copy(data_set['/features'][:,:,batch[0]:batch[-1]+1])
+                data_set.close()
+
+            dset[batch[0]:batch[-1]+1,:,:] = np.moveaxis(values, 2, 0)
+            values = None
+
+        data_set_save.close()
+
+    elapsed = time.time() - t
+    print('Took %.5f sec to write file'%elapsed)
+
+    return filename_save
+
+
+def load_features(filename, image_inds, prf_inds):
+
+    """
+    Load features for a set of images and pRFs from a pRF-major file.
+    Only the requested pRFs are read, and only the requested images too (using a memory map
+    if the file is uncompressed, or only the chunks that have those images if compressed).
+    Returns [n_images x n_features x n_prfs], same as the original file layout.
+    """
+
+    prf_inds = np.array(prf_inds)
+    image_inds = np.array(image_inds)
+    # h5py needs increasing indices to do selection
+    prf_inds_unique, prf_order = np.unique(prf_inds, return_inverse=True)
+
+    with h5py.File(filename, 'r') as data_set:
+
+        dset = data_set['/features_prfmajor']
+        offset = dset.id.get_offset()
+
+        if dset.chunks is None and offset is not None:
+            # contiguous dataset, can memory-map it and take just the values we need.
+            mm = np.memmap(filename, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+            values = np.array(mm[np.ix_(prf_inds_unique, image_inds)])
+            mm = None
+        else:
+            # chunked - read only the chunks that have these pRFs and images.
+            if np.all(np.diff(prf_inds_unique)==1):
+                prf_sel = slice(prf_inds_unique[0], prf_inds_unique[-1]+1)
+            else:
+                prf_sel = prf_inds_unique
+            n_images_total = dset.shape[1]
+            chunk_size = dset.chunks[1]
+            # find runs of consecutive image chunks that are needed, read each run at once.
+            chunk_inds = np.unique(image_inds // chunk_size)
+            runs = np.split(chunk_inds, np.where(np.diff(chunk_inds)>1)[0]+1)
+            values = []
+            images_read = []
+            for run in runs:
+                start = run[0]*chunk_size
+                stop = int(np.min([(run[-1]+1)*chunk_size, n_images_total]))
+                values += [dset[prf_sel, start:stop, :]]
+                images_read += [np.arange(start, stop)]
+            values = np.concatenate(values, axis=1)
+            images_read = np.concatenate(images_read)
+            values = values[:,np.searchsorted(images_read, image_inds),:]
+
+        data_set.close()
+
+    values = values[prf_order]
+
+    # [n_prfs x n_images x n_features] to [n_images x n_features x n_prfs]
+    return np.ascontiguousarray(np.moveaxis(values, 0, 2))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--features_file", type=str, nargs='+',
+                    help="name of the feature file(s) to convert")
+    parser.add_argument("--compression", type=str, default='none',
+                    help="compression for new file? 'none' makes a memory-mappable file, or 'gzip'")
+    parser.add_argument("--prf_batch_size", type=int, default=100,
+                    help="how many pRFs to convert at once?")
+    parser.add_argument("--image_chunk_size", type=int, default=0,
+                    help="how many images in each chunk, if compressing? 0 for default (about 1 MB chunks)")
+    parser.add_argument("--overwrite", type=int, default=0,
+                    help="want to overwrite existing pRF-major files? 1 for yes, 0 for no")
+
+    args = parser.parse_args()
+
+    if args.compression=='none':
+        args.compression = None
+    if args.image_chunk_size==0:
+        args.image_chunk_size = None
+
+    for fn in args.features_file:
+
+        convert_to_prf_major(fn, compression=args.compression, \
+                             prf_batch_size=args.prf_batch_size, \
+                             image_chunk_size=args.image_chunk_size, \
+                             overwrite=args.overwrite==1)
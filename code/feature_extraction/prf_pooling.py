@@ -0,0 +1,150 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+"""
+Pytorch module that pools feature maps within each pRF, for many pRFs at once.
+Used by the feature extractors (gabor, color, sketch tokens, alexnet, resnet) in place
+of multiplying the full feature maps by one pRF mask at a time.
+"""
+
+class prf_pooler(nn.Module):
+
+    """
+    Module to get the pRF-weighted spatial pooling of feature maps, for a set of pRFs.
+    The pRFs are the same as prf_utils.gauss_2d (isotropic gaussian), which is separable
+    in x and y: pRF = gy * gx^T. So pooling can be done as gy^T * maps * gx, and any pRFs
+    that have the same x (or y) profile share that part of the work.
+    Input parameters:
+        prf_params     ~ [n_prfs x 3] array, columns are [x, y, sigma]
+        n_pix          ~ size of the feature maps that will be pooled (n_pix x n_pix)
+        aperture       ~ number of arbitrary "units" occupied by the whole image (see gauss_2d)
+        prf_scaling    ~ 'max' means each pRF is scaled to range [0,1], and the weighted maps are
+                         averaged over space (this is what the CNN feature extractors do).
+                         'sum' means each pRF sums to 1, and the weighted maps are summed over space.
+        engine         ~ 'separable' does two small contractions, sharing the x profiles across pRFs.
+                         'dense' does one matrix multiplication with a [n_prfs x n_pix x n_pix] stack.
+                         'auto' picks separable if it saves at least half the multiplications
+                         (i.e. if many pRFs share x positions and sizes, as in cartesian grids),
+                         and maps are at least min_pix_separable pixels. For small maps one big matrix
+                         multiplication is faster than many small ones (see benchmark_prf_pooling.py).
+        min_pix_separable ~ smallest maps that 'auto' will use the separable engine for.
+        max_elements   ~ limit on the size of intermediate arrays, to bound memory. In dense mode,
+                         if the whole pRF stack is bigger than this it is made in batches of pRFs.
+        device         ~ Device that the module's parameters will be on (i.e. cpu or cuda)
+    Input to forward is [n_images x n_features x n_pix x n_pix]
+    (or [n_images x n_pix x n_pix x n_features] if channels_last=True)
+    Returns [n_images x n_features x n_prfs]
+    """
+
+    def __init__(self, prf_params, n_pix, aperture=1.0, prf_scaling='max', engine='auto', \
+                 min_pix_separable=64, max_elements=2**26, device=None):
+
+        super(prf_pooler, self).__init__()
+
+        if prf_scaling not in ['max', 'sum']:
+            raise ValueError('prf_scaling must be "max" or "sum"')
+        if engine not in ['auto', 'separable', 'dense']:
+            raise ValueError('engine must be "auto", "separable" or "dense"')
+
+        prf_params = np.asarray(prf_params, dtype=np.float64)
+        self.n_prfs = prf_params.shape[0]
+        self.n_pix = n_pix
+        self.prf_scaling = prf_scaling
+        self.max_elements = max_elements
+
+        # 1D profiles, same grid as in gauss_2d (note y coordinate is negated there)
+        coords = np.linspace(-aperture/2, aperture/2, n_pix)
+
+        # unique [x, sigma] combinations, since these will share the first contraction
+        x_sigma_unique, prf_x_inds = np.unique(prf_params[:,[0,2]], axis=0, return_inverse=True)
+        prf_x_inds = np.ravel(prf_x_inds)
+        gx = np.exp(-(coords[None,:] - x_sigma_unique[:,0:1])**2 / (2*x_sigma_unique[:,1:2]**2))
+        gy = np.exp(-(coords[None,:] + prf_params[:,1:2])**2 / (2*prf_params[:,2:3]**2))
+        # gx is [n_unique_x x n_pix], gy is [n_prfs x n_pix]
+
+        # values too small for float32 are set to zero, since denormals make matrix multiplication very slow.
+        tiny = np.finfo(np.float32).tiny
+        gx[gx<tiny] = 0
+        gy[gy<tiny] = 0
+
+        gx_each_prf = gx[prf_x_inds,:]
+        if prf_scaling=='max':
+            # (prf - min)/max(prf - min), then average over pixels
+            offset = np.min(gy, axis=1) * np.min(gx_each_prf, axis=1)
+            scale = 1/((np.max(gy, axis=1) * np.max(gx_each_prf, axis=1) - offset) * n_pix**2)
+        else:
+            # prf/sum(prf)
+            offset = np.zeros((self.n_prfs,))
+            scale = 1/(np.sum(gy, axis=1) * np.sum(gx_each_prf, axis=1))
+
+        if engine=='auto':
+            n_mult_separable = len(x_sigma_unique)*n_pix + self.n_prfs
+            n_mult_dense = self.n_prfs * n_pix
+            use_separable = (n_mult_separable < n_mult_dense/2) and (n_pix >= min_pix_separable)
+            engine = 'separable' if use_separable else 'dense'
+        self.engine = engine
+
+        self.register_buffer('gx', torch.tensor(gx, dtype=torch.float32, device=device))
+        self.register_buffer('gy', torch.tensor(gy, dtype=torch.float32, device=device))
+        self.register_buffer('offset', torch.tensor(offset, dtype=torch.float32, device=device))
+        self.register_buffer('scale', torch.tensor(scale, dtype=torch.float32, device=device))
+        self.register_buffer('prf_x_inds', torch.tensor(prf_x_inds, device=device))
+        # list of which pRFs go with each x profile
+        self.prfs_each_x = [torch.tensor(np.where(prf_x_inds==uu)[0], device=device) \
+                            for uu in range(len(x_sigma_unique))]
+
+        if self.engine=='dense' and (self.n_prfs * n_pix**2 <= max_elements):
+            # small enough to keep the whole [n_prfs x n_pix**2] stack
+            self.register_buffer('stack', self.__make_stack__(np.arange(self.n_prfs)))
+        else:
+            # otherwise the stack is made in batches of pRFs, during forward
+            self.stack = None
+
+    def __make_stack__(self, prf_inds):
+
+        _gx = self.gx[self.prf_x_inds[prf_inds],:]
+        _gy = self.gy[prf_inds,:]
+        _stack = (_gy[:,:,None] * _gx[:,None,:] - self.offset[prf_inds,None,None]) \
+                    * self.scale[prf_inds,None,None]
+        _stack[torch.abs(_stack)<np.finfo(np.float32).tiny] = 0
+
+        return _stack.reshape([len(prf_inds), self.n_pix**2])
+
+    def forward(self, maps, channels_last=False):
+
+        if channels_last:
+            maps = maps.permute(0,3,1,2)
+        n_images, n_features = maps.shape[0:2]
+        assert(maps.shape[2]==self.n_pix and maps.shape[3]==self.n_pix)
+
+        if self.engine=='dense':
+            _maps = maps.reshape([n_images*n_features, self.n_pix**2])
+            if self.stack is not None:
+                _features = _maps @ self.stack.T
+            else:
+                _features = torch.zeros((n_images*n_features, self.n_prfs), dtype=maps.dtype, device=maps.device)
+                prf_batch_size = int(np.max([1, self.max_elements // self.n_pix**2]))
+                for p0 in range(0, self.n_prfs, prf_batch_size):
+                    prf_inds = np.arange(p0, np.min([p0+prf_batch_size, self.n_prfs]))
+                    _features[:,prf_inds] = _maps @ self.__make_stack__(prf_inds).T
+        else:
+            _maps = maps.reshape([n_images*n_features, self.n_pix, self.n_pix])
+            _features = torch.zeros((n_images*n_features, self.n_prfs), dtype=maps.dtype, device=maps.device)
+            # first contraction is [n_pix(y) x n_pix(x)] x [n_pix(x) x n_unique_x],
+            # batched over x profiles so the intermediate stays below max_elements.
+            n_x = len(self.prfs_each_x)
+            x_batch_size = int(np.max([1, self.max_elements // (n_images*n_features*self.n_pix)]))
+            for x0 in range(0, n_x, x_batch_size):
+                x1 = int(np.min([x0+x_batch_size, n_x]))
+                _mx = _maps @ self.gx[x0:x1,:].T # [n_images*n_features x n_pix(y) x n_x_batch]
+                for uu in range(x0, x1):
+                    prf_inds = self.prfs_each_x[uu]
+                    # second contraction over y, for all pRFs with this x profile
+                    _features[:,prf_inds] = _mx[:,:,uu-x0] @ self.gy[prf_inds,:].T
+                _mx = None
+            if self.prf_scaling=='max':
+                _features = _features - torch.sum(_maps, dim=(1,2))[:,None] * self.offset[None,:]
+            _features = _features * self.scale[None,:]
+
+        return _features.reshape([n_images, n_features, self.n_prfs])
@@ -0,0 +1,115 @@
+import numpy as np
+import sys
+import time
+import h5py
+
+"""
+Code to regress one set of features out of another (e.g. sketch tokens features with the
+gabor features regressed out), separately for each pRF.
+Works with any two feature loaders that have the same pRFs (see fwrf_features.py).
+"""
+
+def get_residuals(X, Y, fit_inds, add_bias=True):
+
+    """
+    Regress each column of Y on the columns of X, fitting on the trials in fit_inds,
+    and return residuals for all trials.
+    The pseudo-inverse of X is only computed once, and then used for all columns of Y
+    (same solution as doing np.linalg.pinv(X[fit_inds,:]) @ y for each column separately).
+    Inputs:
+        X ~ [n_trials x n_predictors]
+        Y ~ [n_trials x n_targets]
+        fit_inds ~ which trials to fit the regression on (boolean or indices)
+        add_bias ~ include an intercept column in X?
+    Returns:
+        resid ~ [n_trials x n_targets] (Y - Yhat)
+        r2 ~ [n_targets], how much variance in each column of Y is explained by X
+             (over all trials).
+    """
+
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    n_trials = X.shape[0]
+    assert(Y.shape[0]==n_trials)
+
+    if add_bias:
+        X = np.concatenate([X, np.ones((n_trials,1))], axis=1)
+
+    # [n_predictors x n_fit_trials], one factorization for all targets
+    X_pinv = np.linalg.pinv(X[fit_inds,:])
+
+    coeffs = X_pinv @ Y[fit_inds,:]
+    # make predictions for whole data set
+    Yhat = X @ coeffs
+    resid = Y - Yhat
+
+    ssr = np.sum(resid**2, axis=0)
+    sst = np.sum((Y - np.mean(Y, axis=0, keepdims=True))**2, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = 1 - ssr/sst
+
+    return resid, r2
+
+
+def residualize_features(feat_loader_target, feat_loader_predictors, image_inds, fit_inds, \
+                         fn2save, debug=False, dtype=np.float32):
+
+    """
+    For each pRF, regress the features from feat_loader_predictors out of the features
+    from feat_loader_target, and save the residuals to fn2save (in same format as the
+    other features files, [n_trials x n_features x n_prfs] in '/features').
+    Goes through pRFs in the same batches as feat_loader_target, so that the loaders
+    each read one batch of pRFs at a time from their files, and the residuals for each
+    batch are written before moving on (whole array never in memory).
+    Returns r2 [n_target_features x n_prfs].
+    """
+
+    n_trials = len(image_inds)
+    n_feats = feat_loader_target.max_features
+    n_prfs = feat_loader_target.n_prfs
+    assert(feat_loader_predictors.n_prfs==n_prfs)
+
+    r2_vals = np.zeros((n_feats, n_prfs), dtype=dtype)
+
+    print('Writing residual features to %s\n'%fn2save)
+    t = time.time()
+    with h5py.File(fn2save, 'w') as data_set:
+
+        dset = data_set.create_dataset("features", (n_trials, n_feats, n_prfs), dtype=dtype)
+
+        for bb, prf_batch_inds in enumerate(feat_loader_target.prf_batch_inds):
+
+            if debug and bb>0:
+                continue
+
+            resid_batch = np.zeros((n_trials, n_feats, len(prf_batch_inds)), dtype=dtype)
+
+            for mi, mm in enumerate(prf_batch_inds):
+
+                if debug and mm>1:
+                    continue
+
+                feat_target, target_inds_defined = feat_loader_target.load(image_inds, prf_model_index=mm)
+                feat_pred, _ = feat_loader_predictors.load(image_inds, prf_model_index=mm)
+
+                print('pRF %d of %d - size of features are'%(mm, n_prfs))
+                print(feat_target.shape)
+                print(feat_pred.shape)
+                sys.stdout.flush()
+
+                resid, r2 = get_residuals(feat_pred, feat_target, fit_inds)
+
+                resid_batch[:,target_inds_defined,mi] = resid
+                r2_vals[target_inds_defined,mm] = r2
+
+            data_set['/features'][:,:,prf_batch_inds] = resid_batch
+
+        data_set.close()
+
+    elapsed = time.time() - t
+    print('time elapsed to compute and save: %.5f'%elapsed)
+
+    feat_loader_target.clear_big_features()
+    feat_loader_predictors.clear_big_features()
+
+    return r2_vals
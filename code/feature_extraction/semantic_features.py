@@ -2,7 +2,7 @@ import numpy as np
 import os
 import pandas as pd
 
-from utils import default_paths, nsd_utils
+from utils import default_paths, nsd_utils, label_utils
 from model_fitting import initialize_fitting
 
 class semantic_feature_loader:
@@ -78,8 +78,7 @@ class semantic_feature_loader:
                                   'S%d_realworldsize_prf0.csv'%(self.subject))          
                 self.n_features = 3
             elif 'coco_things' in self.feature_set:
-                self.features_file = os.path.join(self.labels_folder, \
-                                  'S%d_cocolabs_binary_prf0.csv'%(self.subject))
+                self.features_file = self.__get_coco_labels_file__(stuff=False)
                 
                 if 'supcateg' in self.feature_set:                    
                     self.n_features = 12
@@ -102,15 +101,13 @@ class semantic_feature_loader:
                     self.n_features = 80
                     
             elif 'coco_stuff' in self.feature_set:
-                self.features_file = os.path.join(self.labels_folder, \
-                                  'S%d_cocolabs_stuff_binary_prf0.csv'%(self.subject))
+                self.features_file = self.__get_coco_labels_file__(stuff=True)
                 if 'supcateg' in self.feature_set:                    
                     self.n_features = 16
                 else:
                     self.n_features = 92           
             else:
-                self.features_file = os.path.join(self.labels_folder, \
-                                      'S%d_cocolabs_binary_prf0.csv'%(self.subject))
+                self.features_file = self.__get_coco_labels_file__(stuff=False)
                 self.n_features = 2
     
         self.max_features = self.n_features
@@ -120,6 +117,20 @@ class semantic_feature_loader:
 
         self.features_in_prf = None
         
+    def __get_coco_labels_file__(self, stuff):
+        
+        # use the packed labels file for all pRFs if it exists, otherwise the csv files.
+        packed_file = os.path.join(self.labels_folder, \
+                                   label_utils.get_packed_labels_filename(self.subject, stuff))
+        if os.path.exists(packed_file):
+            return packed_file
+        elif stuff:
+            return os.path.join(self.labels_folder, \
+                                'S%d_cocolabs_stuff_binary_prf0.csv'%(self.subject))
+        else:
+            return os.path.join(self.labels_folder, \
+                                'S%d_cocolabs_binary_prf0.csv'%(self.subject))
+        
     def __get_categ_exclude__(self):
         
         if self.remove_missing:
@@ -184,28 +195,23 @@ class semantic_feature_loader:
                 labels = np.array(size_df).astype(np.float32)
                 colnames = list(size_df.keys())
             elif 'coco_stuff' in self.feature_set:
-                self.features_file = os.path.join(self.labels_folder, \
-                                  'S%d_cocolabs_stuff_binary_prf%d.csv'%(self.subject, \
-                                                                         prf_model_index))
-                print('Loading pre-computed features from %s'%self.features_file)
-                coco_df = pd.read_csv(self.features_file, index_col=0)
+                coco_labels, coco_colnames = label_utils.load_binary_labels_within_prf(self.subject, \
+                                                 self.which_prf_grid, prf_model_index, stuff=True, verbose=True)
                 if 'supcateg' in self.feature_set:
-                    labels = np.array(coco_df)[:,0:16]
-                    colnames = list(coco_df.keys())[0:16]
+                    labels = coco_labels[:,0:16]
+                    colnames = coco_colnames[0:16]
                 else:
-                    labels = np.array(coco_df)[:,16:]   
-                    colnames = list(coco_df.keys())[16:]
+                    labels = coco_labels[:,16:]   
+                    colnames = coco_colnames[16:]
             else:
-                self.features_file = os.path.join(self.labels_folder, \
-                                  'S%d_cocolabs_binary_prf%d.csv'%(self.subject, prf_model_index))
-                print('Loading pre-computed features from %s'%self.features_file)
-                coco_df = pd.read_csv(self.features_file, index_col=0)
+                coco_labels, coco_colnames = label_utils.load_binary_labels_within_prf(self.subject, \
+                                                 self.which_prf_grid, prf_model_index, stuff=False, verbose=True)
                 if 'supcateg' in self.feature_set:
-                    labels = np.array(coco_df)[:,0:12]
-                    colnames = list(coco_df.keys())[0:12]
+                    labels = coco_labels[:,0:12]
+                    colnames = coco_colnames[0:12]
                 elif 'categ' in self.feature_set:
-                    labels = np.array(coco_df)[:,12:92]   
-                    colnames = list(coco_df.keys())[12:92]
+                    labels = coco_labels[:,12:92]   
+                    colnames = coco_colnames[12:92]
                     if 'material_diagnostic' in self.feature_set:
                         colnames = [cc.split('.1')[0] for cc in colnames]
                         columns_use = np.isin(colnames, self.categ_names_use)
@@ -214,7 +220,7 @@ class semantic_feature_loader:
                         colnames = np.array(colnames)[columns_use]
                    
                 elif self.feature_set=='animacy':    
-                    supcat_labels = np.array(coco_df)[:,0:12]
+                    supcat_labels = coco_labels[:,0:12]
                     animate_supcats = [1,9]
                     inanimate_supcats = [ii for ii in range(12)\
                                          if ii not in animate_supcats]
@@ -227,8 +233,8 @@ class semantic_feature_loader:
                     colnames = ['has_animate','has_inanimate']
                  
                 else:
-                    has_label = np.any(np.array(coco_df)[:,0:12]==1, axis=1)
-                    label1 = np.array(coco_df[self.feature_set])[:,np.newaxis]
+                    has_label = np.any(coco_labels[:,0:12]==1, axis=1)
+                    label1 = coco_labels[:,coco_colnames.index(self.feature_set)][:,np.newaxis]
                     label2 = (label1==0) & (has_label[:,np.newaxis])
                     labels = np.concatenate([label1, label2], axis=1)
                     colnames = ['has_%s'%self.feature_set, 'has_other']
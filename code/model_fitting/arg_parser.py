@@ -56,6 +56,10 @@ def get_args():
                     help="want to do ridge regression (lambda>0)? 1 for yes, 0 for no")
     parser.add_argument("--set_lambda_per_group", type=nice_str2bool, default=False,
                     help="want to allow lambda to differ between diff feature groups?? 1 for yes, 0 for no")
+    parser.add_argument("--ridge_solver", type=str, default='inverse',
+                    help="how to solve ridge regression? 'inverse' (invert once per lambda), 'eig' (one SVD per pRF, all lambdas in closed form) or 'gram' (X^T*X and X^T*Y once per pRF, shared by all partial versions)")
+    parser.add_argument("--n_fit_workers", type=int, default=1,
+                    help="number of processes to spread pRFs over when fitting on cpu (1 = fit serially)")
     parser.add_argument("--zscore_features", type=nice_str2bool, default=True,
                     help="want to z-score each feature right before fitting encoding model? 1 for yes, 0 for no")
     parser.add_argument("--do_corrcoef", type=nice_str2bool, default=True,
@@ -95,6 +99,8 @@ def get_args():
     
     parser.add_argument("--from_scratch", type=nice_str2bool,default=True,
                     help="want to do model training from the start? 1 for yes, 0 for no")
+    parser.add_argument("--fit_checkpoint", type=nice_str2bool,default=False,
+                    help="want to save fitting progress after each batch of pRFs, so that --from_scratch=False can resume partway through? 1 for yes, 0 for no")
     parser.add_argument("--use_precomputed_prfs", type=nice_str2bool,default=False,
                     help="want to use prf estimates that were already computed? 1 for yes, 0 for no")
     parser.add_argument("--prfs_model_name", type=str, default='', 
@@ -118,6 +124,8 @@ def get_args():
                     help="what date was the model fitting done (only if you're starting from validation step.)")
     
      
+    parser.add_argument("--prefetch_features", type=nice_str2bool,default=False,
+                    help="want to load the next batch of pRF features in the background while fitting? 1 for yes, 0 for no")
     parser.add_argument("--sample_batch_size", type=int,default=500,
                     help="number of trials to analyze at once when making features (smaller will help with out-of-memory errors)")
     parser.add_argument("--voxel_batch_size", type=int,default=1000,
@@ -0,0 +1,101 @@
+import sys, os
+import numpy as np
+import time
+import torch
+import argparse
+
+# import custom modules
+code_dir = '/'.join(os.path.dirname(os.path.abspath(__file__)).split('/')[0:-1])
+sys.path.append(code_dir)
+from utils import torch_utils
+from model_fitting import fwrf_model
+
+"""
+Micro-benchmark for choosing the betas that go with the best lambda for each voxel.
+Compares the old approaches (copy all betas to numpy then loop over voxels, or
+masked assignment over lambdas) to fwrf_model.encoding_model.__select_best_lambda__.
+All return [n_features x n_voxels (x n_shuff_iters)] numpy arrays.
+"""
+
+def gather_old(_beta, _best_lambda_index):
+
+    best_lambda_index = torch_utils.get_value(_best_lambda_index)
+    betas = torch_utils.get_value(_beta)
+    if len(betas.shape)==3:
+        betas = np.array([betas[best_lambda_index[ii],:,ii] for ii in range(len(best_lambda_index))]).T
+    else:
+        betas = np.array([[betas[best_lambda_index[ii,jj],:,ii,jj] \
+                           for ii in range(best_lambda_index.shape[0])] \
+                           for jj in range(best_lambda_index.shape[1])])
+        betas = np.moveaxis(betas,[0,1,2],[2,1,0])
+
+    return betas
+
+def gather_masked(_beta, _best_lambda_index):
+
+    _out = torch.zeros(_beta.shape[1:], dtype=_beta.dtype, device=_beta.device)
+    for ll in range(_beta.shape[0]):
+        _mask = _best_lambda_index==ll
+        _out[:,_mask] = _beta[ll][:,_mask]
+
+    return torch_utils.get_value(_out)
+
+def gather_new(_beta, _best_lambda_index):
+
+    # doesn't use any attributes of the model, so no need to make one
+    _beta = fwrf_model.encoding_model.__select_best_lambda__(None, _beta, _best_lambda_index)
+
+    return torch_utils.get_value(_beta)
+
+def run_benchmark(n_lambdas=10, n_features=64, n_voxels=1000, n_shuff_iters=0, \
+                  n_reps=10, device='cpu:0'):
+
+    device = torch.device(device)
+
+    if n_shuff_iters>0:
+        shape = (n_lambdas, n_features, n_voxels, n_shuff_iters)
+    else:
+        shape = (n_lambdas, n_features, n_voxels)
+
+    _beta = torch.randn(shape, dtype=torch.float32, device=device)
+    _best_lambda_index = torch.randint(0, n_lambdas, shape[2:], device=device)
+
+    print('betas size: %s'%(str(shape)))
+
+    betas_new = gather_new(_beta, _best_lambda_index)
+    assert(np.array_equal(gather_old(_beta, _best_lambda_index), betas_new))
+    assert(np.array_equal(gather_masked(_beta, _best_lambda_index), betas_new))
+
+    names = ['old (numpy loop)', 'old (masked assignment)', 'new (torch gather)']
+    for name, gather_fn in zip(names, [gather_old, gather_masked, gather_new]):
+        times = np.zeros((n_reps,))
+        for rr in range(n_reps):
+            if device.type=='cuda':
+                torch.cuda.synchronize()
+            t = time.time()
+            betas = gather_fn(_beta, _best_lambda_index)
+            times[rr] = time.time() - t
+        print('%s: %.5f sec (min %.5f sec) over %d reps'%(name, np.mean(times), np.min(times), n_reps))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--n_lambdas", type=int, default=10,
+                    help="number of ridge lambdas")
+    parser.add_argument("--n_features", type=int, default=64,
+                    help="number of features (including intercept)")
+    parser.add_argument("--n_voxels", type=int, default=1000,
+                    help="voxels per batch")
+    parser.add_argument("--n_shuff_iters", type=int, default=0,
+                    help="permutation iterations per batch (0 for regular fitting)")
+    parser.add_argument("--n_reps", type=int, default=10,
+                    help="how many times to repeat each timing")
+    parser.add_argument("--device", type=str, default='cpu:0',
+                    help="device to run on")
+
+    args = parser.parse_args()
+
+    run_benchmark(n_lambdas=args.n_lambdas, n_features=args.n_features, n_voxels=args.n_voxels, \
+                  n_shuff_iters=args.n_shuff_iters, n_reps=args.n_reps, device=args.device)
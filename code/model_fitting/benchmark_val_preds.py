@@ -0,0 +1,111 @@
+import sys, os
+import numpy as np
+import time
+import tracemalloc
+import torch
+import argparse
+
+# import custom modules
+code_dir = '/'.join(os.path.dirname(os.path.abspath(__file__)).split('/')[0:-1])
+sys.path.append(code_dir)
+from utils import torch_utils
+
+"""
+Micro-benchmark for getting validation set predictions for one batch of voxels that share a pRF.
+Compares the old approach (tile the design matrix for every voxel, then torch.bmm, once per
+partial version) to the shared design matrix used in fwrf_model.encoding_model, where all
+voxels and partial versions are done in one matrix multiplication.
+"""
+
+def preds_old(features, weights, bias, masks, sample_batch_size):
+
+    n_trials = features.shape[0]
+    n_voxels, max_features, n_partial_versions = weights.shape
+    pred = np.zeros((n_trials, n_voxels, n_partial_versions), dtype=np.float32)
+
+    for pp in range(n_partial_versions):
+
+        features_to_use = masks[:,pp]
+        features_tiled = np.tile(features[:,features_to_use,None], [1,1,n_voxels])
+        _weights = torch_utils._to_torch(weights[:,features_to_use,pp])
+        _bias = torch_utils._to_torch(bias[:,pp])
+
+        n_trial_batches = int(np.ceil(n_trials/sample_batch_size))
+        for ti in range(n_trial_batches):
+            trial_batch_inds = np.arange(sample_batch_size*ti, np.min([sample_batch_size*(ti+1), n_trials]))
+            _features = torch_utils._to_torch(features_tiled[trial_batch_inds,:,:])
+            _features = torch.transpose(torch.transpose(_features, 0, 2), 1, 2)
+            _r = torch.squeeze(torch.bmm(_features, torch.unsqueeze(_weights, 2)), dim=2).t()
+            _r = _r + torch.tile(torch.unsqueeze(_bias, 0), [_r.shape[0],1])
+            pred[trial_batch_inds,:,pp] = torch_utils.get_value(_r)
+
+    return pred
+
+def preds_new(features, weights, bias, masks):
+
+    weights = weights * masks[None,:,:].astype(weights.dtype)
+    _weights = torch_utils._to_torch(weights)
+    _features = torch_utils._to_torch(features)
+    _r = torch.tensordot(_features, _weights, dims=[[1],[1]])
+    _r = _r + torch_utils._to_torch(bias)[None,:,:]
+
+    return torch_utils.get_value(_r)
+
+def run_benchmark(n_trials=1000, n_features=64, n_voxels=1000, n_partial_versions=5, \
+                  sample_batch_size=500, n_reps=5):
+
+    features = np.random.normal(0,1,[n_trials, n_features]).astype(np.float32)
+    weights = np.random.normal(0,1,[n_voxels, n_features, n_partial_versions]).astype(np.float32)
+    bias = np.random.normal(0,1,[n_voxels, n_partial_versions]).astype(np.float32)
+    masks = np.ones((n_features, n_partial_versions), dtype=bool)
+    for pp in range(1, n_partial_versions):
+        masks[:,pp] = np.random.uniform(0,1,n_features)>0.5
+    # features left out are zero in weights, same as after fitting
+    weights = weights * masks[None,:,:]
+
+    print('%d trials, %d features, %d voxels, %d partial versions'\
+          %(n_trials, n_features, n_voxels, n_partial_versions))
+
+    pred_old = preds_old(features, weights, bias, masks, sample_batch_size)
+    pred_new = preds_new(features, weights, bias, masks)
+    print('max abs difference: %.3e'%np.max(np.abs(pred_old - pred_new)))
+
+    for name, preds_fn in zip(['old (tiled, bmm)', 'new (shared matmul)'], \
+                              [lambda: preds_old(features, weights, bias, masks, sample_batch_size), \
+                               lambda: preds_new(features, weights, bias, masks)]):
+        times = np.zeros((n_reps,))
+        for rr in range(n_reps):
+            t = time.time()
+            pred = preds_fn()
+            times[rr] = time.time() - t
+        # numpy allocations only (torch allocations aren't tracked)
+        tracemalloc.start()
+        pred = preds_fn()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('%s: %.5f sec (min %.5f sec) over %d reps, peak numpy memory %.1f MB'\
+              %(name, np.mean(times), np.min(times), n_reps, peak/1024**2))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--n_trials", type=int, default=1000,
+                    help="number of validation trials")
+    parser.add_argument("--n_features", type=int, default=64,
+                    help="number of features")
+    parser.add_argument("--n_voxels", type=int, default=1000,
+                    help="voxels per batch")
+    parser.add_argument("--n_partial_versions", type=int, default=5,
+                    help="number of partial versions of the model")
+    parser.add_argument("--sample_batch_size", type=int, default=500,
+                    help="trials per batch, for old version")
+    parser.add_argument("--n_reps", type=int, default=5,
+                    help="how many times to repeat each timing")
+
+    args = parser.parse_args()
+
+    run_benchmark(n_trials=args.n_trials, n_features=args.n_features, n_voxels=args.n_voxels, \
+                  n_partial_versions=args.n_partial_versions, \
+                  sample_batch_size=args.sample_batch_size, n_reps=args.n_reps)
@@ -10,6 +10,7 @@ import time
 import numpy as np
 import argparse
 import gc
+import h5py
 
 # import custom modules
 from utils import nsd_utils, roi_utils, default_paths
@@ -188,6 +189,124 @@ def fit_fwrf(args):
         print(dict2save.keys())
         np.save(fn2save, dict2save, allow_pickle=True)
 
+    # results for each voxel subset get saved here as they are done, and the full results 
+    # file (fn2save) is only written at the end.
+    progress_fn = fn2save.replace('.npy', '_progress.h5py')
+    if args.from_scratch and os.path.exists(progress_fn):
+        os.remove(progress_fn)
+    
+    # per-voxel arrays (voxels in first dimension) that go into progress_fn
+    progress_voxel_arrays = ['best_losses', 'best_lambdas', 'best_prf_models', \
+                             'best_weights', 'best_biases', 'val_cc', 'val_r2', \
+                             'corr_each_feature', 'sem_discrim_each_axis', 'sem_corr_each_axis', \
+                             'n_sem_samp_each_axis', 'mean_each_sem_level', \
+                             'sem_partial_corrs', 'sem_partial_n_samp']
+    params_names = ['best_losses', 'best_lambdas', 'best_prf_models', 'best_weights', \
+                    'best_biases', 'features_mean', 'features_std']
+    
+    def save_progress(vi, names):
+        
+        """
+        Save results for one voxel subset to progress_fn, without rewriting the whole results. 
+        Only the arrays in names get written, and only the voxels in this subset 
+        (arrays that aren't in the file yet are written whole, including when the file is created). 
+        The done flags are written last, so an interrupted save is never treated as complete.
+        """
+        values = {'best_losses': best_losses, 'best_lambdas': best_lambdas, \
+                  'best_prf_models': best_prf_models, 'best_weights': best_weights, \
+                  'best_biases': best_biases, 'features_mean': features_mean, \
+                  'features_std': features_std, 'val_cc': val_cc, 'val_r2': val_r2, \
+                  'corr_each_feature': corr_each_feature, \
+                  'sem_discrim_each_axis': sem_discrim_each_axis, \
+                  'sem_corr_each_axis': sem_corr_each_axis, \
+                  'n_sem_samp_each_axis': n_sem_samp_each_axis, \
+                  'mean_each_sem_level': mean_each_sem_level, \
+                  'sem_partial_corrs': sem_partial_corrs, 'sem_partial_n_samp': sem_partial_n_samp}
+        
+        voxel_inds = np.where(voxel_subset_masks[vi])[0]
+        if len(voxel_inds)>0 and np.all(np.diff(voxel_inds)==1):
+            voxel_inds = slice(voxel_inds[0], voxel_inds[-1]+1)
+            
+        print('\nSaving %s for voxel subset %d to %s\n'%(names, vi, progress_fn))
+        t = time.time()
+        with h5py.File(progress_fn, 'a') as f:
+            
+            if 'lambdas' not in f.keys():
+                # new file, write everything we have so far.
+                f.create_dataset('lambdas', data=lambdas)
+                f.attrs['up_to_sess'] = args.up_to_sess
+                f.attrs['debug'] = args.debug
+                f.attrs['which_prf_grid'] = args.which_prf_grid
+                f.attrs['saved_prfs_fn'] = saved_prfs_fn if saved_prfs_fn is not None else ''
+                f.attrs['saved_best_layer_fn'] = saved_best_layer_fn if saved_best_layer_fn is not None else ''
+                names = list(values.keys())
+                
+            for name in names:
+                if values[name] is None:
+                    continue
+                if name in ['features_mean', 'features_std']:
+                    # these are [n_prfs x max_features x n_subsets]
+                    if name in f.keys():
+                        f[name][:,:,vi] = values[name][:,:,vi]
+                        continue
+                elif (name in f.keys()) and (f[name].shape==values[name].shape):
+                    f[name][voxel_inds] = values[name][voxel_inds]
+                    continue
+                if name in f.keys():
+                    # shape changed (e.g. padded), replace it
+                    del f[name]
+                chunks = (int(np.min([values[name].shape[0], 1024])),) + values[name].shape[1:] \
+                            if (values[name].size>0 and name in progress_voxel_arrays) else None
+                f.create_dataset(name, data=values[name], chunks=chunks)
+                
+            if discrim_type_list is not None:
+                f.attrs['discrim_type_list'] = list(discrim_type_list)
+            if axes_to_do is not None:
+                f.attrs['axes_to_do'] = axes_to_do
+                
+            for name, flags in zip(['voxel_subset_is_done_trn', 'voxel_subset_is_done_val'], \
+                                   [voxel_subset_is_done_trn, voxel_subset_is_done_val]):
+                if name in f.keys():
+                    f[name][:] = flags
+                else:
+                    f.create_dataset(name, data=flags)
+            f.close()
+            
+        print('took %.5f sec'%(time.time() - t))
+        
+    def load_progress(progress_fn):
+        
+        """
+        Load the results saved by save_progress, in the same format as the full results file.
+        """
+        print('\nLoading the results of training from %s\n'%progress_fn)
+        with h5py.File(progress_fn, 'r') as f:
+            last_saved = dict([(name, f[name][:]) for name in f.keys()])
+            last_saved['up_to_sess'] = f.attrs['up_to_sess']
+            last_saved['debug'] = f.attrs['debug']
+            last_saved['which_prf_grid'] = f.attrs['which_prf_grid']
+            for name in ['saved_prfs_fn', 'saved_best_layer_fn']:
+                last_saved[name] = f.attrs[name] if len(f.attrs[name])>0 else None
+            last_saved['discrim_type_list'] = list(f.attrs['discrim_type_list']) \
+                                            if 'discrim_type_list' in f.attrs.keys() else None
+            last_saved['axes_to_do'] = list(f.attrs['axes_to_do']) \
+                                            if 'axes_to_do' in f.attrs.keys() else None
+            f.close()
+            
+        for name in ['best_weights', 'best_biases'] + progress_voxel_arrays:
+            if name not in last_saved.keys():
+                last_saved[name] = None
+        for name in ['axes_to_balance', 'sem_discrim_each_axis_balanced', 'sem_corr_each_axis_balanced', \
+                     'n_sem_samp_each_axis_balanced', 'mean_each_sem_level_balanced']:
+            last_saved[name] = None
+            
+        last_saved['best_params'] = [prf_models[last_saved['best_prf_models'],:], \
+                                     last_saved['best_weights'], last_saved['best_biases'], \
+                                     last_saved['features_mean'], last_saved['features_std'], \
+                                     last_saved['best_prf_models']]
+        
+        return last_saved
+        
     if (args.from_scratch) and not (args.date_str==0 or args.date_str=='0' or args.date_str==''):
         raise ValueError('if --from_scratch=True, should specify --date_str=0 (rather than entering a date)')    
     if (args.do_sem_disc or args.do_tuning) and not args.do_val:
@@ -425,10 +544,15 @@ def fit_fwrf(args):
     if not args.from_scratch:
         
         # stuff that needs to happen if we are resuming from some intermediate point
-        print('\nLoading the results of training from %s\n'%fn2save)
-        last_saved = np.load(fn2save, allow_pickle=True).item()
+        if os.path.exists(progress_fn):
+            # job was interrupted before the full results file was written
+            last_saved = load_progress(progress_fn)
+        else:
+            print('\nLoading the results of training from %s\n'%fn2save)
+            last_saved = np.load(fn2save, allow_pickle=True).item()
         # make sure that training was actually done, otherwise should start over 
-        assert(np.any(last_saved['voxel_subset_is_done_trn']))
+        # (unless there is a checkpoint from partway through training)
+        assert(np.any(last_saved['voxel_subset_is_done_trn']) or args.fit_checkpoint)
         assert(last_saved['up_to_sess']==args.up_to_sess)
         assert(last_saved['debug']==args.debug)
         assert(last_saved['which_prf_grid']==args.which_prf_grid)
@@ -516,6 +640,8 @@ def fit_fwrf(args):
             val_r2 = np.zeros((n_voxels, n_partial_versions), dtype=np.float32) 
             best_weights = np.zeros((n_voxels, max_features_overall, n_partial_versions), dtype=np.float32)
             best_biases = np.zeros((n_voxels, n_partial_versions), dtype=np.float32)
+        best_params = [prf_models[best_prf_models,:], best_weights, best_biases, \
+                           features_mean, features_std, best_prf_models]
         
     ########### LOOPING OVER VOXEL SUBSETS ######################################################
     for vi, voxel_subset_mask in enumerate(voxel_subset_masks):
@@ -534,6 +660,12 @@ def fit_fwrf(args):
             voxel_subset_is_done_trn = True
             continue
         
+        if args.fit_checkpoint:
+            # progress of fitting this voxel subset gets saved here, so we can resume partway through.
+            checkpoint_file = os.path.join(output_dir, 'fit_checkpoint_subset%d.h5py'%vi)
+        else:
+            checkpoint_file = None
+            
         # pull out my current feature loader
         feat_loader_full = feat_loader_full_list[vi]
         max_features = feat_loader_full.max_features 
@@ -547,6 +679,8 @@ def fit_fwrf(args):
                                             zscore=args.zscore_features, \
                                             add_bias=True, \
                                             set_lambda_per_group = args.set_lambda_per_group, \
+                                            ridge_solver = args.ridge_solver, \
+                                            n_fit_workers = args.n_fit_workers, \
                                             voxel_batch_size=args.voxel_batch_size,\
                                             sample_batch_size=args.sample_batch_size,\
                                             device=device,\
@@ -560,6 +694,7 @@ def fit_fwrf(args):
                                             n_boot_iters = args.n_boot_iters, \
                                             boot_val_only = args.boot_val_only, \
                                             do_corrcoef = args.do_corrcoef, \
+                                            checkpoint_file = checkpoint_file, \
                                             dtype=np.float32, debug=args.debug)
                   
           
@@ -569,6 +704,10 @@ def fit_fwrf(args):
    
             print('\nStarting training (voxel subset %d of %d)...\n'%(vi, len(voxel_subset_masks)))
             print(len(image_inds_trn))
+            
+            if args.fit_checkpoint and not os.path.exists(progress_fn):
+                # save the params before training, so that we can load them if resuming from checkpoint
+                save_progress(vi, [])
 
             sys.stdout.flush()
             
@@ -627,7 +766,11 @@ def fit_fwrf(args):
         
         print('about to save')
                   
-        save_all(fn2save)   
+        save_progress(vi, params_names)   
+        
+        if checkpoint_file is not None and os.path.exists(checkpoint_file):
+            # training for this subset is saved now, don't need the checkpoint anymore
+            os.remove(checkpoint_file)
             
         ############### VALIDATE MODEL ##################################################################
     
@@ -646,7 +789,7 @@ def fit_fwrf(args):
                                  
             if (not args.do_tuning) and (not args.do_sem_disc):
                 voxel_subset_is_done_val[vi] = True
-            save_all(fn2save) 
+            save_progress(vi, ['val_cc', 'val_r2']) 
             
             ############# ESTIMATE FEATURE SELECTIVITY #########################################################
             sys.stdout.flush()
@@ -670,7 +813,7 @@ def fit_fwrf(args):
                 corr_each_feature[voxel_subset_mask,0:max_features] = corr_each_feature_tmp                
                 if not args.do_sem_disc:
                     voxel_subset_is_done_val[vi] = True
-                save_all(fn2save)
+                save_progress(vi, ['corr_each_feature'])
 
             ########### ESTIMATE SEMANTIC DISCRIMINABILITY #######################################################
             sys.stdout.flush()
@@ -710,7 +853,8 @@ def fit_fwrf(args):
                 n_sem_samp_each_axis[voxel_subset_mask,:,:] = n_samp_tmp
                 mean_each_sem_level[voxel_subset_mask,:,:] = mean_tmp
 #                 voxel_subset_is_done_val[vi] = True
-                save_all(fn2save)
+                save_progress(vi, ['sem_discrim_each_axis', 'sem_corr_each_axis', \
+                                   'n_sem_samp_each_axis', 'mean_each_sem_level'])
     
                 # compute partial correlations for some axes 
                 axes_to_do = [0,1,2,3,4,5,6,7]
@@ -733,7 +877,7 @@ def fit_fwrf(args):
                 sem_partial_n_samp[voxel_subset_mask,:,:] = n_samp_tmp
         
                 voxel_subset_is_done_val[vi] = True
-                save_all(fn2save)
+                save_progress(vi, ['sem_partial_corrs', 'sem_partial_n_samp'])
                 
                 
                 
@@ -753,8 +897,12 @@ def fit_fwrf(args):
                                                     session_inds, all_dat_r2[:,0], \
                                                     args)
             
+    # write the full results file once everything is done 
+    save_all(fn2save)
+    if os.path.exists(progress_fn):
+        os.remove(progress_fn)
                  
-        # Done!
+    # Done!
 
 if __name__ == '__main__':
     
@@ -1,8 +1,12 @@
 import sys
+import os
 import time
 import copy
 import numpy as np
 import gc
+import h5py
+import multiprocessing
+from multiprocessing import shared_memory
 
 import torch
 
@@ -40,6 +44,21 @@ class encoding_model():
             if 'voxel_batch_size' in kwargs.keys() else 100
         self.prfs_fit_mask = kwargs['prfs_fit_mask'] \
             if 'prfs_fit_mask' in kwargs.keys() else None
+        # how to solve the ridge regression: 'inverse' does one matrix inverse per lambda,
+        # 'eig' does one SVD of design matrix and gets all lambdas in closed form,
+        # 'gram' computes X^T*X and X^T*Y once per pRF and solves each partial version 
+        # from the sub-blocks for its features.
+        self.ridge_solver = kwargs['ridge_solver'] \
+            if 'ridge_solver' in kwargs.keys() else 'inverse'
+        if self.ridge_solver not in ['inverse', 'eig', 'gram']:
+            raise ValueError('ridge_solver must be "inverse", "eig" or "gram"')
+        # how many processes to spread pRFs over during fitting (1 = fit serially)
+        self.n_fit_workers = kwargs['n_fit_workers'] \
+            if 'n_fit_workers' in kwargs.keys() else 1
+        # optional file to save fitting progress to after each batch of pRFs, 
+        # if it exists already then fitting will resume from where it left off.
+        self.checkpoint_file = kwargs['checkpoint_file'] \
+            if 'checkpoint_file' in kwargs.keys() else None
         
         self.device = kwargs['device'] if 'device' in kwargs.keys() else torch.device('cpu:0')
         self.dtype = kwargs['dtype'] if 'dtype' in kwargs.keys() else np.float32
@@ -177,6 +196,49 @@ class encoding_model():
         # clear any stored features from feature loader's memory    
         self.feature_loader.clear_big_features()
         
+        self.prfs_done = np.zeros((self.n_prfs,), dtype=bool)
+        if self.checkpoint_file is not None:
+            self.__init_checkpoint__()
+            
+        if self.n_fit_workers>1:
+            self.__fit_parallel__()
+        else:
+            self.__fit_serial__()
+            
+        if self.checkpoint_file is not None:
+            self.__save_checkpoint__()
+                
+        # Finish up, prepare to return items of interest
+        self.best_weights = self.best_w_params[:,0:self.max_features,:]  
+        if self.add_bias:
+            self.best_biases = self.best_w_params[:,-1,:]       
+        else: 
+            self.best_biases = None
+        
+        # trying to clear some space here...
+        self.best_w_params = None
+        self.voxel_data_trn = None
+        self.image_inds_trn = None
+        self.voxel_data_holdout = None
+        self.image_inds_holdout = None
+        self.shuff_inds_trn = None
+        self.shuff_inds_out = None
+        self.image_inds_concat = None
+        self.trials_use_each_prf_trn = None
+        self.trials_use_each_prf_holdout = None
+        gc.collect()
+        
+        # This step clears any loaded arrays out of feature loader (no longer needed)
+        self.feature_loader.clear_big_features()
+        gc.collect()
+        
+        sys.stdout.flush()
+       
+    def __fit_serial__(self):
+        
+        checkpoint_interval = self.feature_loader.prf_batch_size \
+            if hasattr(self.feature_loader, 'prf_batch_size') else 100
+        
         with torch.no_grad(): # make sure local gradients are off to save memory
                 
             # Looping over pRFs here
@@ -191,41 +253,201 @@ class encoding_model():
                     print('skipping pRF %d, based on prfs_fit_mask'%mm)
                     continue
                     
+                if self.prfs_done[mm]:
+                    print('skipping pRF %d, already done (loaded from checkpoint)'%mm)
+                    continue
+                    
                 print('\nProcessing prf %d of %d'%(mm, self.n_prfs))
 
                 self.__fit_one_prf__(mm)
+                self.prfs_done[mm] = True
                 
+                if self.checkpoint_file is not None and np.mod(mm+1, checkpoint_interval)==0:
+                    self.__save_checkpoint__()
+                    
                 gc.collect()
         
                 sys.stdout.flush()
                 
-        # Finish up, prepare to return items of interest
-        self.best_weights = self.best_w_params[:,0:self.max_features,:]  
-        if self.add_bias:
-            self.best_biases = self.best_w_params[:,-1,:]       
-        else: 
-            self.best_biases = None
+    def __fit_parallel__(self):
         
-        # trying to clear some space here...
-        self.best_w_params = None
-        self.voxel_data_trn = None
-        self.image_inds_trn = None
-        self.voxel_data_holdout = None
-        self.image_inds_holdout = None
-        self.shuff_inds_trn = None
-        self.shuff_inds_out = None
-        self.image_inds_concat = None
-        self.trials_use_each_prf_trn = None
-        self.trials_use_each_prf_holdout = None
-        gc.collect()
+        '''
+        Spread pRFs over a pool of worker processes on this node. 
+        Each worker fits a contiguous chunk of pRFs (matching the feature loader's pRF batches), 
+        keeping its own running best for each voxel. The voxel data is put into shared memory 
+        so that workers don't each make a copy. Then results of each chunk are merged here.
+        '''
+        if self.shuffle_data or self.bootstrap_data:
+            raise ValueError('parallel fitting is not supported for permutation test or bootstrap')
+        if torch.device(self.device).type!='cpu':
+            raise ValueError('parallel fitting is only supported on cpu')
+            
+        prfs_to_fit = np.arange(self.n_prfs)
+        if self.debug:
+            prfs_to_fit = prfs_to_fit[0:2]
+        if self.prfs_fit_mask is not None:
+            prfs_to_fit = prfs_to_fit[self.prfs_fit_mask[prfs_to_fit]]
+        prfs_to_fit = prfs_to_fit[~self.prfs_done[prfs_to_fit]]
+            
+        prf_chunk_size = self.feature_loader.prf_batch_size \
+            if hasattr(self.feature_loader, 'prf_batch_size') else 100
+        prf_chunks = [prfs_to_fit[(prfs_to_fit>=cc) & (prfs_to_fit<cc+prf_chunk_size)] \
+                      for cc in np.arange(0, self.n_prfs, prf_chunk_size)]
+        prf_chunks = [pc for pc in prf_chunks if len(pc)>0]
+        
+        n_workers = int(np.min([self.n_fit_workers, len(prf_chunks)]))
+        print('fitting %d pRFs in %d chunks, with %d workers (1 thread each)'\
+              %(len(prfs_to_fit), len(prf_chunks), n_workers))
+        sys.stdout.flush()
+        
+        # put voxel data into shared memory
+        shm_list = []
+        shm_info = dict()
+        voxel_data_orig = dict()
+        for name in ['voxel_data_trn', 'voxel_data_holdout']:
+            data = np.ascontiguousarray(getattr(self, name))
+            shm = shared_memory.SharedMemory(create=True, size=int(np.max([data.nbytes, 1])))
+            np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[:] = data
+            shm_list.append(shm)
+            shm_info[name] = (shm.name, data.shape, data.dtype)
+            voxel_data_orig[name] = getattr(self, name)
+            # workers will attach to the shared copy instead
+            setattr(self, name, None)
         
-        # This step clears any loaded arrays out of feature loader (no longer needed)
         self.feature_loader.clear_big_features()
         gc.collect()
         
+        try:
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(n_workers, initializer=_init_fit_worker, \
+                          initargs=(self, shm_info)) as pool:
+                for result in pool.imap_unordered(_fit_prf_chunk, prf_chunks):
+                    self.__merge_fit_results__(*result)
+                    print('merged results for pRFs [%d - %d]'%(result[0][0], result[0][-1]))
+                    self.prfs_done[result[0]] = True
+                    if self.checkpoint_file is not None:
+                        self.__save_checkpoint__()
+                    sys.stdout.flush()
+        finally:
+            for name in voxel_data_orig.keys():
+                setattr(self, name, voxel_data_orig[name])
+            for shm in shm_list:
+                shm.close()
+                shm.unlink()
+                
+    def __merge_fit_results__(self, prf_inds, voxel_inds, best_losses, best_lambdas, \
+                              best_prf_models, best_w_params, \
+                              features_mean, features_std):
+        
+        '''
+        Combine running best params from one chunk of pRFs with the running best over all chunks.
+        The params are only for the voxels in voxel_inds (the ones this chunk fit).
+        '''
+        if self.fitting_prfs_now:
+            # choose based on loss of the full model, same as in the serial case. 
+            # if there is a tie, the lower pRF index wins (which is what the serial loop does).
+            chunk_fit = best_prf_models[:,0]>=0
+            improved = chunk_fit & \
+                ((best_losses[:,0] < self.best_losses[voxel_inds,0]) | \
+                 ((best_losses[:,0]==self.best_losses[voxel_inds,0]) & \
+                  (best_prf_models[:,0] < self.best_prf_models[voxel_inds,0])))
+        else:
+            # each voxel only has one pRF, so only one chunk will have fit it.
+            improved = np.ones((len(voxel_inds),), dtype=bool)
+        improved_voxels = voxel_inds[improved]
+        best_losses, best_lambdas, best_prf_models, best_w_params = \
+            best_losses[improved], best_lambdas[improved], best_prf_models[improved], best_w_params[improved]
+            
+        self.best_losses[improved_voxels] = best_losses
+        self.best_lambdas[improved_voxels] = best_lambdas
+        self.best_prf_models[improved_voxels] = best_prf_models
+        self.best_w_params[improved_voxels] = best_w_params
+        
+        if self.zscore:
+            self.features_mean[prf_inds] = features_mean
+            self.features_std[prf_inds] = features_std
+            
+    def __init_checkpoint__(self):
+        
+        '''
+        Set up the checkpoint file for this fit. If it already exists (from a job that 
+        was interrupted), load the running best params and the list of pRFs that are done, 
+        so the fitting loop can skip those pRFs.
+        Each array is its own dataset, chunked over voxels, so that saving only has to 
+        write the voxels that changed since the last save.
+        '''
+        self.ckpt_arrays = ['best_w_params', 'best_prf_models', 'best_lambdas', 'best_losses']
+        if self.zscore:
+            self.ckpt_arrays += ['features_mean', 'features_std']
+            
+        if os.path.exists(self.checkpoint_file):
+            
+            print('Loading fitting progress from %s'%self.checkpoint_file)
+            with h5py.File(self.checkpoint_file, 'r') as f:
+                for name in self.ckpt_arrays:
+                    if (name not in f.keys()) or (f[name].shape!=getattr(self, name).shape):
+                        raise ValueError('checkpoint file %s does not match this model (%s)'\
+                                         %(self.checkpoint_file, name))
+                if not np.array_equal(f['lambdas'][:], self.lambdas):
+                    raise ValueError('checkpoint file %s does not match this model (lambdas)'\
+                                     %(self.checkpoint_file))
+                for name in self.ckpt_arrays:
+                    setattr(self, name, f[name][:])
+                self.prfs_done = f['prfs_done'][:]
+                f.close()
+            print('%d of %d pRFs already done'%(np.sum(self.prfs_done), self.n_prfs))
+            
+        else:
+            
+            print('Saving fitting progress to %s'%self.checkpoint_file)
+            with h5py.File(self.checkpoint_file, 'w') as f:
+                for name in self.ckpt_arrays:
+                    values = getattr(self, name)
+                    chunks = (int(np.min([values.shape[0], 256])),) + values.shape[1:] \
+                                if values.size>0 else None
+                    f.create_dataset(name, data=values, chunks=chunks)
+                f.create_dataset('lambdas', data=self.lambdas)
+                f.create_dataset('prfs_done', data=self.prfs_done)
+                f.close()
+        
+        # copies of what is in the file now, to check what has changed at next save
+        self.ckpt_last = dict([(name, np.copy(getattr(self, name))) \
+                                   for name in ['best_prf_models', 'best_lambdas', 'best_losses']])
         sys.stdout.flush()
-       
-    
+        
+    def __save_checkpoint__(self):
+        
+        '''
+        Write any voxels whose params have changed since the last save, and update the 
+        list of pRFs that are done. 
+        The prfs_done flags are written last, so that an interrupted save is never 
+        treated as complete.
+        '''
+        t = time.time()
+        changed = np.zeros((self.n_voxels,), dtype=bool)
+        for name in ['best_prf_models', 'best_lambdas', 'best_losses']:
+            changed |= np.any(np.reshape(getattr(self, name)!=self.ckpt_last[name], \
+                                         [self.n_voxels, -1]), axis=1)
+        voxels_changed = np.where(changed)[0]
+        
+        with h5py.File(self.checkpoint_file, 'r+') as f:
+            if len(voxels_changed)>0:
+                for name in ['best_w_params', 'best_prf_models', 'best_lambdas', 'best_losses']:
+                    f[name][voxels_changed] = getattr(self, name)[voxels_changed]
+                    if name in self.ckpt_last.keys():
+                        self.ckpt_last[name][voxels_changed] = getattr(self, name)[voxels_changed]
+            if self.zscore:
+                prfs_new = np.where(self.prfs_done & ~f['prfs_done'][:])[0]
+                if len(prfs_new)>0:
+                    f['features_mean'][prfs_new] = self.features_mean[prfs_new]
+                    f['features_std'][prfs_new] = self.features_std[prfs_new]
+            f['prfs_done'][:] = self.prfs_done
+            f.close()
+            
+        print('saved checkpoint (%d of %d pRFs done, %d voxels updated), took %.5f sec'\
+              %(np.sum(self.prfs_done), self.n_prfs, len(voxels_changed), time.time()-t))
+        sys.stdout.flush()
+        
     def __init_for_fit__(self, \
                         image_inds_trn, \
                         voxel_data_trn, \
@@ -244,33 +466,7 @@ class encoding_model():
 
         self.n_voxels = self.voxel_data_trn.shape[1]   
 
-        # Initialize arrays to store model fitting params
-        n_params = self.max_features
-        if self.add_bias:
-            n_params += 1
-        
-        if self.shuffle_data:
-            self.best_w_params = np.zeros(shape=(self.n_voxels, \
-                                             n_params, \
-                                             self.n_partial_versions, \
-                                             self.n_shuff_iters), dtype=self.dtype)
-        elif self.bootstrap_data and not self.boot_val_only:
-            self.best_w_params = np.zeros(shape=(self.n_voxels, \
-                                             n_params, \
-                                             self.n_partial_versions, \
-                                             self.n_boot_iters), dtype=self.dtype)
-        else:
-            self.best_w_params = np.zeros(shape=(self.n_voxels, \
-                                                 n_params, \
-                                                 self.n_partial_versions), dtype=self.dtype)
-            
-        self.best_prf_models = np.full(shape=(self.n_voxels, \
-                                             self.n_partial_versions), fill_value=-1, dtype=int)   
-        self.best_lambdas = np.full(shape=(self.n_voxels, \
-                                             self.n_partial_versions), fill_value=-1, dtype=int)
-        self.best_losses = np.full(fill_value=np.inf, \
-                                   shape=(self.n_voxels, \
-                                          self.n_partial_versions), dtype=self.dtype)
+        self.__init_best_params__()
 
         # params needed if z-scoring
         if self.zscore:        
@@ -310,6 +506,36 @@ class encoding_model():
                 self.boot_inds_trn[:,xx] = np.random.choice(np.arange(n_trn), n_trn, replace=True)
                 self.boot_inds_out[:,xx] = np.random.choice(np.arange(n_out), n_out, replace=True)
             
+    def __init_best_params__(self):
+        
+        # Initialize arrays to store model fitting params
+        n_params = self.max_features
+        if self.add_bias:
+            n_params += 1
+        
+        if self.shuffle_data:
+            self.best_w_params = np.zeros(shape=(self.n_voxels, \
+                                             n_params, \
+                                             self.n_partial_versions, \
+                                             self.n_shuff_iters), dtype=self.dtype)
+        elif self.bootstrap_data and not self.boot_val_only:
+            self.best_w_params = np.zeros(shape=(self.n_voxels, \
+                                             n_params, \
+                                             self.n_partial_versions, \
+                                             self.n_boot_iters), dtype=self.dtype)
+        else:
+            self.best_w_params = np.zeros(shape=(self.n_voxels, \
+                                                 n_params, \
+                                                 self.n_partial_versions), dtype=self.dtype)
+            
+        self.best_prf_models = np.full(shape=(self.n_voxels, \
+                                             self.n_partial_versions), fill_value=-1, dtype=int)   
+        self.best_lambdas = np.full(shape=(self.n_voxels, \
+                                             self.n_partial_versions), fill_value=-1, dtype=int)
+        self.best_losses = np.full(fill_value=np.inf, \
+                                   shape=(self.n_voxels, \
+                                          self.n_partial_versions), dtype=self.dtype)
+            
     def __fit_one_prf__(self, mm):
 
         # Initialize some variables for this pRF
@@ -394,6 +620,15 @@ class encoding_model():
         print('prf %d - using %d training trials and %d held-out trials'\
                   %(mm, trn_data_use.shape[0], out_data_use.shape[0]))
 
+        # permutation and bootstrap fits change X^T*Y (or X^T*X) on every iteration,
+        # so they always use one of the other solvers.
+        use_gram = (self.ridge_solver=='gram') and (not self.shuffle_data) and \
+                    (not self.bootstrap_data or self.boot_val_only)
+        if use_gram:
+            # every partial version's X^T*X and X^T*Y are sub-blocks of these.
+            _gram, _xty = self.__gram_terms_cpu__(trn_features, trn_data_use, \
+                                                  voxels_to_fit, n_voxel_batches)
+            
         # Looping over versions of the model w different features set to zero (variance partition)
         for pp in range(self.n_partial_versions):
 
@@ -410,9 +645,22 @@ class encoding_model():
             _xtrn = torch_utils._to_torch(trn_features[:, nonzero_inds_short], device=self.device)
             _xout = torch_utils._to_torch(out_features[:, nonzero_inds_short], device=self.device)   
 
+            if self.bootstrap_data and not self.boot_val_only:
+                # bootstrap loops over resampling iterations first, then voxel batches, 
+                # so that each resampled solution is only computed once.
+                self.__fit_bootstrap__(_xtrn, _xout, \
+                                trn_data_use, out_data_use, \
+                                nonzero_inds_full, voxels_to_fit, \
+                                n_voxel_batches, mm, pp)
+                continue
+                
             # Do part of the matrix math involved in ridge regression optimization out of the loop, 
             # because this part will be same for all the voxels.
-            _cof = self.__cofactor_fn_cpu__(_xtrn, self.lambda_vectors[pp][:,nonzero_inds_full]) 
+            if use_gram:
+                _cof = self.__gram_fn_cpu__(_gram, _xty, nonzero_inds_short, \
+                                            self.lambda_vectors[pp][:,nonzero_inds_full], _xtrn.dtype)
+            else:
+                _cof = self.__solver_fn__(_xtrn, self.lambda_vectors[pp][:,nonzero_inds_full]) 
              
              # Now looping over batches of voxels (only reason is because can't store all in memory at same time)
             for vv in range(n_voxel_batches):
@@ -421,18 +669,18 @@ class encoding_model():
                           np.min([self.voxel_batch_size*(vv+1), len(voxels_to_fit)]))
                 voxel_batch_inds = voxels_to_fit[vinds]
         
-                if self.shuffle_data:                    
-                    self.__fit_voxel_batch_shuffle__(_cof, _xout, \
+                if use_gram:
+                    self.__fit_voxel_batch__(self.__gram_select_voxels__(_cof, vinds), _xout, \
                                 trn_data_use, out_data_use, \
                                 nonzero_inds_full, \
                                 full_model_improved, voxels_to_fit, \
-                                mm, pp, voxel_batch_inds)              
-                elif self.bootstrap_data and not self.boot_val_only:
-                    self.__fit_voxel_batch_bootstrap__(_xtrn, _xout, \
+                                mm, pp, voxel_batch_inds)
+                elif self.shuffle_data:                    
+                    self.__fit_voxel_batch_shuffle__(_cof, _xout, \
                                 trn_data_use, out_data_use, \
                                 nonzero_inds_full, \
                                 full_model_improved, voxels_to_fit, \
-                                mm, pp, voxel_batch_inds)   
+                                mm, pp, voxel_batch_inds)              
                 else:
                     self.__fit_voxel_batch__(_cof, _xout, \
                                 trn_data_use, out_data_use, \
@@ -459,14 +707,14 @@ class encoding_model():
         # loss is size: [lambdas x voxels]
         _best_loss_values, _best_lambda_index = torch.min(_loss, dim=0)
 
+        # betas is size: [lambdas x features x voxels]
+        # choose betas that go with best lambda (reduce to size [features x voxels])
+        _beta = self.__select_best_lambda__(_beta, _best_lambda_index)
+        
         # back to numpy now
         best_loss_values = torch_utils.get_value(_best_loss_values)
         best_lambda_index =  torch_utils.get_value(_best_lambda_index)
-        
-        # betas is size: [lambdas x features x voxels]
         betas = torch_utils.get_value(_beta)
-        # choose betas that go with best lambda (reduce to size [features x voxels])
-        betas = np.array([betas[best_lambda_index[ii],:,ii] for ii in range(len(best_lambda_index))]).T
            
             
         # decide what to do next...
@@ -523,51 +771,49 @@ class encoding_model():
         
         betas_all = np.zeros((len(voxel_batch_inds), _xout.shape[1], self.n_shuff_iters), dtype=self.dtype)
         
+        _vtrn = torch_utils._to_torch(trn_data_use[:,voxel_batch_inds], device=self.device)
+        _vout = torch_utils._to_torch(out_data_use[:,voxel_batch_inds], device=self.device)
+        
+        if self.trials_use_each_prf_trn is not None:
+            sinds_trn = self.shuff_inds_trn_use
+            sinds_out = self.shuff_inds_out_use
+        else:
+            sinds_trn = self.shuff_inds_trn
+            sinds_out = self.shuff_inds_out
+        _sinds_trn = torch.as_tensor(sinds_trn, device=self.device)
+        _sinds_out = torch.as_tensor(sinds_out, device=self.device)
+        
         # do shuffled fitting in batches to prevent memory overload
         for bb, batch_inds in enumerate(self.shuff_batch_inds):
             
             print('permutation test, batch %d of %d'%(bb, len(self.shuff_batch_inds)))
             
-            _vtrn = torch_utils._to_torch(trn_data_use[:,voxel_batch_inds], device=self.device)
-            _vout = torch_utils._to_torch(out_data_use[:,voxel_batch_inds], device=self.device)
-        
-            if self.trials_use_each_prf_trn is not None:
-                sinds_trn = self.shuff_inds_trn_use
-                sinds_out = self.shuff_inds_out_use
-            else:
-                sinds_trn = self.shuff_inds_trn
-                sinds_out = self.shuff_inds_out
-            # create trial-shuffled datasets here, multiple iterations of shuffling
-            # don't make a new variable name here, trying to save memory
-            _vtrn = torch.cat([_vtrn[sinds_trn[:,ii],:,None] for ii in batch_inds], axis=2)
-            _vout = torch.cat([_vout[sinds_out[:,ii],:,None] for ii in batch_inds], axis=2)
-            # size [n_trials x n_voxels x n_shuff_iters]
-           
-            # Fit weights and get prediction loss here
-            _beta, _loss = self.__loss_fn__(_cof, _vtrn, _xout, _vout) 
+            # shuffled voxel data for this whole batch, size [trials x voxels x shuff_iters]
+            _vtrn_shuff = _vtrn[_sinds_trn[:,batch_inds]].permute(0,2,1)
+            _vout_shuff = _vout[_sinds_out[:,batch_inds]].permute(0,2,1)
+            
+            # Fit weights and get prediction loss here, for all iterations in batch at once
+            _beta, _loss = self.__loss_fn__(_cof, _vtrn_shuff, _xout, _vout_shuff) 
             # betas size [lambdas x features x voxels x shuff_iters]
-
+            
             # choose best lambda value and the loss that went with it.
-            # loss is size: [lambdas x voxels x n_shuff_iters]
+            # loss is size: [lambdas x voxels x shuff_iters]
             _best_loss_values, _best_lambda_index = torch.min(_loss, dim=0)
             # each size [voxels x shuff_iters]
-
-            # back to numpy now
-            best_loss_values = torch_utils.get_value(_best_loss_values)
-            best_lambda_index =  torch_utils.get_value(_best_lambda_index)
-
-            # betas is size: [lambdas x features x voxels x n_shuff_iters]
-            betas = torch_utils.get_value(_beta)
-            # choose betas that go with best lambda 
-            betas = np.array([[betas[best_lambda_index[ii,jj],:,ii,jj] \
-                               for ii in range(len(best_lambda_index))] \
-                               for jj in range(len(batch_inds))])
+            
+            # choose betas that go with best lambda, size [voxels x features x shuff_iters] 
+            _betas_batch = self.__select_best_lambda__(_beta, _best_lambda_index).permute(1,0,2)
+            
+            if bb==len(self.shuff_batch_inds)-1:
+                # only saving lambda and loss for one iteration (first of the last batch)
+                # back to numpy now
+                best_loss_values = torch_utils.get_value(_best_loss_values[:,0])
+                best_lambda_index =  torch_utils.get_value(_best_lambda_index[:,0])
+                    
             # will be size [voxels x features x n_shuff_iters]
-            betas = np.moveaxis(betas,[0,1,2],[2,0,1])
-
-            betas_all[:,:,batch_inds] = betas
+            betas_all[:,:,batch_inds] = torch_utils.get_value(_betas_batch)
             
-            betas = None
+            _betas_batch = None; _beta = None; _loss = None
             gc.collect()
          
         # for permutation analysis, we already fit pRFs so always saving all voxels.
@@ -576,8 +822,8 @@ class encoding_model():
         self.best_prf_models[voxel_inds_save,pp] = mm
 
         # only saving one lambda and loss, because they'll get very large and we don't really need them.
-        self.best_lambdas[voxel_inds_save,pp] = best_lambda_index[:,0]
-        self.best_losses[voxel_inds_save,pp] = best_loss_values[:,0]                     
+        self.best_lambdas[voxel_inds_save,pp] = best_lambda_index
+        self.best_losses[voxel_inds_save,pp] = best_loss_values                     
 
         # make sure to save all the weights, because we still need to evaluate the model
         # taking the weights associated with the best lambda value
@@ -598,82 +844,245 @@ class encoding_model():
         gc.collect()
           
             
-    def __fit_voxel_batch_bootstrap__(self, _xtrn, _xout, \
-                                    trn_data_use, out_data_use, \
-                                    nonzero_inds_full, \
-                                    full_model_improved, voxels_to_fit, \
-                                    mm, pp, voxel_batch_inds):
-       
-        betas_all = np.zeros((len(voxel_batch_inds), _xout.shape[1], self.n_boot_iters), dtype=self.dtype)
+    def __fit_bootstrap__(self, _xtrn, _xout, \
+                          trn_data_use, out_data_use, \
+                          nonzero_inds_full, voxels_to_fit, \
+                          n_voxel_batches, mm, pp):
+        
+        # Each bootstrap resample is expressed as a count of how many times each trial was drawn.
+        # Fitting to resampled data is then the same as a weighted fit to the original data:
+        # X[inds]^T*X[inds] = X^T*diag(counts)*X, and X[inds]^T*Y[inds] = X^T*diag(counts)*Y
+        # So never need to build resampled copies of the design matrix or voxel data.
+        n_trn = trn_data_use.shape[0]
+        n_out = out_data_use.shape[0]
         
         for ii in range(self.n_boot_iters):
             
             if not np.mod(ii, 100):
                 print('bootstrap resampled fitting, iteration %d of %d'%(ii, self.n_boot_iters))
+                sys.stdout.flush()
+                
+            _counts_trn = torch.as_tensor(np.bincount(self.boot_inds_trn[:,ii], minlength=n_trn), \
+                                          dtype=_xtrn.dtype, device=self.device)
+            _counts_out = torch.as_tensor(np.bincount(self.boot_inds_out[:,ii], minlength=n_out), \
+                                          dtype=_xout.dtype, device=self.device)
             
-            _vtrn = torch_utils._to_torch(trn_data_use[:,voxel_batch_inds], device=self.device)
-            _vout = torch_utils._to_torch(out_data_use[:,voxel_batch_inds], device=self.device)
-        
-            # apply resampling order to voxel data
-            _vtrn = _vtrn[self.boot_inds_trn[:,ii],:]
-            _vout = _vout[self.boot_inds_out[:,ii],:]
+            # this is the same for all voxel batches, so only do it once per iteration
+            _cof = self.__solver_fn__(_xtrn, self.lambda_vectors[pp][:,nonzero_inds_full], \
+                                      _weights=_counts_trn)
             
-            # apply resampling order to design matrix too
-            _cof = self.__cofactor_fn_cpu__(_xtrn[self.boot_inds_trn[:,ii],:], self.lambda_vectors[pp][:,nonzero_inds_full])
+            for vv in range(n_voxel_batches):
+                
+                vinds = np.arange(self.voxel_batch_size*vv, \
+                          np.min([self.voxel_batch_size*(vv+1), len(voxels_to_fit)]))
+                voxel_batch_inds = voxels_to_fit[vinds]
+                
+                self.__fit_voxel_batch_bootstrap__(_cof, _xout, _counts_out, \
+                                trn_data_use, out_data_use, \
+                                nonzero_inds_full, \
+                                mm, pp, ii, voxel_batch_inds)
             
-            # Fit weights and get prediction loss here
-            _beta, _loss = self.__loss_fn__(_cof, \
-                                            _vtrn, \
-                                            _xout[self.boot_inds_out[:,ii],:], \
-                                            _vout) 
-           
-            # choose best lambda value and the loss that went with it.
-            # loss is size: [lambdas x voxels]
-            _best_loss_values, _best_lambda_index = torch.min(_loss, dim=0)
+            _cof = None
+            gc.collect()
+        
+    def __fit_voxel_batch_bootstrap__(self, _cof, _xout, _counts_out, \
+                                    trn_data_use, out_data_use, \
+                                    nonzero_inds_full, \
+                                    mm, pp, ii, voxel_batch_inds):
+       
+        _vtrn = torch_utils._to_torch(trn_data_use[:,voxel_batch_inds], device=self.device)
+        _vout = torch_utils._to_torch(out_data_use[:,voxel_batch_inds], device=self.device)
 
-            # back to numpy now
-            best_loss_values = torch_utils.get_value(_best_loss_values)
-            best_lambda_index =  torch_utils.get_value(_best_lambda_index)
+        # Fit weights and get prediction loss here
+        # (loss is weighted by how many times each held-out trial was resampled)
+        _beta, _loss = self.__loss_fn__(_cof, _vtrn, _xout, _vout, _weights_out=_counts_out) 
 
-            # betas is size: [lambdas x features x voxels]
-            betas = torch_utils.get_value(_beta)
-            # choose betas that go with best lambda (reduce to size [features x voxels])
-            betas = np.array([betas[best_lambda_index[ii],:,ii] for ii in range(len(best_lambda_index))])
+        # choose best lambda value and the loss that went with it.
+        # loss is size: [lambdas x voxels]
+        _best_loss_values, _best_lambda_index = torch.min(_loss, dim=0)
 
-            betas_all[:,:,ii] = betas
-            
-            betas = None
-            gc.collect()
-            
-        # for permutation analysis, we already fit pRFs so always saving all voxels.
+        # betas is size: [lambdas x features x voxels]
+        # choose betas that go with best lambda (reduce to size [voxels x features])
+        _beta = self.__select_best_lambda__(_beta, _best_lambda_index).T
+
+        # back to numpy now
+        best_loss_values = torch_utils.get_value(_best_loss_values)
+        best_lambda_index =  torch_utils.get_value(_best_lambda_index)
+        betas = torch_utils.get_value(_beta)
+
+        # for bootstrap analysis, we already fit pRFs so always saving all voxels.
         voxel_inds_save = voxel_batch_inds
 
         self.best_prf_models[voxel_inds_save,pp] = mm
 
-        # only saving one lambda and loss, because they'll get very large and we don't really need them.
-        self.best_lambdas[voxel_inds_save,pp] = best_lambda_index
-        self.best_losses[voxel_inds_save,pp] = best_loss_values                
+        if ii==self.n_boot_iters-1:
+            # only saving one lambda and loss (from last iteration), 
+            # because they'll get very large and we don't really need them.
+            self.best_lambdas[voxel_inds_save,pp] = best_lambda_index
+            self.best_losses[voxel_inds_save,pp] = best_loss_values                
 
         # make sure to save all the weights, because we still need to evaluate the model
         # taking the weights associated with the best lambda value
         # if there are fewer features defined than self.max_features,
         # then we'll have some zeros in this matrix 
-        best_w_tmp = self.best_w_params[voxel_inds_save,:,pp,:] # don't copy, save space
-        # best_w_tmp = copy.deepcopy(self.best_w_params[voxel_inds_save,:,pp,:])
-        best_w_tmp[:,nonzero_inds_full,:] = betas_all             
-        best_w_tmp[:,~nonzero_inds_full,:] = 0.0 # make sure to fill zeros here
+        best_w_tmp = self.best_w_params[voxel_inds_save,:,pp,ii] 
+        best_w_tmp[:,nonzero_inds_full] = betas             
+        best_w_tmp[:,~nonzero_inds_full] = 0.0 # make sure to fill zeros here
 
         # put this back into full sized array.
-        self.best_w_params[voxel_inds_save,:,pp,:] = best_w_tmp
+        self.best_w_params[voxel_inds_save,:,pp,ii] = best_w_tmp
 
         best_w_tmp = None
-        betas_all = None
-        best_lambda_index = None
-        best_loss_values = None
-        gc.collect()
+        betas = None
            
                 
-    def __cofactor_fn_cpu__(self, _x, lambda_vectors):
+    def __solver_fn__(self, _x, lambda_vectors, _weights=None):
+        
+        '''
+        Prepare the part of the ridge regression solution that is shared by all voxels.
+        Uses the eigendecomposition (SVD) solver if requested and if the lambda vectors allow it, 
+        otherwise falls back to computing a cofactor matrix for each lambda.
+        _weights is an optional [nTrials] vector of weights for each trial 
+        (e.g. bootstrap resampling counts). 
+        '''
+        if self.ridge_solver=='eig' and self.__lambdas_isotropic__(lambda_vectors) \
+                    and (_x.shape[1] > int(self.add_bias)):
+            return self.__eig_fn_cpu__(_x, lambda_vectors, _weights=_weights)
+        else:
+            return self.__cofactor_fn_cpu__(_x, lambda_vectors, _weights=_weights)
+        
+    def __gram_terms_cpu__(self, trn_features, trn_data_use, voxels_to_fit, n_voxel_batches):
+        
+        '''
+        Compute X^T*X [nFeatures x nFeatures] and X^T*Y [nFeatures x nVoxels] for the full 
+        design matrix of this pRF (all defined features), for the voxels being fit.
+        These are done once per pRF, and then used for all the partial versions of the model.
+        Done in floating point-64 precision (like __cofactor_fn_cpu__), since the weights are 
+        made from these by multiplying with the inverse, which can have large values for small lambdas.
+        '''
+        _x = torch.as_tensor(trn_features, device=self.device).to(torch.float64)
+        _gram = (_x.T @ _x).to('cpu')
+        
+        _xty = torch.zeros((_x.shape[1], len(voxels_to_fit)), dtype=torch.float64, device=self.device)
+        for vv in range(n_voxel_batches):
+            vinds = np.arange(self.voxel_batch_size*vv, \
+                          np.min([self.voxel_batch_size*(vv+1), len(voxels_to_fit)]))
+            _vtrn = torch.as_tensor(trn_data_use[:,voxels_to_fit[vinds]], device=self.device).to(torch.float64)
+            _xty[:,vinds] = _x.T @ _vtrn
+            
+        return _gram, _xty
+    
+    def __gram_fn_cpu__(self, _gram, _xty, nonzero_inds_short, lambda_vectors, type_orig):
+        
+        '''
+        Alternative to __cofactor_fn_cpu__, using the X^T*X and X^T*Y from __gram_terms_cpu__.
+        For one partial version of the model, take the blocks for its features, and
+        get (X^T*X + I*lambda)^-1 for each lambda [nLambdas x nFeatures x nFeatures].
+        Weights are then (X^T*X + I*lambda)^-1 * X^T*Y, so the trials dimension never comes in.
+        Returns a dict of the terms needed by __loss_fn__.
+        '''
+        _inds = torch.as_tensor(np.where(nonzero_inds_short)[0])
+        mult = _gram[_inds][:,_inds]
+        _f = self.__ridge_inverse_cpu__(mult, lambda_vectors)
+        
+        _gram_terms = {'f': _f.to(_xty.device), \
+                       'xty': _xty[_inds.to(_xty.device)], \
+                       'type': type_orig}
+        
+        return _gram_terms
+    
+    def __gram_select_voxels__(self, _gram_terms, vinds):
+        '''
+        Take the X^T*Y columns for one batch of voxels, from output of __gram_fn_cpu__.
+        '''
+        _gram_terms_batch = dict(_gram_terms)
+        _gram_terms_batch['xty'] = _gram_terms['xty'][:,vinds]
+        return _gram_terms_batch
+        
+    def __lambdas_isotropic__(self, lambda_vectors):
+        
+        '''
+        Check whether each lambda vector applies the same penalty to every feature 
+        (other than the intercept, which always has lambda=0).
+        If not (i.e. set_lambda_per_group gave different lambdas to different groups), 
+        the SVD solver can't be used.
+        '''
+        if self.add_bias:
+            if np.any(lambda_vectors[:,-1]!=0):
+                return False
+            lambda_vectors = lambda_vectors[:,0:-1]
+        return np.all(lambda_vectors==lambda_vectors[:,0:1])
+        
+    def __eig_fn_cpu__(self, _x, lambda_vectors, _weights=None):
+        
+        '''
+        Alternative to __cofactor_fn_cpu__, for the case where each lambda vector is isotropic.
+        Do a single SVD of the (centered) training design matrix, X = U*S*V^T. Then 
+        ridge solution for every lambda is:
+        w = V * diag(s/(s^2+lambda)) * U^T * Y
+        so no inverse or [nLambdas x nFeatures x nTrials] cofactor is needed.
+        If add_bias, the intercept column is left out of the SVD and the intercept is 
+        recovered from the feature means (equivalent to leaving intercept unpenalized).
+        Returns a dict of the terms needed by __loss_fn__.
+        SVD is done on the cpu in floating point-64 precision, like __cofactor_fn_cpu__.
+        If _weights are given, the SVD is of diag(sqrt(weights))*X, and the weights are 
+        folded into U^T, so that the weighted solution comes from multiplying by Y as usual.
+        '''
+        device_orig = _x.device
+        type_orig = _x.dtype
+        _x = _x.to('cpu').to(torch.float64)
+        
+        if _weights is not None:
+            _c = _weights.to('cpu').to(torch.float64)
+            # normalized weights, for taking weighted means
+            _w = _c / torch.sum(_c)
+        else:
+            _w = None
+            
+        if self.add_bias:
+            # intercept is always the last column
+            _x = _x[:,0:-1]
+            if _w is not None:
+                _xm = torch.sum(_w[:,None] * _x, axis=0, keepdims=True)
+            else:
+                _xm = torch.mean(_x, axis=0, keepdims=True)
+            _x = _x - _xm
+        else:
+            _xm = None
+        
+        if _w is not None:
+            _x = torch.sqrt(_c)[:,None] * _x
+        
+        _u, _s, _vt = torch.linalg.svd(_x, full_matrices=False)
+        if _w is not None:
+            _u = torch.sqrt(_c)[:,None] * _u
+        
+        # treat singular values that are numerically zero as exactly zero (minimum-norm solution)
+        tol = torch.max(_s) * max(_x.shape) * torch.finfo(torch.float64).eps
+        _lambdas = torch.tensor(np.asarray(lambda_vectors)[:,0:1], dtype=torch.float64)
+        _s = _s[None,:]
+        _d = torch.where(_s>tol, _s/(_s**2 + _lambdas), torch.zeros_like(_s))
+        # _d is [lambdas x n_components]
+        
+        _eig = {'ut': _u.T.to(device_orig).to(type_orig), \
+                'v': _vt.T.to(device_orig).to(type_orig), \
+                'd': _d.to(device_orig).to(type_orig), \
+                'xm': _xm.to(device_orig).to(type_orig) if _xm is not None else None, \
+                'w': _w.to(device_orig).to(type_orig) if _w is not None else None}
+        
+        return _eig
+        
+    def __select_best_lambda__(self, _beta, _best_lambda_index):
+        '''
+        Pick out the betas that go with best lambda for each voxel, without leaving the device.
+        _beta is [#lambdas, #features, #voxels(, #shuff_iters)] 
+        _best_lambda_index is [#voxels(, #shuff_iters)]
+        returns [#features, #voxels(, #shuff_iters)]
+        '''
+        _index = _best_lambda_index[None,None].expand(1, _beta.shape[1], *_best_lambda_index.shape)
+        return torch.gather(_beta, 0, _index)[0]
+        
+    def __cofactor_fn_cpu__(self, _x, lambda_vectors, _weights=None):
 
         '''
         Generating a matrix needed to solve ridge regression model for each lambda value.
@@ -682,6 +1091,7 @@ class encoding_model():
         This func will return (X^T*X + I*lambda)^-1 * X^T. 
         So once we have that, can just multiply by training data (Y) to get weights.
         returned size is [nLambdas x nFeatures x nTrials]
+        If _weights are given, this is weighted least squares: (X^T*W*X + I*lambda)^-1 * X^T*W.
         This version makes sure that the torch inverse operation is done on the cpu, and in 
         floating point-64 precision. 
         Otherwise it can give bad results for small lambdas (may be cuda-version-dependent).
@@ -691,8 +1101,30 @@ class encoding_model():
         # switch to this specific format which works with inverse
         _x = _x.to('cpu').to(torch.float64)
        
-        mult = _x.T @ _x
-        ridge_term = torch.eye(_x.size()[1], device='cpu', dtype=torch.float64)
+        if _weights is not None:
+            # X^T*diag(weights), used in place of X^T everywhere below
+            _xt = _x.T * _weights.to('cpu').to(torch.float64)[None,:]
+        else:
+            _xt = _x.T
+        mult = _xt @ _x
+        _f = self.__ridge_inverse_cpu__(mult, lambda_vectors)
+            
+        # [lambdas x features x features] x [images x features]
+        cof = torch.tensordot(_f.to(device_orig), \
+                              _xt.T.to(device_orig), \
+                              dims=[[2],[1]]) 
+        # return [lambdas x features x samples]
+        
+        # put back to whatever way it was before, so that we can continue with other operations as usual
+        return cof.to(type_orig)
+
+    def __ridge_inverse_cpu__(self, mult, lambda_vectors):
+        
+        '''
+        Get (X^T*X + I*lambda)^-1 for each lambda vector, given X^T*X (cpu, float64).
+        Returns [nLambdas x nFeatures x nFeatures]
+        '''
+        ridge_term = torch.eye(mult.size()[0], device='cpu', dtype=torch.float64)
         
         try: 
            
@@ -703,10 +1135,10 @@ class encoding_model():
             # problem with inverse - print some info to help diagnose the problem.
             # usually due to zero columns or duplicate columns.
             print('WARNING: Problem with inverse in _cofactor_fn_cpu.')
-            print('Size of _x (trials x features):')
-            print(_x.shape)
-            print('Rank of _x:')
-            print(torch.matrix_rank(_x))
+            print('Size of X^T*X (features x features):')
+            print(mult.shape)
+            print('Rank of X^T*X:')
+            print(torch.linalg.matrix_rank(mult))
             # to prevent a crash, replace 0 with a small lambda value, just temporarily
             lambdas_adjusted = copy.deepcopy(lambda_vectors)
             lambdas_adjusted[lambdas_adjusted==0] = 10e-9
@@ -715,30 +1147,58 @@ class encoding_model():
             _f = torch.stack([(mult+ridge_term*l).inverse() \
                        for l in lambdas_adjusted], axis=0)
             
-        # [lambdas x features x features] x [images x features]
-        cof = torch.tensordot(_f.to(device_orig), \
-                              _x.to(device_orig), \
-                              dims=[[2],[1]]) 
-        # return [lambdas x features x samples]
-        
-        # put back to whatever way it was before, so that we can continue with other operations as usual
-        return cof.to(type_orig)
-
-    def __loss_fn__(self, _cofactor, _vtrn, _xout, _vout):
+        return _f
+    
+    def __loss_fn__(self, _cofactor, _vtrn, _xout, _vout, _weights_out=None):
         '''
         Calculate loss given "cofactor" from cofactor_fn, training data, held-out design matrix, held out data.
         returns weights (betas) based on equation
         w = (X^T*X + I*lambda)^-1 * X^T * Y
         also returns loss for these weights w the held out data. SSE is loss func here.
+        _cofactor can also be the dict returned by __eig_fn_cpu__ or __gram_fn_cpu__.
+        _vtrn and _vout can have an extra last dim for shuffle iterations, then betas
+        are [#lambdas, #features, #voxels, #shuff_iters] and loss is [#lambdas, #voxels, #shuff_iters].
+        _weights_out is an optional [nSamples] vector of weights for each held-out trial's error.
         '''
 
-        _beta = torch.tensordot(_cofactor, _vtrn, dims=[[2], [0]]) # [#lambdas, #feature, #voxel]
+        if isinstance(_cofactor, dict) and ('f' in _cofactor.keys()):
+            # (X^T*X + I*lambda)^-1 * X^T*Y, with X^T*Y already computed
+            _beta = torch.tensordot(_cofactor['f'], _cofactor['xty'], \
+                                    dims=[[2], [0]]).to(_cofactor['type']) # [#lambdas, #feature, #voxel]
+        elif isinstance(_cofactor, dict):
+            _beta = self.__beta_fn_eig__(_cofactor, _vtrn)
+        else:
+            _beta = torch.tensordot(_cofactor, _vtrn, dims=[[2], [0]]) # [#lambdas, #feature, #voxel]
         _pred = torch.tensordot(_xout, _beta, dims=[[1],[1]]) # [#samples, #lambdas, #voxels]
-        _loss = torch.sum(torch.pow(_vout[:,None,:] - _pred, 2), dim=0) # [#lambdas, #voxels]
+        if _weights_out is not None:
+            _loss = torch.tensordot(_weights_out, torch.pow(_vout[:,None,:] - _pred, 2), dims=[[0],[0]]) # [#lambdas, #voxels]
+        else:
+            _loss = torch.sum(torch.pow(_vout[:,None,:] - _pred, 2), dim=0) # [#lambdas, #voxels]
         
              
         return _beta, _loss
 
+    def __beta_fn_eig__(self, _eig, _vtrn):
+        '''
+        Get weights for all lambdas from the SVD terms computed in __eig_fn_cpu__.
+        _vtrn can be [#samples, #voxels] or [#samples, #voxels, #shuff_iters]
+        returns [#lambdas, #features, #voxels(, #shuff_iters)], same as the cofactor version.
+        '''
+        _uty = torch.tensordot(_eig['ut'], _vtrn, dims=[[1], [0]]) # [#components, #voxels, ...]
+        _beta = torch.einsum('fk,lk,k...->lf...', _eig['v'], _eig['d'], _uty) # [#lambdas, #feature, #voxel, ...]
+        
+        if _eig['xm'] is not None:
+            # intercept = mean(y) - mean(x)*w
+            if _eig['w'] is not None:
+                _ym = torch.tensordot(_eig['w'], _vtrn, dims=[[0], [0]])
+            else:
+                _ym = torch.mean(_vtrn, axis=0)
+            _bias = _ym[None] \
+                        - torch.tensordot(_eig['xm'][0], _beta, dims=[[0], [1]]) # [#lambdas, #voxel, ...]
+            _beta = torch.cat([_beta, _bias[:,None]], axis=1)
+            
+        return _beta
+
 
     def validate(self, \
                  voxel_data_val=None, \
@@ -887,6 +1347,12 @@ class encoding_model():
         print('prf %d: using %d validation set trials'%(mm, np.sum(trials_use)))
         sys.stdout.flush()
         
+        # all voxels here have the same pRF, so they share one design matrix [trials x max_features]
+        # Note there may be some zeros in this matrix, if we used fewer than the 
+        # max number of features.
+        # But they are zero in weight matrix too, so turns out ok.
+        features_full = features_full[:,:,0]
+        
         # Next looping over all voxels with this same pRF, in batches        
         for vv in range(n_voxel_batches):
 
@@ -903,93 +1369,96 @@ class encoding_model():
             if vv>1 and self.debug:
                 continue
 
-            # Looping over versions of model w different features set to zero (variance partition)
-            for pp in range(self.n_partial_versions):
-
-                print('\nEvaluating version %d of %d: %s'%(pp, self.n_partial_versions, self.partial_version_names[pp]))
-                sys.stdout.flush()
-        
-                # masks describes the indices of the features that are included in this partial model
-                # n_features_max in length
-                features_to_use = self.masks[0:self.max_features,pp]
-                print('Includes %d features'%np.sum(features_to_use))
+            if self.shuffle_data or (self.bootstrap_data and not self.boot_val_only):
+                
+                # Looping over versions of model w different features set to zero (variance partition)
+                for pp in range(self.n_partial_versions):
+
+                    print('\nEvaluating version %d of %d: %s'%(pp, self.n_partial_versions, self.partial_version_names[pp]))
+                    sys.stdout.flush()
+
+                    # masks describes the indices of the features that are included in this partial model
+                    # n_features_max in length
+                    features_to_use = self.masks[0:self.max_features,pp]
+                    print('Includes %d features'%np.sum(features_to_use))
+                    sys.stdout.flush()
+
+                    if self.shuffle_data:
+                        self.__get_preds_one_batch_shuffle__(features_full, \
+                                                     features_to_use, \
+                                                     trials_use, \
+                                                     voxel_data_use, 
+                                                     voxel_batch_inds, pp)
+                    else:
+                        self.__get_preds_one_batch_bootstrap__(features_full, \
+                                                     features_to_use, \
+                                                     trials_use, \
+                                                     voxel_data_use, 
+                                                     voxel_batch_inds, pp)
+                    gc.collect()
+                    
+            else:
+                
+                # Evaluating all versions of the model (variance partition) at once here
+                print('\nEvaluating %d versions: %s'%(self.n_partial_versions, self.partial_version_names))
                 sys.stdout.flush()
-        
-                # Take out the relevant features now
-                features = np.tile(features_full[:,features_to_use,:], [1,1,len(voxel_batch_inds)])
-                # Note there may be some zeros in this matrix, if we used fewer than the 
-                # max number of features.
-                # But they are zero in weight matrix too, so turns out ok.
-
-                if self.shuffle_data:
-                    self.__get_preds_one_batch_shuffle__(features, \
-                                                 features_to_use, \
-                                                 trials_use, \
-                                                 voxel_data_use, 
-                                                 voxel_batch_inds, pp)
-                elif self.bootstrap_data and not self.boot_val_only:
-                    self.__get_preds_one_batch_bootstrap__(features, \
-                                                 features_to_use, \
-                                                 trials_use, \
-                                                 voxel_data_use, 
-                                                 voxel_batch_inds, pp)
-                elif self.bootstrap_data and self.boot_val_only:
-                    self.__get_preds_one_batch_bootstrap_val_only__(features, \
-                                                 features_to_use, \
+                
+                if self.bootstrap_data and self.boot_val_only:
+                    self.__get_preds_one_batch_bootstrap_val_only__(features_full, \
                                                  trials_use, \
                                                  voxel_data_use, 
-                                                 voxel_batch_inds, pp)
+                                                 voxel_batch_inds)
                 else:
-                    self.__get_preds_one_batch__(features, \
-                                                 features_to_use, \
+                    self.__get_preds_one_batch__(features_full, \
                                                  trials_use, \
                                                  voxel_data_use, 
-                                                 voxel_batch_inds, pp)
+                                                 voxel_batch_inds)
                 gc.collect()
                     
+    def __get_preds_all_versions__(self, features, voxel_batch_inds):
+        
+        '''
+        Get predictions for a batch of voxels that all have the same pRF, for all 
+        partial versions of the model at once.
+        features is [trials x max_features], shared by all voxels in the batch.
+        Weights for features left out of a partial version are set to zero, so the 
+        predictions for every voxel and version come from one [trials x features] x 
+        [features x (voxels*versions)] matrix multiplication.
+        Returns [trials x voxels x partial versions]
+        '''
+        # weights is [voxels x features x partial versions]
+        weights = self.best_weights[voxel_batch_inds,:,:] * \
+                    self.masks[None,0:self.max_features,:].astype(self.best_weights.dtype)
+        _weights = torch_utils._to_torch(weights, device=self.device)
+        _features = torch_utils._to_torch(features, device=self.device)
+        
+        # _r will be [trials x voxels x partial versions]
+        _r = torch.tensordot(_features, _weights, dims=[[1],[1]])
+        
+        if self.best_biases is not None:
+            # bias is [voxels x partial versions]
+            _bias = torch_utils._to_torch(self.best_biases[voxel_batch_inds,:], device=self.device)
+            _r = _r + _bias[None,:,:]
+            
+        return torch_utils.get_value(_r)
+    
     def __get_preds_one_batch__(self, features, \
-                                         features_to_use, \
                                          trials_use, \
                                          voxel_data_use, 
-                                         voxel_batch_inds, pp):
+                                         voxel_batch_inds):
          
-        _weights = torch_utils._to_torch(self.best_weights[voxel_batch_inds,:,pp], device=self.device)         
-        _weights = _weights[:, features_to_use]
-        _bias = torch_utils._to_torch(self.best_biases[voxel_batch_inds,pp], device=self.device)
-
-        n_trials_use = np.sum(trials_use)
-        pred_block = np.full(fill_value=0, shape=(n_trials_use, len(voxel_batch_inds)), dtype=self.dtype)
-
-        # Now looping over validation set trials in batches
-        n_trial_batches = int(np.ceil(n_trials_use/self.sample_batch_size))
-        for ti in range(n_trial_batches):
-
-            trial_batch_inds = np.arange(self.sample_batch_size*ti, np.min([self.sample_batch_size*(ti+1), n_trials_use]))
-
-            # features is [trials x features x voxels]
-            _features = torch_utils._to_torch(features[trial_batch_inds,:,:], device=self.device)
-            # swap dims to [voxels x trials x features]
-            _features = torch.transpose(torch.transpose(_features, 0, 2), 1, 2)
-            # weights is [voxels x features]
-            # _r will be [voxels x trials x 1] - then [trials x voxels]
-            
-            _r = torch.squeeze(torch.bmm(_features, torch.unsqueeze(_weights, 2)), dim=2).t() 
-
-            if _bias is not None:
-                _r = _r + torch.tile(torch.unsqueeze(_bias, 0), [_r.shape[0],1])
-
-            pred_block[trial_batch_inds] = torch_utils.get_value(_r) 
+        # pred_block is [trials x voxels x partial versions]
+        pred_block = self.__get_preds_all_versions__(features, voxel_batch_inds)
 
         if voxel_data_use is not None:
-            # Now for this batch of voxels and this partial version of the model, measure performance.
-            if self.do_corrcoef:
-                self.val_cc[voxel_batch_inds,pp] = stats_utils.get_corrcoef(voxel_data_use[:,voxel_batch_inds], pred_block)
-            self.val_r2[voxel_batch_inds,pp] = stats_utils.get_r2(voxel_data_use[:,voxel_batch_inds], pred_block)
+            # Now for this batch of voxels and each partial version of the model, measure performance.
+            for pp in range(self.n_partial_versions):
+                if self.do_corrcoef:
+                    self.val_cc[voxel_batch_inds,pp] = stats_utils.get_corrcoef(voxel_data_use[:,voxel_batch_inds], pred_block[:,:,pp])
+                self.val_r2[voxel_batch_inds,pp] = stats_utils.get_r2(voxel_data_use[:,voxel_batch_inds], pred_block[:,:,pp])
 
         # Make sure to save the trial-wise predictions, for use in analyses later on 
-        pred_these_trials = self.pred_voxel_data[trials_use,:,pp]
-        pred_these_trials[:,voxel_batch_inds] = pred_block
-        self.pred_voxel_data[trials_use,:,pp] = pred_these_trials
+        self.pred_voxel_data[np.ix_(trials_use, voxel_batch_inds)] = pred_block
 
         sys.stdout.flush()
 
@@ -1011,61 +1480,45 @@ class encoding_model():
         assert(n_trials_use==features.shape[0]) 
         pred_block = np.full(fill_value=0, shape=(n_trials_use, len(voxel_batch_inds), self.n_shuff_iters), dtype=self.dtype)
 
-        # Now looping over validation set trials in batches
-        n_trial_batches = int(np.ceil(n_trials_use/self.sample_batch_size))
-        for ti in range(n_trial_batches):
-            
-            trial_batch_inds = np.arange(self.sample_batch_size*ti, np.min([self.sample_batch_size*(ti+1), n_trials_use]))
-
-            _features = torch_utils._to_torch(features[trial_batch_inds,:,:], device=self.device)
-            # features is [#samples, #features, #voxels]
-            # swap dims to [#voxels, #samples, features]
-            _features = torch.transpose(torch.transpose(_features, 0, 2), 1, 2)
-
-            r_all = np.zeros((len(voxel_batch_inds), len(trial_batch_inds), self.n_shuff_iters), dtype=self.dtype)
+        # features is [#samples, #features], same for all voxels
+        _features = torch_utils._to_torch(features[:,features_to_use], device=self.device)
            
-            # also batching over shuffle iterations
-            for bb, batch_inds in enumerate(self.shuff_batch_inds):
+        # batching over shuffle iterations
+        for bb, batch_inds in enumerate(self.shuff_batch_inds):
 
-                print('permutation test, batch %d of %d'%(bb, len(self.shuff_batch_inds)))
+            print('permutation test, batch %d of %d'%(bb, len(self.shuff_batch_inds)))
 
-                _weights = torch_utils._to_torch(weights[:,:,batch_inds], device=self.device)
-                _bias = torch_utils._to_torch(bias[:,batch_inds], device=self.device)
-                
-                # _r will be [voxels x samples x n_shuff_iters]
-                _r = torch.bmm(_features, _weights)
+            _weights = torch_utils._to_torch(weights[:,:,batch_inds], device=self.device)
+            _bias = torch_utils._to_torch(bias[:,batch_inds], device=self.device)
 
-                if _bias is not None:
-                    _r = _r + torch.tile(torch.unsqueeze(_bias, 1), [1,_r.shape[1],1])
+            # _r will be [samples x voxels x n_shuff_iters]
+            _r = torch.tensordot(_features, _weights, dims=[[1],[1]])
 
-                r_all[:,:,batch_inds] = torch_utils.get_value(_r)
-            
-            pred_block[trial_batch_inds,:,:] = np.moveaxis(r_all, [0], [1])
-            # pred_block[trial_batch_inds,:,:] = torch_utils.get_value(torch.transpose(_r, 0,1 ))
+            if _bias is not None:
+                _r = _r + _bias[None,:,:]
 
+            pred_block[:,:,batch_inds] = torch_utils.get_value(_r)
+            
         if self.trials_use_each_prf_val is not None:
             sinds_val = self.shuff_inds_val_use
         else:
             sinds_val = self.shuff_inds_val
           
         # Now for this batch of voxels and this partial version of the model, measure performance.
-        for xx in range(self.n_shuff_iters):
-            # use the randomized validation set order here
-            shuff_order = sinds_val[:,xx]
-            shuff_dat = voxel_data_use[:,voxel_batch_inds][shuff_order,:]
-            if self.do_corrcoef:
-                self.val_cc[voxel_batch_inds,pp,xx] = stats_utils.get_corrcoef(shuff_dat, pred_block[:,:,xx])
-            self.val_r2[voxel_batch_inds,pp,xx] = stats_utils.get_r2(shuff_dat, pred_block[:,:,xx])
+        # use the randomized validation set order here, all shuffle iterations at once.
+        # shuff_dat is [samples x voxels x n_shuff_iters], same as pred_block
+        shuff_dat = np.moveaxis(voxel_data_use[:,voxel_batch_inds][sinds_val,:], [0,1,2], [0,2,1])
+        if self.do_corrcoef:
+            self.val_cc[voxel_batch_inds,pp,:] = stats_utils.get_corrcoef(shuff_dat, pred_block)
+        self.val_r2[voxel_batch_inds,pp,:] = stats_utils.get_r2(shuff_dat, pred_block)
+        shuff_dat = None
 
         # We don't need to save every trial-wise prediction here because they'll get very large.
         # just save the first one in case we want to check values later.
-        pred_these_trials = self.pred_voxel_data[trials_use,:,pp]
-        pred_these_trials[:,voxel_batch_inds] = pred_block[:,:,0]
-        self.pred_voxel_data[trials_use,:,pp] = pred_these_trials
+        self.pred_voxel_data[np.ix_(trials_use, voxel_batch_inds, [pp])] = pred_block[:,:,0:1]
 
         sys.stdout.flush()
         
-        r_all = None;
         pred_block = None;
         gc.collect()
 
@@ -1084,44 +1537,41 @@ class encoding_model():
 
         n_trials_use = np.sum(trials_use)
         assert(n_trials_use==features.shape[0]) 
-        # pred_block = np.full(fill_value=0, shape=(n_trials_use, len(voxel_batch_inds), self.n_boot_iters), dtype=self.dtype)
+        
+        # features is [#samples, #features], same for all voxels
+        _features = torch_utils._to_torch(features[:,features_to_use], device=self.device)
 
         for ii in range(self.n_boot_iters):
             
             if not np.mod(ii, 100):
                 print('bootstrap resampled validation, iter %d of %d'%(ii, self.n_boot_iters))
 
-            # apply resampling order to design matrix for validation set (features)
-            _features = torch_utils._to_torch(features[self.boot_inds_val[:,ii],:,:], device=self.device)
-            # features is [#samples, #features, #voxels]
-            # swap dims to [#voxels, #samples, features]
-            _features = torch.transpose(torch.transpose(_features, 0, 2), 1, 2)
-
             _weights = torch_utils._to_torch(weights[:,:,ii], device=self.device)
             _bias = torch_utils._to_torch(bias[:,ii], device=self.device)
 
             # weights is [voxels x features]
-            # _r will be [voxels x trials x 1] - then [trials x voxels]
-            _r = torch.squeeze(torch.bmm(_features, torch.unsqueeze(_weights, 2)), dim=2).t() 
+            # apply resampling order to the predictions (same as resampling design matrix)
+            # _r will be [trials x voxels]
+            _r = (_features @ _weights.T)[self.boot_inds_val[:,ii],:]
 
             if _bias is not None:
-                _r = _r + torch.tile(torch.unsqueeze(_bias, 0), [_r.shape[0],1])
+                _r = _r + _bias[None,:]
 
-            _r = _r.detach().cpu().numpy()
-            # pred_block[:,:,ii] = _r
-            
             # Measure performance
             # Make sure to apply re-sampling order to the validation set data here.
             shuff_dat = voxel_data_use[:,voxel_batch_inds][self.boot_inds_val[:,ii],:]
             if self.do_corrcoef:
-                self.val_cc[voxel_batch_inds,pp,ii] = stats_utils.get_corrcoef(shuff_dat, _r)
+                # correlation on the same device as the predictions
+                _shuff_dat = torch_utils._to_torch(shuff_dat, device=self.device)
+                self.val_cc[voxel_batch_inds,pp,ii] = torch_utils.get_value(stats_utils.get_corrcoef_torch(_shuff_dat, _r))
+                
+            _r = _r.detach().cpu().numpy()
+            
             self.val_r2[voxel_batch_inds,pp,ii] = stats_utils.get_r2(shuff_dat, _r)
 
         # We don't need to save every trial-wise prediction here because they'll get very large.
         # just save one in case we want to check values later.
-        pred_these_trials = self.pred_voxel_data[trials_use,:,pp]
-        pred_these_trials[:,voxel_batch_inds] = _r
-        self.pred_voxel_data[trials_use,:,pp] = pred_these_trials
+        self.pred_voxel_data[np.ix_(trials_use, voxel_batch_inds, [pp])] = _r[:,:,None]
 
         sys.stdout.flush()
         
@@ -1130,37 +1580,12 @@ class encoding_model():
         gc.collect()
         
     def __get_preds_one_batch_bootstrap_val_only__(self, features, \
-                                                 features_to_use, \
                                                  trials_use, \
                                                  voxel_data_use, 
-                                                 voxel_batch_inds, pp):
-
+                                                 voxel_batch_inds):
 
-        _weights = torch_utils._to_torch(self.best_weights[voxel_batch_inds,:,pp], device=self.device)   
-        _weights = _weights[:, features_to_use]
-        _bias = torch_utils._to_torch(self.best_biases[voxel_batch_inds,pp], device=self.device)
-
-        n_trials_use = np.sum(trials_use)
-        pred_block = np.full(fill_value=0, shape=(n_trials_use, len(voxel_batch_inds)), dtype=self.dtype)
-
-        # Now looping over validation set trials in batches
-        n_trial_batches = int(np.ceil(n_trials_use/self.sample_batch_size))
-        for ti in range(n_trial_batches):
-
-            trial_batch_inds = np.arange(self.sample_batch_size*ti, np.min([self.sample_batch_size*(ti+1), n_trials_use]))
-
-            # features is [trials x features x voxels]
-            _features = torch_utils._to_torch(features[trial_batch_inds,:,:], device=self.device)
-            # swap dims to [voxels x trials x features]
-            _features = torch.transpose(torch.transpose(_features, 0, 2), 1, 2)
-            # weights is [voxels x features]
-            # _r will be [voxels x trials x 1] - then [trials x voxels]
-            _r = torch.squeeze(torch.bmm(_features, torch.unsqueeze(_weights, 2)), dim=2).t() 
-
-            if _bias is not None:
-                _r = _r + torch.tile(torch.unsqueeze(_bias, 0), [_r.shape[0],1])
-
-            pred_block[trial_batch_inds] = torch_utils.get_value(_r) 
+        # pred_block is [trials x voxels x partial versions]
+        pred_block = self.__get_preds_all_versions__(features, voxel_batch_inds)
 
         for ii in range(self.n_boot_iters):
             
@@ -1169,17 +1594,67 @@ class encoding_model():
 
             # Measure performance, using this bootstrap resampled set of trials
             resamp_dat = voxel_data_use[:,voxel_batch_inds][self.boot_inds_val[:,ii],:]
-            resamp_pred = pred_block[self.boot_inds_val[:,ii],:]
-               
-            if self.do_corrcoef:
-                self.val_cc[voxel_batch_inds,pp,ii] = stats_utils.get_corrcoef(resamp_dat, resamp_pred)
-            self.val_r2[voxel_batch_inds,pp,ii] = stats_utils.get_r2(resamp_dat, resamp_pred)
+            
+            for pp in range(self.n_partial_versions):
+                resamp_pred = pred_block[self.boot_inds_val[:,ii],:,pp]
+                if self.do_corrcoef:
+                    self.val_cc[voxel_batch_inds,pp,ii] = stats_utils.get_corrcoef(resamp_dat, resamp_pred)
+                self.val_r2[voxel_batch_inds,pp,ii] = stats_utils.get_r2(resamp_dat, resamp_pred)
 
         # Make sure to save the trial-wise predictions, for use in analyses later on 
-        pred_these_trials = self.pred_voxel_data[trials_use,:,pp]
-        pred_these_trials[:,voxel_batch_inds] = pred_block
-        self.pred_voxel_data[trials_use,:,pp] = pred_these_trials
+        self.pred_voxel_data[np.ix_(trials_use, voxel_batch_inds)] = pred_block
 
         sys.stdout.flush()
 
+
+# Functions used by the worker processes in encoding_model.__fit_parallel__
+# (these need to be at module level so that the process pool can find them)
+
+_worker_model = None
+_worker_shm = []
+
+def _init_fit_worker(model, shm_info):
+    
+    global _worker_model
+    # workers are forked, and torch's thread pool can deadlock in a forked child if the 
+    # parent has already used it - so each worker only uses one thread.
+    torch.set_num_threads(1)
+    # each worker only does one batch of pRFs at a time, so don't prefetch the next one
+    for loader in getattr(model.feature_loader, 'modules', [model.feature_loader]):
+        loader.prefetch = False
+    # attach to the voxel data in shared memory (read only)
+    for name, (shm_name, shape, dtype) in shm_info.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker_shm.append(shm) # keep a reference so buffer stays open
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        data.flags.writeable = False
+        setattr(model, name, data)
+    _worker_model = model
+    
+def _fit_prf_chunk(prf_inds):
+    
+    # fit one chunk of pRFs, keeping a running best for this chunk only. 
+    model = _worker_model
+    model.__init_best_params__()
+    
+    with torch.no_grad():
+        for mm in prf_inds:
+            print('\nProcessing prf %d of %d (worker %d)'%(mm, model.n_prfs, os.getpid()))
+            model.__fit_one_prf__(mm)
+            gc.collect()
+            sys.stdout.flush()
             
+    model.feature_loader.clear_big_features()
+    
+    if model.zscore:
+        features_mean = model.features_mean[prf_inds]
+        features_std = model.features_std[prf_inds]
+    else:
+        features_mean, features_std = None, None
+        
+    # only send back the voxels that this chunk fit
+    voxel_inds = np.where(np.any(model.best_prf_models>=0, axis=1))[0]
+        
+    return prf_inds, voxel_inds, model.best_losses[voxel_inds], model.best_lambdas[voxel_inds], \
+            model.best_prf_models[voxel_inds], model.best_w_params[voxel_inds], \
+            features_mean, features_std
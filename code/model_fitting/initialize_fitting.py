@@ -608,6 +608,7 @@ def make_feature_loaders(args, fitting_types, vi, dnn_layers_use=None):
                 prf_grid = args.which_prf_grid
             feat_loader = fwrf_features.fwrf_feature_loader(subject=sub,\
                                                             image_set=args.image_set,\
+                                                            prefetch=args.prefetch_features,\
                                                             which_prf_grid=prf_grid,\
                                                             feature_type='gabor_solo',\
                                                             n_ori=args.n_ori_gabor, n_sf=args.n_sf_gabor,\
@@ -621,6 +622,7 @@ def make_feature_loaders(args, fitting_types, vi, dnn_layers_use=None):
         elif 'pyramid' in ft:
             feat_loader = fwrf_features.fwrf_feature_loader(subject=sub,\
                                                             image_set=args.image_set,\
+                                                            prefetch=args.prefetch_features,\
                                                             which_prf_grid=args.which_prf_grid, \
                                                             feature_type='pyramid_texture',\
                                                             n_ori=args.n_ori_pyr, n_sf=args.n_sf_pyr,\
@@ -640,6 +642,7 @@ def make_feature_loaders(args, fitting_types, vi, dnn_layers_use=None):
                 prf_grid = args.which_prf_grid
             feat_loader = fwrf_features.fwrf_feature_loader(subject=sub,\
                                                             image_set=args.image_set,\
+                                                            prefetch=args.prefetch_features,\
                                                             which_prf_grid=prf_grid, \
                                                             feature_type='sketch_tokens',\
                                                             use_pca_feats = args.use_pca_st_feats, \
@@ -660,6 +663,7 @@ def make_feature_loaders(args, fitting_types, vi, dnn_layers_use=None):
                 prf_grid = args.which_prf_grid
             feat_loader = fwrf_features.fwrf_feature_loader(subject=sub,\
                                                             image_set=args.image_set,\
+                                                            prefetch=args.prefetch_features,\
                                                             which_prf_grid=prf_grid, \
                                                             feature_type='color',
                                                             pca_subject = pca_subject,
@@ -672,6 +676,7 @@ def make_feature_loaders(args, fitting_types, vi, dnn_layers_use=None):
             prf_grid=0
             feat_loader = fwrf_features.fwrf_feature_loader(subject=sub,\
                                                             image_set=args.image_set,\
+                                                            prefetch=args.prefetch_features,\
                                                             which_prf_grid=prf_grid, \
                                                             n_ori = args.n_ori_gist, \
                                                             n_blocks = args.n_blocks_gist, \
@@ -693,6 +698,7 @@ def make_feature_loaders(args, fitting_types, vi, dnn_layers_use=None):
                 for ll in range(len(names)):
                     feat_loader = fwrf_features.fwrf_feature_loader(subject=sub,\
                                                             image_set=args.image_set,\
+                                                            prefetch=args.prefetch_features,\
                                                             which_prf_grid=prf_grid, \
                                                             feature_type='alexnet',\
                                                             layer_name=names[ll],\
@@ -708,6 +714,7 @@ def make_feature_loaders(args, fitting_types, vi, dnn_layers_use=None):
                 print(this_layer_name)
                 feat_loader = fwrf_features.fwrf_feature_loader(subject=sub,\
                                                             image_set=args.image_set,\
+                                                            prefetch=args.prefetch_features,\
                                                             which_prf_grid=prf_grid, \
                                                             feature_type='alexnet',\
                                                             layer_name=this_layer_name,\
@@ -721,6 +728,7 @@ def make_feature_loaders(args, fitting_types, vi, dnn_layers_use=None):
             else:
                 feat_loader = fwrf_features.fwrf_feature_loader(subject=sub,\
                                                             image_set=args.image_set,\
+                                                            prefetch=args.prefetch_features,\
                                                             which_prf_grid=prf_grid, \
                                                             feature_type='alexnet',\
                                                             layer_name=args.alexnet_layer_name,\
@@ -754,6 +762,7 @@ def make_feature_loaders(args, fitting_types, vi, dnn_layers_use=None):
                 for ll in range(len(names)):
                     feat_loader = fwrf_features.fwrf_feature_loader(subject=sub,\
                                                             image_set=args.image_set,\
+                                                            prefetch=args.prefetch_features,\
                                                             which_prf_grid=prf_grid, \
                                                             feature_type='resnet',layer_name=names[ll],\
                                                             model_architecture=args.resnet_model_architecture,\
@@ -768,6 +777,7 @@ def make_feature_loaders(args, fitting_types, vi, dnn_layers_use=None):
                 print(this_layer_name)
                 feat_loader = fwrf_features.fwrf_feature_loader(subject=sub,\
                                                             image_set=args.image_set,\
+                                                            prefetch=args.prefetch_features,\
                                                             which_prf_grid=prf_grid, \
                                                             feature_type='resnet',layer_name=this_layer_name,\
                                                             model_architecture=args.resnet_model_architecture,\
@@ -780,6 +790,7 @@ def make_feature_loaders(args, fitting_types, vi, dnn_layers_use=None):
             else:
                 feat_loader = fwrf_features.fwrf_feature_loader(subject=sub,\
                                                             image_set=args.image_set,\
+                                                            prefetch=args.prefetch_features,\
                                                             which_prf_grid=prf_grid, \
                                                             feature_type='resnet',\
                                                             layer_name=args.resnet_layer_name,\
@@ -5,6 +5,7 @@ import numpy as np
 import pandas as pd
 import PIL
 import copy
+import h5py
 
 from utils import default_paths, nsd_utils, prf_utils, segmentation_utils
 
@@ -52,12 +53,14 @@ def write_binary_labels_csv(subject, stuff=False):
     return
 
 def write_binary_labels_csv_within_prf(subject, min_pix = 10, stuff=False, \
-                                       which_prf_grid=1, debug=False):
+                                       which_prf_grid=1, debug=False, write_csv=True):
     """
     Creating a csv file where columns are binary labels for the presence/absence of categories
     and supercategories in COCO.
     Analyzing presence of categories for each pRF position separately - make a separate csv file for each prf.
     10,000 images long (same size as image arrays in /nsd/stimuli/)
+    Also saves all pRFs in one packed file (see write_packed_binary_labels), which is what
+    the loaders use when it exists. Set write_csv=False to skip the per-pRF csv files.
     """
 
     from utils import coco_utils
@@ -167,6 +170,23 @@ def write_binary_labels_csv_within_prf(subject, min_pix = 10, stuff=False, \
         sys.stdout.flush()            
              
                     
+    if debug:
+        folder2save = os.path.join(default_paths.stim_labels_root, 'DEBUG', \
+                                       'S%d_within_prf_grid%d'%(subject, which_prf_grid))
+    else:
+        folder2save = os.path.join(default_paths.stim_labels_root, \
+                                       'S%d_within_prf_grid%d'%(subject, which_prf_grid))
+    if not os.path.exists(folder2save):
+        os.makedirs(folder2save)
+        
+    # Save all pRFs together in one packed file
+    fn2save = os.path.join(folder2save, get_packed_labels_filename(subject, stuff))
+    write_packed_binary_labels(np.concatenate([supcat_labels_binary, cat_labels_binary], axis=1), \
+                               get_unique_colnames(supcat_names + cat_names), fn2save)
+    
+    if not write_csv:
+        return
+    
     # Now save as csv files for each pRF
     for mm in range(n_prfs):
         
@@ -177,14 +197,6 @@ def write_binary_labels_csv_within_prf(subject, min_pix = 10, stuff=False, \
                                                       cat_labels_binary[:,:,mm]], axis=1), \
                                                       columns = supcat_names + cat_names)
     
-        if debug:
-            folder2save = os.path.join(default_paths.stim_labels_root, 'DEBUG', \
-                                           'S%d_within_prf_grid%d'%(subject, which_prf_grid))
-        else:
-            folder2save = os.path.join(default_paths.stim_labels_root, \
-                                           'S%d_within_prf_grid%d'%(subject, which_prf_grid))
-        if not os.path.exists(folder2save):
-            os.makedirs(folder2save)
         if stuff:
             fn2save =  os.path.join(folder2save,'S%d_cocolabs_stuff_binary_prf%d.csv'%(subject, mm))
         else:
@@ -193,6 +205,134 @@ def write_binary_labels_csv_within_prf(subject, min_pix = 10, stuff=False, \
         binary_df.to_csv(fn2save, header=True)
         
         
+def get_packed_labels_filename(subject, stuff=False):
+    
+    if stuff:
+        return 'S%d_cocolabs_stuff_binary_packed.h5'%subject
+    else:
+        return 'S%d_cocolabs_binary_packed.h5'%subject
+    
+def get_unique_colnames(colnames):
+    """
+    Rename any repeated column names the same way that pd.read_csv does 
+    (second "person" becomes "person.1", etc.), so that packed labels have the 
+    same column names as the csv files.
+    """
+    colnames = list(colnames)
+    counts = dict()
+    for ii, cc in enumerate(colnames):
+        orig_cc = cc
+        cur_count = counts.get(cc, 0)
+        while cur_count > 0:
+            counts[orig_cc] = cur_count + 1
+            cc = '%s.%d'%(orig_cc, cur_count)
+            if cc in colnames:
+                cur_count += 1
+            else:
+                cur_count = counts.get(cc, 0)
+        colnames[ii] = cc
+        counts[cc] = cur_count + 1
+        
+    return colnames
+
+def write_packed_binary_labels(labels, colnames, fn2save):
+    """
+    Save binary labels for all pRFs in one file. 
+    labels is [n_images x n_labels x n_prfs], all values 0 or 1.
+    The labels are stored as bits (np.packbits along the labels axis), in a 
+    [n_prfs x n_images x n_bytes] array chunked by pRF, so loading one pRF 
+    only reads that pRF's labels.
+    """
+    n_images, n_labels, n_prfs = labels.shape
+    assert(len(colnames)==n_labels)
+    assert(np.all((labels==0) | (labels==1)))
+    
+    print('Saving to %s'%fn2save)
+    with h5py.File(fn2save, 'w') as f:
+        packed = f.create_dataset('labels_packed', \
+                                  shape=(n_prfs, n_images, int(np.ceil(n_labels/8))), \
+                                  dtype=np.uint8, chunks=(1, n_images, int(np.ceil(n_labels/8))))
+        for mm in range(n_prfs):
+            packed[mm,:,:] = np.packbits(labels[:,:,mm]==1, axis=1)
+        f.create_dataset('colnames', data=np.array(colnames, dtype=object), \
+                         dtype=h5py.string_dtype())
+        f.attrs['n_labels'] = n_labels
+        
+def convert_binary_labels_csv_to_packed(subject, which_prf_grid, stuff=False):
+    """
+    Make the packed label file from the existing per-pRF csv files 
+    (written by write_binary_labels_csv_within_prf).
+    """
+    labels_folder = os.path.join(default_paths.stim_labels_root,\
+                                 'S%d_within_prf_grid%d'%(subject, which_prf_grid))
+    if stuff:
+        csv_name = 'S%d_cocolabs_stuff_binary_prf%d.csv'
+    else:
+        csv_name = 'S%d_cocolabs_binary_prf%d.csv'
+        
+    models = prf_utils.get_prf_models(which_grid=which_prf_grid)    
+    n_prfs = len(models)
+    
+    for mm in range(n_prfs):
+        fn2load = os.path.join(labels_folder, csv_name%(subject, mm))
+        print('Loading from %s'%fn2load)
+        sys.stdout.flush()
+        coco_df = pd.read_csv(fn2load, index_col=0)
+        if mm==0:
+            colnames = list(coco_df.keys())
+            labels = np.zeros((coco_df.shape[0], coco_df.shape[1], n_prfs), dtype=np.uint8)
+        else:
+            assert(list(coco_df.keys())==colnames)
+        labels[:,:,mm] = np.array(coco_df)
+    
+    fn2save = os.path.join(labels_folder, get_packed_labels_filename(subject, stuff))
+    write_packed_binary_labels(labels, colnames, fn2save)
+
+def load_packed_binary_labels(fn2load, prf_model_index):
+    """
+    Load binary labels for one pRF from a packed label file.
+    Returns labels [n_images x n_labels] (int), and the column names.
+    """
+    with h5py.File(fn2load, 'r') as f:
+        n_labels = int(f.attrs['n_labels'])
+        packed = f['labels_packed'][prf_model_index,:,:]
+        colnames = [cc.decode() if isinstance(cc, bytes) else cc for cc in f['colnames'][:]]
+        
+    # same dtype as reading the csv file
+    labels = np.unpackbits(packed, axis=1, count=n_labels).astype(int)
+    
+    return labels, colnames
+    
+def load_binary_labels_within_prf(subject, which_prf_grid, prf_model_index, stuff=False, verbose=False):
+    """
+    Load the coco (or coco-stuff) binary labels for one pRF: first supercategories, 
+    then categories. Same values/columns as the per-pRF csv files.
+    Uses the packed label file if it exists, otherwise the csv file.
+    Returns labels [n_images x n_labels] (int), and the column names.
+    """
+    labels_folder = os.path.join(default_paths.stim_labels_root,\
+                                 'S%d_within_prf_grid%d'%(subject, which_prf_grid))
+    fn2load = os.path.join(labels_folder, get_packed_labels_filename(subject, stuff))
+    
+    if os.path.exists(fn2load):
+        if verbose:
+            print('Loading pre-computed features from %s, prf %d'%(fn2load, prf_model_index))
+        labels, colnames = load_packed_binary_labels(fn2load, prf_model_index)
+    else:
+        if stuff:
+            fn2load = os.path.join(labels_folder, \
+                              'S%d_cocolabs_stuff_binary_prf%d.csv'%(subject, prf_model_index))
+        else:
+            fn2load = os.path.join(labels_folder, \
+                              'S%d_cocolabs_binary_prf%d.csv'%(subject, prf_model_index))
+        if verbose:
+            print('Loading pre-computed features from %s'%fn2load)
+        coco_df = pd.read_csv(fn2load, index_col=0)
+        labels = np.array(coco_df)
+        colnames = list(coco_df.keys())
+        
+    return labels, colnames
+        
 def make_indoor_outdoor_labels(subject):
     """
     Creating binary labels for indoor/outdoor status of images (inferred based on presence of 
@@ -268,8 +408,6 @@ def make_buildings_labels(subject, which_prf_grid):
 
     stuff_cat_objects, stuff_cat_names, stuff_cat_ids, stuff_supcat_names, stuff_ids_each_supcat = \
             coco_utils.get_coco_cat_info(coco_utils.coco_stuff_val) 
-
-    labels_folder = os.path.join(default_paths.stim_labels_root,'S%d_within_prf_grid%d'%(subject, which_prf_grid))
     
     fn2load = os.path.join(os.path.dirname(os.path.abspath(__file__)),'files','Building_stuff_categ.npy')
     d = np.load(fn2load, allow_pickle=True).item()
@@ -291,10 +429,9 @@ def make_buildings_labels(subject, which_prf_grid):
     
     for prf_model_index in range(n_prfs):
 
-        fn2load = os.path.join(labels_folder, \
-                              'S%d_cocolabs_stuff_binary_prf%d.csv'%(subject, prf_model_index))
-        coco_stuff_df = pd.read_csv(fn2load, index_col=0)
-        stuff_cat_labels = np.array(coco_stuff_df)[:,16:108]
+        stuff_labels, _ = load_binary_labels_within_prf(subject, which_prf_grid, \
+                                                        prf_model_index, stuff=True)
+        stuff_cat_labels = stuff_labels[:,16:108]
         
         has_building[:,prf_model_index] = np.any(stuff_cat_labels[:,building_cat_inds], axis=1)
         
@@ -347,8 +484,6 @@ def make_realworldsize_labels(subject, which_prf_grid):
     cat_objects, cat_names, cat_ids, supcat_names, ids_each_supcat = \
                 coco_utils.get_coco_cat_info(coco_utils.coco_val)
 
-    labels_folder = os.path.join(default_paths.stim_labels_root,'S%d_within_prf_grid%d'%(subject, which_prf_grid))
-    
     # load a dict of sizes for each category
     fn2save = os.path.join(os.path.dirname(os.path.abspath(__file__)),'files','Realworldsize_categ.npy')
     names_to_sizes = np.load(fn2save, allow_pickle=True).item()
@@ -402,11 +537,10 @@ def make_realworldsize_labels(subject, which_prf_grid):
     
     for prf_model_index in range(n_prfs):
        
-        fn2load = os.path.join(labels_folder, \
-                          'S%d_cocolabs_binary_prf%d.csv'%(subject, prf_model_index))
-        coco_df = pd.read_csv(fn2load, index_col = 0)
+        coco_labels, _ = load_binary_labels_within_prf(subject, which_prf_grid, \
+                                                       prf_model_index, stuff=False)
 
-        cat_labels = np.array(coco_df)[:,12:92]
+        cat_labels = coco_labels[:,12:92]
 
         s = np.any(cat_labels[:,categ_size_labels[0,:]], axis=1).astype(float)
         m = np.any(cat_labels[:,categ_size_labels[1,:]], axis=1).astype(float)
@@ -436,8 +570,6 @@ def make_animacy_labels(subject, which_prf_grid):
     """
     Creating labels for animacy of objects in image patches
     """
-
-    labels_folder = os.path.join(default_paths.stim_labels_root,'S%d_within_prf_grid%d'%(subject, which_prf_grid))
     
     # first making labels for entire image
     fn2load = os.path.join(default_paths.stim_labels_root,'S%d_cocolabs_binary.csv'%(subject))
@@ -467,9 +599,9 @@ def make_animacy_labels(subject, which_prf_grid):
     
     for prf_model_index in range(n_prfs):
       
-        fn2load = os.path.join(labels_folder,'S%d_cocolabs_binary_prf%d.csv'%(subject, prf_model_index))
-        coco_df = pd.read_csv(fn2load, index_col = 0)
-        supcat_labels = np.array(coco_df)[:,0:12]
+        coco_labels, _ = load_binary_labels_within_prf(subject, which_prf_grid, \
+                                                       prf_model_index, stuff=False)
+        supcat_labels = coco_labels[:,0:12]
         animate_supcats = np.array([1,9])
         inanimate_supcats = np.array([ii for ii in range(12) if ii not in animate_supcats])
         a = np.any(supcat_labels[:,animate_supcats]==1, axis=1).astype(float)
@@ -702,21 +834,19 @@ def count_total_coco_labels(which_prf_grid=5):
         print('analyzing counts for S%d, %d images'%(ss, len(image_order)))
         n_trials = len(image_order)
         sys.stdout.flush()
-        labels_folder = os.path.join(default_paths.stim_labels_root,\
-                                 'S%d_within_prf_grid%d'%(ss, which_prf_grid))
     
         for prf_model_index in range(n_prfs):
       
-            fn2load = os.path.join(labels_folder,'S%d_cocolabs_binary_prf%d.csv'%(ss, prf_model_index))
-            coco_df = pd.read_csv(fn2load, index_col = 0)
-            coco_things_binary = np.array(coco_df)[:,12:92]
+            coco_labels, _ = load_binary_labels_within_prf(ss, which_prf_grid, \
+                                                           prf_model_index, stuff=False)
+            coco_things_binary = coco_labels[:,12:92]
             num_things = np.sum(coco_things_binary, axis=1)
         
             counts_coco_things[si,prf_model_index] = np.sum(num_things)
             
-            fn2load = os.path.join(labels_folder,'S%d_cocolabs_stuff_binary_prf%d.csv'%(ss, prf_model_index))
-            coco_df = pd.read_csv(fn2load, index_col = 0)
-            coco_stuff_binary = np.array(coco_df)[:,16:108]
+            coco_labels, _ = load_binary_labels_within_prf(ss, which_prf_grid, \
+                                                           prf_model_index, stuff=True)
+            coco_stuff_binary = coco_labels[:,16:108]
             num_stuff = np.sum(coco_stuff_binary, axis=1)
         
             counts_coco_stuff[si,prf_model_index] = np.sum(num_stuff)
@@ -0,0 +1,28 @@
+import os, sys, argparse
+import numpy as np
+
+from utils import label_utils
+from utils import default_paths
+
+nsd_root = default_paths.nsd_root
+labels_path = default_paths.stim_labels_root
+
+print('nsd_root: %s'%nsd_root)
+print('labels_path: %s'%labels_path)
+ 
+if __name__ == '__main__':
+    
+    parser = argparse.ArgumentParser()
+    
+    parser.add_argument("--which_prf_grid", type=int,default=5,
+                    help="which version of prf grid to use")
+   
+    args = parser.parse_args()
+    
+    # convert the existing per-pRF csv files into one packed file per subject/label type
+    subjects = list(np.arange(1,9))+[999,998]
+        
+    for subject in subjects:
+        
+        label_utils.convert_binary_labels_csv_to_packed(subject=subject, which_prf_grid=args.which_prf_grid, stuff=False)
+        label_utils.convert_binary_labels_csv_to_packed(subject=subject, which_prf_grid=args.which_prf_grid, stuff=True)
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 import scipy.stats
 import warnings
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
@@ -57,13 +58,103 @@ def get_corrcoef(actual,predicted,dtype=np.float32):
     """
     This computes the linear correlation coefficient.
     Always goes along first dimension (i.e. the trials/samples dimension)
-    Assume input is 2D.
+    Each column (or element of the trailing dimensions) is done separately, 
+    all at once. Same values as np.corrcoef on each column, computed in float64.
+    Problems (constant columns, nans) are reported for all columns together.
     """
-    assert(len(actual.shape)==2)
-    vals_cc = np.full(fill_value=0, shape=(actual.shape[1],), dtype=dtype)
-    for vv in range(actual.shape[1]):
-        vals_cc[vv] = numpy_corrcoef_warn(actual[:,vv], predicted[:,vv])[0,1] 
-    return vals_cc
+    assert(len(actual.shape)>=2)
+    assert(actual.shape==predicted.shape)
+    a = np.asarray(actual, dtype=np.float64)
+    b = np.asarray(predicted, dtype=np.float64)
+    n = a.shape[0]
+    a = a - np.mean(a, axis=0)
+    b = b - np.mean(b, axis=0)
+    std_a = np.sqrt(np.sum(a*a, axis=0) / (n-1))
+    std_b = np.sqrt(np.sum(b*b, axis=0) / (n-1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vals_cc = np.sum(a*b, axis=0) / (n-1) / std_a / std_b
+    # same clipping as np.corrcoef
+    vals_cc = np.clip(vals_cc, -1, 1)
+    
+    corrcoef_warn_summary(vals_cc, std_a, std_b)
+        
+    return vals_cc.astype(dtype)
+
+def get_corrcoef_torch(_actual, _predicted):
+    """
+    Same as get_corrcoef, but for torch tensors, computed on whatever device they are on.
+    Returns a tensor (float64) with shape of the trailing dimensions.
+    """
+    assert(len(_actual.shape)>=2)
+    assert(_actual.shape==_predicted.shape)
+    _a = _actual.double()
+    _b = _predicted.double()
+    n = _a.shape[0]
+    _a = _a - torch.mean(_a, dim=0)
+    _b = _b - torch.mean(_b, dim=0)
+    _std_a = torch.sqrt(torch.sum(_a*_a, dim=0) / (n-1))
+    _std_b = torch.sqrt(torch.sum(_b*_b, dim=0) / (n-1))
+    _cc = torch.sum(_a*_b, dim=0) / (n-1) / _std_a / _std_b
+    _cc = torch.clamp(_cc, -1, 1)
+    
+    corrcoef_warn_summary(_cc.detach().cpu().numpy(), \
+                          _std_a.detach().cpu().numpy(), _std_b.detach().cpu().numpy())
+    
+    return _cc
+
+def corrcoef_warn_summary(vals_cc, std_a, std_b):
+    """
+    Print the same kind of diagnostics as numpy_corrcoef_warn, but summarized over 
+    a whole set of correlation coefficients.
+    """
+    zero_std = (std_a==0) | (std_b==0)
+    if np.any(zero_std):
+        print('Warning: problem computing correlation coefficient')
+        print('%d of %d columns have zero variance (actual: %d, predicted: %d)'\
+              %(np.sum(zero_std), zero_std.size, np.sum(std_a==0), np.sum(std_b==0)))
+    if np.any(np.isnan(vals_cc)):
+        print('There are nans in correlation coefficient (%d of %d columns)'\
+              %(np.sum(np.isnan(vals_cc)), vals_cc.size))
+
+def get_corrcoef_all_pairs(a, b):
+    """
+    Linear correlation coefficient between every column of a [n_samples x n_a] 
+    and every column of b [n_samples x n_b], done as one matrix multiplication.
+    Returns [n_a x n_b]. Columns with no variance give nan, same as np.corrcoef.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    a = a - np.mean(a, axis=0, keepdims=True)
+    b = b - np.mean(b, axis=0, keepdims=True)
+    norm_a = np.sqrt(np.sum(a**2, axis=0))
+    norm_b = np.sqrt(np.sum(b**2, axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cc = (a.T @ b) / (norm_a[:,None] * norm_b[None,:])
+    # same clipping as np.corrcoef
+    cc = np.clip(cc, -1, 1)
+    
+    return cc
+
+
+def get_corrcoef_rows(a, b):
+    """
+    Linear correlation coefficient between each row of a [n_rows x n_samples] and the 
+    vector b [n_samples], same steps as np.corrcoef(a[ii,:], b)[0,1] for each row.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    n = a.shape[1]
+    a = a - np.mean(a, axis=1, keepdims=True)
+    b = b - np.mean(b)
+    cov_ab = (a @ b) / (n-1)
+    std_a = np.sqrt(np.sum(a*a, axis=1) / (n-1))
+    std_b = np.sqrt(np.dot(b, b) / (n-1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cc = cov_ab / std_a / std_b
+    # same clipping as np.corrcoef
+    cc = np.clip(cc, -1, 1)
+    
+    return cc
 
 
 def compute_partial_corr(x, y, c, return_p=False):
@@ -74,15 +165,19 @@ def compute_partial_corr(x, y, c, return_p=False):
     Uses linear regression based method.
     Inputs: 
         x [n_samples,] or [n_samples,1]
-        y [n_samples,] or [n_samples,1]
+        y [n_samples,] or [n_samples,n_targets]
         c [n_samples,] or [n_samples,n_covariates]
         
     Outputs:
-        partial_corr, a single value for the partial correlation coefficient.
+        partial_corr, a single value for the partial correlation coefficient 
+        (or [n_targets,] if y has more than one column).
+    The regression on c is the same for x and each column of y, so the projection
+    is computed once and applied to all targets together.
     """
     
     if len(x.shape)==1:
         x = x[:,np.newaxis]        
+    single_target = (len(y.shape)==1) or (y.shape[1]==1)
     if len(y.shape)==1:
         y = y[:,np.newaxis]
     if len(c.shape)==1:
@@ -90,25 +185,39 @@ def compute_partial_corr(x, y, c, return_p=False):
     n_trials = x.shape[0]
     assert(y.shape[0]==n_trials and c.shape[0]==n_trials)
     
+    # predictors for both models are the other vars plus intercept
+    model_preds = np.concatenate([c, np.ones((n_trials,1))], axis=1)
+    model_preds_pinv = np.linalg.pinv(model_preds)
+    
     # first predict x from the other vars
-    model1_preds = np.concatenate([c, np.ones((n_trials,1))], axis=1)
-    model1_coeffs = np.linalg.pinv(model1_preds) @ x
-    model1_yhat = model1_preds @ model1_coeffs
+    model1_coeffs = model_preds_pinv @ x
+    model1_yhat = model_preds @ model1_coeffs
     model1_resids = model1_yhat - x
    
-    # then predict y from the other vars
-    model2_preds = np.concatenate([c, np.ones((n_trials,1))], axis=1)
-    model2_coeffs = np.linalg.pinv(model2_preds) @ y
-    model2_yhat = model2_preds @ model2_coeffs
+    # then predict y from the other vars (all columns at once)
+    model2_coeffs = model_preds_pinv @ y
+    model2_yhat = model_preds @ model2_coeffs
     model2_resids = model2_yhat - y
 
     # correlate the residuals to get partial correlation.
-    if return_p:
-        partial_corr, p = scipy.stats.pearsonr(model1_resids[:,0], model2_resids[:,0])
-        return partial_corr, p
+    if single_target:
+        if return_p:
+            partial_corr, p = scipy.stats.pearsonr(model1_resids[:,0], model2_resids[:,0])
+            return partial_corr, p
+        else:
+            partial_corr = numpy_corrcoef_warn(model1_resids[:,0], model2_resids[:,0])[0,1]
+            return partial_corr
     else:
-        partial_corr = numpy_corrcoef_warn(model1_resids[:,0], model2_resids[:,0])[0,1]
-        return partial_corr
+        partial_corr = get_corrcoef_rows(model2_resids.T, model1_resids[:,0])
+        if np.any(~np.isfinite(partial_corr)):
+            print('Warning: problem computing partial correlation, %d of %d targets have non-finite values'\
+                  %(np.sum(~np.isfinite(partial_corr)), len(partial_corr)))
+        if return_p:
+            p = np.array([scipy.stats.pearsonr(model1_resids[:,0], model2_resids[:,tt])[1] \
+                          for tt in range(y.shape[1])])
+            return partial_corr, p
+        else:
+            return partial_corr
    
     
 
@@ -212,6 +321,47 @@ def anova_oneway_warn(groups):
            
     return anova_out
 
+def ttest_warn_rows(a,b):
+    
+    """
+    Same as ttest_warn, but for many t-tests at once: each row of a [n_rows x n_a] vs. the same 
+    row of b [n_rows x n_b]. Problems are reported for all rows together.
+    """
+    with warnings.catch_warnings(record=True) as warns:
+        warnings.simplefilter('always')
+        ttest_out = scipy.stats.ttest_ind(a,b,axis=1)
+        
+    if len(warns)>0:
+        bad = ~np.isfinite(ttest_out.statistic)
+        print('Warning: problem with t test, %d of %d rows have non-finite values'%(np.sum(bad), len(bad)))
+        print(np.unique([str(ww.message) for ww in warns]))
+    
+    if np.any(np.isnan(ttest_out.statistic)):
+        print('nans in t-test result')
+           
+    return ttest_out
+
+def anova_oneway_warn_rows(groups):
+    
+    """
+    Same as anova_oneway_warn, but for many anovas at once: each element of groups is 
+    [n_rows x n_samples_in_group], and the anova is done for each row. 
+    Problems are reported for all rows together.
+    """
+    with warnings.catch_warnings(record=True) as warns:
+        warnings.simplefilter('always')
+        anova_out = scipy.stats.f_oneway(*groups, axis=1)
+        
+    if len(warns)>0:
+        bad = ~np.isfinite(anova_out.statistic)
+        print('Warning: problem with one way anova, %d of %d rows have non-finite values'%(np.sum(bad), len(bad)))
+        print(np.unique([str(ww.message) for ww in warns]))
+    
+    if np.any(np.isnan(anova_out.statistic)):
+        print('nans in anova result')
+           
+    return anova_out
+
 def ttest_unequal(a,b):
     
     """
@@ -490,11 +640,7 @@ def decode_lda(X, y, n_crossval_folds=10, debug=False):
     if not debug:
         assert(len(un_values)>1)
     
-    n_per_fold = int(np.ceil(n_trials/n_crossval_folds))
-    
-    cv_labels = np.tile(np.arange(n_crossval_folds), n_per_fold)[0:n_trials]
-    shuff_order = np.random.permutation(np.arange(n_trials))
-    cv_labels = cv_labels[shuff_order]
+    cv_labels = get_cv_labels(n_trials, n_crossval_folds)
 
     ypred = np.zeros_like(y)
     
@@ -521,4 +667,174 @@ def decode_lda(X, y, n_crossval_folds=10, debug=False):
     tst_acc = np.mean(ypred==y)
     tst_dprime = get_dprime(ypred, y, un_values)
     
-    return tst_acc, tst_dprime
\ No newline at end of file
+    return tst_acc, tst_dprime
+
+def get_cv_labels(n_trials, n_crossval_folds=10):
+
+    """
+    Random assignment of trials to cross-validation folds (as evenly as possible).
+    Uses the global numpy random state, so calling this in the same order as
+    decode_lda would gives the same folds.
+    """
+
+    n_per_fold = int(np.ceil(n_trials/n_crossval_folds))
+
+    cv_labels = np.tile(np.arange(n_crossval_folds), n_per_fold)[0:n_trials]
+    shuff_order = np.random.permutation(np.arange(n_trials))
+    cv_labels = cv_labels[shuff_order]
+
+    return cv_labels
+
+def decode_lda_batch(X, y, cv_labels, n_crossval_folds=10, device='cpu:0', tol=1e-4, debug=False):
+
+    """
+    Cross-validated LDA decoding for a batch of problems that have the same number of
+    trials (e.g. many pRFs for one semantic axis), same result as decode_lda
+    for each problem (given the same cv_labels).
+    Instead of fitting sklearn's LinearDiscriminantAnalysis for each fold,
+    the class means and pooled within-class covariance for each training set are computed
+    from sufficient statistics (totals over all trials minus the held-out fold), and the
+    classifier for all problems in the batch is solved at once with batched linear algebra.
+    Like the 'svd' solver in sklearn, features are standardized by their within-class std,
+    and directions of the within-class covariance with singular values < tol are discarded.
+    Works for binary or multi-class labels.
+    Inputs:
+        X ~ [n_problems x n_trials x n_features] (can pad with zeros if problems have
+            different numbers of features, constant features are ignored)
+        y ~ [n_problems x n_trials], labels (same number of unique labels for all problems)
+        cv_labels ~ [n_problems x n_trials], which fold each trial is in (see get_cv_labels)
+    Returns:
+        tst_acc ~ [n_problems]
+        tst_dprime ~ [n_problems]
+    """
+
+    n_problems, n_trials, n_features = X.shape
+    assert(y.shape==(n_problems, n_trials))
+    assert(cv_labels.shape==(n_problems, n_trials))
+
+    un_values = [np.unique(y[pp]) for pp in range(n_problems)]
+    n_classes = len(un_values[0])
+    assert(np.all([len(un)==n_classes for un in un_values]))
+    if not debug:
+        assert(n_classes>1)
+    # labels as indices into unique values, [n_problems x n_trials]
+    y_inds = np.array([np.searchsorted(un_values[pp], y[pp]) for pp in range(n_problems)])
+
+    with torch.no_grad():
+
+        _x = torch.tensor(X, dtype=torch.float64, device=device)
+        # constant features have no within-class variance, set them to exactly zero
+        # so that they get dropped.
+        const_feats = torch.all(_x==_x[:,0:1,:], axis=1)
+        # centering doesn't change the classifier, but helps precision of the sums below
+        _x = _x - torch.mean(_x, axis=1, keepdim=True)
+        _x = torch.where(const_feats[:,None,:], torch.zeros_like(_x), _x)
+
+        onehot_y = torch.nn.functional.one_hot(torch.tensor(y_inds, dtype=torch.int64, device=device), \
+                                               n_classes).to(torch.float64)
+        onehot_cv = torch.nn.functional.one_hot(torch.tensor(cv_labels, dtype=torch.int64, device=device), \
+                                                n_crossval_folds).to(torch.float64)
+
+        # sufficient statistics for each fold
+        # counts is [n_problems x n_folds x n_classes], sums is [n_problems x n_folds x n_classes x n_features]
+        counts = torch.einsum('ptf,ptk->pfk', onehot_cv, onehot_y)
+        sums = torch.einsum('ptf,ptk,ptn->pfkn', onehot_cv, onehot_y, _x)
+        # training set for each fold is everything except that fold
+        counts_trn = torch.sum(counts, axis=1, keepdim=True) - counts
+        sums_trn = torch.sum(sums, axis=1, keepdim=True) - sums
+        # [n_problems x n_features x n_features]
+        xtx_all = _x.transpose(1,2) @ _x
+
+        # make sure all labels are represented for each cross-val fold.
+        assert(torch.all(counts_trn>0))
+
+        ypred_inds = torch.zeros((n_problems, n_trials), dtype=torch.int64, device=device)
+
+        for cv in range(n_crossval_folds):
+
+            tstinds = onehot_cv[:,:,cv]
+
+            xtx_trn = xtx_all - (_x * tstinds[:,:,None]).transpose(1,2) @ _x
+
+            n_each = counts_trn[:,cv,:]
+            n_trn = torch.sum(n_each, axis=1)
+            means = sums_trn[:,cv,:,:] / n_each[:,:,None]
+
+            # pooled within-class scatter
+            within = xtx_trn - torch.einsum('pk,pkn,pkm->pnm', n_each, means, means)
+
+            # standardize features, and scale to within-class covariance
+            # (same scaling as the sklearn svd solver, 1/n_samples)
+            std = torch.sqrt(torch.clamp(torch.diagonal(within, dim1=1, dim2=2)/n_trn[:,None], min=0))
+            std[std==0] = 1.0
+            fac = 1 / n_trn
+            cov = within / (std[:,:,None] * std[:,None,:]) * fac[:,None,None]
+
+            # pseudo-inverse, dropping directions with singular values < tol
+            evals, evecs = torch.linalg.eigh(cov)
+            keep = evals > tol**2
+            inv_evals = torch.where(keep, 1/torch.where(keep, evals, torch.ones_like(evals)), \
+                                    torch.zeros_like(evals))
+
+            means_proj = (means / std[:,None,:]) @ evecs
+            coefs = (means_proj * inv_evals[:,None,:]) @ evecs.transpose(1,2)
+            priors = n_each / n_trn[:,None]
+            intercepts = -0.5 * torch.sum(means_proj**2 * inv_evals[:,None,:], axis=2) + torch.log(priors)
+
+            # scores for every trial, only keep predictions for the held-out ones
+            scores = (_x / std[:,None,:]) @ coefs.transpose(1,2) + intercepts[:,None,:]
+            ypred_inds = torch.where(tstinds==1, torch.argmax(scores, axis=2), ypred_inds)
+
+        ypred_inds = ypred_inds.detach().cpu().numpy()
+
+    ypred = np.array([un_values[pp][ypred_inds[pp]] for pp in range(n_problems)])
+
+    tst_acc = np.mean(ypred==y, axis=1)
+    tst_dprime = np.array([get_dprime(ypred[pp], y[pp], un_values[pp]) for pp in range(n_problems)])
+
+    return tst_acc, tst_dprime
+
+def decode_lda_many(X_list, y_list, cv_labels_list, n_crossval_folds=10, \
+                    max_batch_size=100, device='cpu:0', debug=False):
+
+    """
+    Run decode_lda_batch for a list of decoding problems (e.g. all pRFs x semantic axes).
+    Problems with the same number of trials and classes are done together, in batches of up
+    to max_batch_size. If problems have different numbers of features, the features are
+    padded with zeros (which doesn't change the result).
+    X_list is a list of [n_trials x n_features] arrays, y_list and cv_labels_list are lists
+    of [n_trials] arrays (to get the same folds as decode_lda, make the cv_labels with
+    get_cv_labels, in the same order that decode_lda would have been called).
+    Returns tst_acc and tst_dprime, each [n_problems]
+    """
+
+    n_problems = len(X_list)
+    assert(len(y_list)==n_problems and len(cv_labels_list)==n_problems)
+
+    tst_acc = np.zeros((n_problems,))
+    tst_dprime = np.zeros((n_problems,))
+
+    # problems in a batch need the same number of trials and of classes
+    n_trials_each = np.array([len(yy) for yy in y_list])
+    n_classes_each = np.array([len(np.unique(yy)) for yy in y_list])
+
+    for n_trials, n_classes in np.unique(np.array([n_trials_each, n_classes_each]).T, axis=0):
+
+        problem_inds = np.where((n_trials_each==n_trials) & (n_classes_each==n_classes))[0]
+
+        for bb in range(0, len(problem_inds), max_batch_size):
+
+            batch_inds = problem_inds[bb:bb+max_batch_size]
+            n_features = np.max([X_list[pp].shape[1] for pp in batch_inds])
+
+            X = np.zeros((len(batch_inds), n_trials, n_features))
+            for pi, pp in enumerate(batch_inds):
+                X[pi,:,0:X_list[pp].shape[1]] = X_list[pp]
+            y = np.array([y_list[pp] for pp in batch_inds])
+            cv_labels = np.array([cv_labels_list[pp] for pp in batch_inds])
+
+            tst_acc[batch_inds], tst_dprime[batch_inds] = \
+                    decode_lda_batch(X, y, cv_labels, n_crossval_folds=n_crossval_folds, \
+                                     device=device, debug=debug)
+
+    return tst_acc, tst_dprime